@@ -3,13 +3,23 @@
 import pygame
 from pygame.locals import *
 import csv
+import io
+import json
 import sys
 import os
 import time
 from datetime import datetime
 from math import sqrt
 import random
+import heapq
+import bisect
 import textwrap
+import struct
+import threading
+import tracemalloc
+import zlib
+import numpy as np
+from collections import OrderedDict, deque
 
 # Define the window dimensions, title and game speed (frames per second)
 WINDOW_WIDTH = 816
@@ -17,6 +27,16 @@ WINDOW_HEIGHT = 528
 WINDOW_TITLE = "Hero Adventure"
 GAME_FPS = 30
 
+# The game logic runs GAME_FPS times a second whatever the frame rate.
+# Frames are drawn up to RENDER_FPS times a second with moving objects drawn part
+# way between ticks. If the computer can't keep up, at most MAX_TICKS_PER_FRAME
+# ticks are run before drawing and the rest are dropped so the game slows down.
+RENDER_FPS = 60
+MAX_TICKS_PER_FRAME = 5
+
+# Objects that move further than this in one tick (e.g. teleports) are not interpolated
+TELEPORT_DISTANCE = 64
+
 # Define the size and position of the speech box
 SPEECH_RECT_X = 50
 SPEECH_RECT_Y = WINDOW_HEIGHT - 150
@@ -35,6 +55,30 @@ MAP_HEIGHT = 300
 COLLISION_LAYER_WIDTH = MAP_WIDTH*3
 COLLISION_LAYER_HEIGHT = MAP_HEIGHT*3
 
+# Size of a collision layer cell in pixels
+COLLISION_CELL_SIZE = 16
+
+# Anything put down with its foot box in something solid is moved to the middle of the
+# nearest clear collision cell within CLEAR_SEARCH_RADIUS cells, as it couldn't walk out
+CLEAR_SEARCH_RADIUS = 8
+
+# Number of rendered pieces of text to keep so they don't need rendering every frame
+TEXT_CACHE_SIZE = 256
+
+# Every image the game uses. These are loaded in the background while the menu is shown
+ASSET_MANIFEST = ["logo.png", "tilesheet.png", "items.png", "herosheet.png", "heroattack.png", "orc.png", "orcattack.png",
+                  "oldman.png", "lady.png", "kid.png", "blacksmith.png", "pirate.png", "abi.png"]
+
+# The map is edited as a CSV file and compiled into a binary file which loads much faster
+MAP_FILE = "map.txt"
+MAP_BINARY_FILE = "map.bin"
+MAP_BINARY_MAGIC = b"HAMB"
+MAP_BINARY_VERSION = 1
+
+# Size of the pre-rendered map chunks in tiles and the memory the chunk cache may use
+MAP_CHUNK_SIZE = 8
+MAP_CHUNK_CACHE_BUDGET = 32*1024*1024
+
 # Size of the maze in tiles
 MAZE_WIDTH = 23
 MAZE_HEIGHT = 21
@@ -68,6 +112,10 @@ RAIL_LEFT = 1
 RAIL_RIGHT = 2
 RAIL_UP = 3
 RAIL_DOWN = 4
+RAIL_DIRECTIONS = {RAIL_LEFT: (-1, 0), RAIL_RIGHT: (1, 0), RAIL_UP: (0, -1), RAIL_DOWN: (0, 1)}
+
+# Pixels a monster moves along its rail each tick
+RAIL_SPEED = 2
 
 # Keep track of the rescue kid mission
 KID_MISSION_START = 0           # need to speak to mum
@@ -79,24 +127,224 @@ KID_MISSION_DONE = 5            # spoken to mum with kid following
 
 kid_mission = KID_MISSION_START
 
+# How far between the last tick and the next tick is being drawn (0.0 to 1.0)
+draw_alpha = 1.0
+
+# The window is made by setup_display. A World makes a headless one if there isn't one yet
+screen = None
+
+# The World whose game objects are in the globals below. Each World keeps its own
+# copies of the WORLD_GLOBALS so more than one game can be run at the same time
+current_world = None
+WORLD_GLOBALS = ["game_map", "map_layers", "camera", "game_slot", "player", "people_npcs", "monster_npcs",
+                 "items", "scene", "GUI", "rng", "flow_field", "path_finder",
+                 "kid_mission", "game_over_countdown", "frame_count"]
+
 
 # Set to TRUE to show Player, NPC, and Item hit boxes. Used for debugging
 DRAW_HIT_BOXES = False
 
-# The map is made up of three visible layers called base, detail and top
-base_layer = [[0]*MAP_WIDTH for i in range(MAP_HEIGHT)]
-detail_layer = [[0]*MAP_WIDTH for i in range(MAP_HEIGHT)]
-top_layer = [[0]*MAP_WIDTH for i in range(MAP_HEIGHT)]
+# Set to TRUE to print how long the map took to load and how much memory it uses
+SHOW_LOAD_STATS = False
 
+# The map is made up of three visible layers called base, detail and top
 # Two invsisible layers are used for collision detection and movement on rails
-rail_layer = [[0]*MAP_WIDTH for i in range(MAP_HEIGHT)]
-collision_layer = [[0]*COLLISION_LAYER_WIDTH for i in range(COLLISION_LAYER_HEIGHT)]
+# The layers are stored in a MapLayers object and picked using these numbers
+LAYER_BASE = 0
+LAYER_DETAIL = 1
+LAYER_TOP = 2
+LAYER_RAIL = 3
+LAYER_COLLISION = 4
+
+# Tile the camera starts on and how fast it scrolls in pixels per frame
+CAMERA_START_X = 50
+CAMERA_START_Y = 83
+CAMERA_SPEED = 24
+
+# Layers the scene draws objects on. Lower layers are drawn first, then objects on
+# the same layer are drawn from the top of the map down
+SCENE_LAYER_FLOOR = 0
+SCENE_LAYER_OBJECTS = 1
+SCENE_LAYER_OVERHEAD = 2
+
+# How many places on average each object may move in the scene's insertion sort
+# before it gives up and sorts the whole list
+SCENE_MAX_SORT_MOVES = 4
+
+# Size in pixels of the cells in the grid used to find items quickly
+ITEM_GRID_CELL_SIZE = 96
+
+# Tags used to find items of a type. Every item has ITEM_TAG_ANY and items that can be
+# picked up have ITEM_TAG_GETABLE. The others are given to items whose names start with
+# the text in ITEM_NAME_TAGS unless the tags are given when the item is added
+ITEM_TAG_ANY = 0
+ITEM_TAG_GETABLE = 1
+ITEM_TAG_FIRE = 2
+ITEM_TAG_TREE = 3
+ITEM_TAG_DOOR = 4
+ITEM_TAGS = [ITEM_TAG_ANY, ITEM_TAG_GETABLE, ITEM_TAG_FIRE, ITEM_TAG_TREE, ITEM_TAG_DOOR]
+ITEM_NAME_TAGS = {"Fire": ITEM_TAG_FIRE, "Tree": ITEM_TAG_TREE, "Door": ITEM_TAG_DOOR}
+
+# Size in pixels of the cells in the proximity index used to find NPCs quickly
+NPC_GRID_CELL_SIZE = 96
+
+# How close the point 1 tile in front of the player must be to a person to talk to them
+TALK_DISTANCE = 50
+
+# Monsters further than MONSTER_RESET_DISTANCE from the player (in x or y) go back to
+# where they started. Monsters closer than MONSTER_AGGRO_DISTANCE start attacking.
+# MONSTER_HIT_MARGIN is how far a monster's body box reaches from where it is standing
+MONSTER_RESET_DISTANCE = 15*TILE_WIDTH
+MONSTER_AGGRO_DISTANCE = 96
+MONSTER_HIT_MARGIN = 64
+
+# The map is split into square regions. Only NPCs in the 3 by 3 regions around the
+# player are updated, the rest sleep until the player comes near. A region must be
+# bigger than MONSTER_RESET_DISTANCE and half the window so sleeping NPCs are off screen
+ACTIVE_REGION_SIZE = 16*TILE_WIDTH
+
+# The flow field that chasing NPCs follow covers FLOW_FIELD_RADIUS collision cells
+# either side of the player. Within FLOW_FIELD_NEAR_STEPS cells of the player they
+# walk straight at their target instead
+FLOW_FIELD_RADIUS = 32
+FLOW_FIELD_NEAR_STEPS = 4
+FLOW_FIELD_DIRECTIONS = [(0, -1), (-1, 0), (0, 1), (1, 0)]
+
+# Paths for walking NPCs are found with A* and jump point search over the collision layer.
+# The last PATH_CACHE_SIZE paths are kept and thrown away when something in their part of
+# the map (a PATH_REGION_SIZE pixel region) changes. A search only looks at cells within
+# PATH_SEARCH_MARGIN of the start and goal and gives up after PATH_MAX_EXPANSIONS jump points.
+# Paths keep PATH_FOOT_BOX clear of walls and items. Every NPC must have it as its foot box
+PATH_CACHE_SIZE = 64
+PATH_REGION_SIZE = 256
+PATH_SEARCH_MARGIN = 16
+PATH_MAX_EXPANSIONS = 2000
+PATH_FOOT_BOX = Rect(-15, -10, 33, 15)
+# A cell is only walkable if PATH_CELL_BOX at its middle is clear of solid cells. It is the foot
+# box a pixel bigger all round because NPCs can only line up to within a pixel of the middle
+PATH_CELL_BOX = PATH_FOOT_BOX.inflate(2, 2)
+
+# Collision codes that mark trigger zones. When the map is loaded the cells with each code
+# are joined into rectangles which are kept in a grid of TRIGGER_GRID_CELL_SIZE pixel cells.
+# The player can walk into a zone if it is "walkable", otherwise entering it runs the action
+#   "x", "y"     where the player is moved to         "camera"    tile the camera moves to
+#   "needs"      item the player must be carrying    "refused"   message shown without it
+#   "push"       how far the player is pushed back if they don't have the item
+#   "message"    message shown                       "game_over" ticks until the game ends
+#   "water"      a bucket can be filled here         "exit"      action run when leaving the zone
+TRIGGER_GRID_CELL_SIZE = 256
+TRIGGER_ACTIONS = {
+    2: {"name": "Into house", "x": 5232, "y": 470, "camera": (98, 0)},
+    3: {"name": "Out of house", "x": 22*TILE_WIDTH+TILE_WIDTH//2, "y": 56*TILE_HEIGHT+TILE_HEIGHT//2, "camera": (12, 49)},
+    4: {"name": "Water", "walkable": True, "water": True},
+    5: {"name": "Into maze", "x": 110*TILE_WIDTH+TILE_WIDTH//2, "y": 104*TILE_HEIGHT+TILE_HEIGHT//2, "camera": (104, 97)},
+    6: {"name": "Forest entrance", "x": 36*TILE_WIDTH+TILE_WIDTH//2, "y": 31*TILE_HEIGHT+TILE_HEIGHT//2, "camera": (30, 25)},
+    7: {"name": "Into cave", "x": 34*TILE_WIDTH+TILE_WIDTH//2, "y": 137*TILE_HEIGHT, "camera": (25, 132),
+        "needs": "Sword", "refused": "It is too dangerous to go in there unarmed.", "push": (0, 48)},
+    8: {"name": "Purple 3", "x": 15*TILE_WIDTH, "y": 86*TILE_HEIGHT+TILE_HEIGHT//2, "camera": (7, 81)},
+    9: {"name": "Ship", "x": 9*TILE_WIDTH+24, "y": 155*TILE_HEIGHT+TILE_HEIGHT//2, "camera": (0, 150),
+        "message": "You escaped the island!", "game_over": 90},
+}
+
+# Extra space around the camera view that objects are still drawn in
+CULL_MARGIN = 16
+
+# Keys that are checked every tick while they are held down
+MOVEMENT_KEYS = [K_w, K_s, K_a, K_d]
+
+# Set RECORD_FILE to a file name to record the input of every new game so it can be
+# replayed exactly with: python game.py --replay <file>
+RECORD_FILE = ""
+RECORD_MAGIC = b"HARC"
+# Recordings from an older version won't replay the same if the simulation or the file layout changed
+RECORD_VERSION = 10
+
+# Phases of a frame timed by the profiler. PROFILE_FRAME is the whole frame
+# including waiting for the next one
+PROFILE_EVENTS = 0
+PROFILE_UPDATE = 1
+PROFILE_GROUND = 2
+PROFILE_SCENE = 3
+PROFILE_TOP = 4
+PROFILE_GUI = 5
+PROFILE_PRESENT = 6
+PROFILE_FRAME = 7
+PROFILE_NAMES = ["events", "update", "ground", "scene", "top", "gui", "present", "frame"]
+
+# Phases of a game tick timed by the tick profiler
+TICK_INPUT = 0
+TICK_PLAYER = 1
+TICK_PEOPLE = 2
+TICK_MONSTERS = 3
+TICK_OTHER = 4
+TICK_TOTAL = 5
+TICK_PROFILE_NAMES = ["input", "player", "people", "monsters", "other", "tick"]
+
+# Things counted each frame by the profiler
+PROFILE_COUNT_DRAWN = 0
+PROFILE_COUNT_CULLED = 1
+PROFILE_COUNT_AWAKE = 2
+PROFILE_COUNT_ASLEEP = 3
+PROFILE_COUNTER_NAMES = ["drawn", "culled", "awake", "asleep"]
+
+# Set to True to start with the profiler on. F3 turns it on and off while playing.
+# The last PROFILE_SAMPLES frames are kept and written to PROFILE_FILE when the game closes
+PROFILE_ENABLED = False
+PROFILE_SAMPLES = 600
+PROFILE_FILE = "profile.csv"
+PROFILE_OVERLAY_REFRESH = 15    # frames between updates of the numbers on screen
+
+# Benchmarks run with: python game.py --benchmark [results.json] [baseline.json]
+# Each size adds that many items, people and monsters to the area around the
+# player's start and runs the game for BENCHMARK_TICKS ticks with scripted input
+BENCHMARK_SIZES = [0, 10, 100, 1000]
+BENCHMARK_TICKS = 300
+BENCHMARK_SEED = 1
+BENCHMARK_AREA = Rect(33, 72, 48, 32)     # in tiles
+BENCHMARK_LEG_TICKS = 40                  # ticks walked in each direction
+BENCHMARK_ATTACK_TICKS = 15               # ticks between sword swings
+BENCHMARK_FILE = "benchmark.json"
 
-# Variables used to keep track of scrolling through the map as the player moves
-scroll_x_offset = 50
-scroll_y_offset = 83
-scroll_x_counter = 0
-scroll_y_counter = 0
+#########################################################################################
+# TextCache class. Keeps the images of recently drawn text so the same text isn't
+#                  rendered again every frame. Uses an ordered dictionary as a least
+#                  recently used (LRU) cache
+#########################################################################################
+
+class TextCache():
+    def __init__(self, max_entries):
+        self.__max_entries = max_entries
+        self.__text_images = OrderedDict()     #(font, text, colour, antialias) -> rendered text
+        self.__hits = 0
+        self.__misses = 0
+
+    def get_hits(self):
+        return self.__hits
+
+    def get_misses(self):
+        return self.__misses
+
+    def get_size(self):
+        return len(self.__text_images)
+
+    def clear(self):
+        self.__text_images.clear()
+
+    # Returns the rendered text. The returned image is shared so it must not be changed.
+    def render(self, font, text, colour, antialias=True):
+        key = (font, text, tuple(colour), antialias)
+        textimg = self.__text_images.get(key)
+        if textimg is not None:
+            self.__hits += 1
+            self.__text_images.move_to_end(key)
+            return textimg
+
+        self.__misses += 1
+        textimg = font.render(text, antialias, colour)
+        self.__text_images[key] = textimg
+        if len(self.__text_images) > self.__max_entries:
+            self.__text_images.popitem(last=False)
+        return textimg
 
 #########################################################################################
 # Display class. Used for displaying images and text on the screen
@@ -114,53 +362,118 @@ class Display():
 
         # Now create the actual game window which will be centred correctly.
         self.__screen = pygame.display.set_mode((width, height))
+        self.__screen_rect = self.__screen.get_rect()
 
         self.__fps = fps
-        self.__last_time = time.time()
+        self.__next_frame_time = time.perf_counter()
         self.__title = title
         if title != "":
             pygame.display.set_caption (title)
         pygame.font.init()
         self.__font =pygame.font.Font(None,30)
         self.__big_font =pygame.font.SysFont("Arial",50)
+        self.__text_cache = TextCache(TEXT_CACHE_SIZE)
+
+        # Keep track of the parts of the screen that have changed so only those are
+        # sent to the window. The previous frame's rectangles are sent again so
+        # anything drawn last frame but not this frame gets removed.
+        self.__dirty_rects = []
+        self.__last_dirty_rects = []
+        self.__full_update = True
+        self.__scroll = None
+        self.__last_scroll = None
+
+        # Stats for the last frame presented
+        self.__present_time = 0
+        self.__present_rects = 0
+        self.__present_full = False
+
+    # Any drawing that returns a rectangle is recorded as changed
+    def mark_dirty(self, rect):
+        if not self.__full_update:
+            self.__dirty_rects.append(rect)
+        return rect
+
+    # Forces the whole window to be sent on the next update
+    def mark_all_dirty(self):
+        self.__full_update = True
+
+    # Tells the display where the camera is. If it has moved since the last frame
+    # the whole window is sent because every pixel of the map has changed
+    def set_scroll(self, x, y):
+        self.__scroll = (x, y)
+
+    def set_fps(self, fps):
+        self.__fps = fps
+        self.__next_frame_time = time.perf_counter()
+
+    def get_present_time(self):
+        return self.__present_time
+
+    def get_present_rects(self):
+        return self.__present_rects
+
+    def get_present_full(self):
+        return self.__present_full
 
     def clear(self, colour=(0,0,0)):
         self.__screen.fill(colour)
-
-    def blit(self, source, dest, area=None, special_flags=0):
-        self.__screen.blit (source, dest, area, special_flags)
+        self.mark_all_dirty()
+
+    # Background blits (e.g. the map) can set track to False. They only need
+    # sending when the camera moves, which set_scroll takes care of
+    def blit(self, source, dest, area=None, special_flags=0, track=True):
+        rect = self.__screen.blit (source, dest, area, special_flags)
+        if track:
+            self.mark_dirty(rect)
+        return rect
+
+    # Blits a list of (source, dest) pairs in one call
+    def blits(self, blit_list, track=True):
+        rects = self.__screen.blits(blit_list)
+        if track:
+            for rect in rects:
+                self.mark_dirty(rect)
+        return rects
+
+    def get_text_cache(self):
+        return self.__text_cache
+
+    # Blits rendered text. The cached image is shared so if the text is see-through
+    # the alpha is set on a copy instead.
+    def blit_text(self, textimg, position, alpha):
+        if alpha < 255:
+            textimg = textimg.copy()
+            textimg.set_alpha(max(alpha, 0))
+        return self.mark_dirty(self.__screen.blit (textimg, position))
 
     def draw_text (self, text, position, colour=(255,255,255), alpha=255):
-        textimg=self.__font.render(text, True, colour)
-        textimg.set_alpha(alpha)
-        self.__screen.blit (textimg, position)
+        textimg=self.__text_cache.render(self.__font, text, colour)
+        return self.blit_text(textimg, position, alpha)
 
     def draw_text_centred (self, text, position_y, colour=(255,255,255), alpha=255):
-        textimg=self.__font.render(text, True, colour)
+        textimg=self.__text_cache.render(self.__font, text, colour)
         position_x = (WINDOW_WIDTH - textimg.get_width())//2
-        textimg.set_alpha(alpha)
-        self.__screen.blit (textimg, (position_x, position_y))
+        return self.blit_text(textimg, (position_x, position_y), alpha)
 
     def draw_big_text (self, text, position, colour=(255,255,255), alpha=255):
-        textimg=self.__big_font.render(text, True, colour)
-        textimg.set_alpha(alpha)
-        self.__screen.blit (textimg, position)
+        textimg=self.__text_cache.render(self.__big_font, text, colour)
+        return self.blit_text(textimg, position, alpha)
 
     def draw_big_text_centred (self, text, position_x, position_y, width, height, colour=(255,255,255), alpha=255):
-        textimg=self.__big_font.render(text, True, colour)
+        textimg=self.__text_cache.render(self.__big_font, text, colour)
         position_x += (width - textimg.get_width())//2
         position_y += (height - textimg.get_height())//2
-        textimg.set_alpha(alpha)
-        self.__screen.blit (textimg, (position_x, position_y))
+        return self.blit_text(textimg, (position_x, position_y), alpha)
 
     def draw_line (self, start_pos, end_pos, colour, width=1):
-        pygame.draw.line (self.__screen, colour, start_pos, end_pos, width)
+        return self.mark_dirty(pygame.draw.line (self.__screen, colour, start_pos, end_pos, width))
 
     def draw_filled_rect (self, rect, colour):
-        pygame.draw.rect (self.__screen, colour, rect)
+        return self.mark_dirty(pygame.draw.rect (self.__screen, colour, rect))
 
     def draw_rect (self, rect, colour, line_width=1):
-        pygame.draw.rect (self.__screen, colour, rect, line_width)
+        return self.mark_dirty(pygame.draw.rect (self.__screen, colour, rect, line_width))
 
     def set_clip (self, rect):
         self.__screen.set_clip (rect)
@@ -168,20 +481,203 @@ class Display():
     def get_clip (self):
         return self.__screen.get_clip()
 
-    def update(self):
-        pygame.display.update()
+    # Joins together any rectangles that overlap so no part of the screen is sent twice
+    def merge_rects(self, rects):
+        merged = []
+        for rect in rects:
+            rect = self.__screen_rect.clip(rect)
+            if rect.w == 0 or rect.h == 0:
+                continue
+            index = rect.collidelist(merged)
+            while index != -1:
+                rect.union_ip(merged.pop(index))
+                index = rect.collidelist(merged)
+            merged.append(rect)
+        return merged
 
-        # Limit the game speed to our desired FPS
-        current_time = time.time()
-        delta = current_time - self.__last_time
-        self.__last_time = current_time
-        delay = max(1.0/self.__fps - delta, 0)
-        time.sleep(delay)
+    def update(self):
+        start_time = time.perf_counter()
+        if self.__scroll is not None and self.__scroll != self.__last_scroll:
+            self.__full_update = True
+        self.__last_scroll = self.__scroll
+        self.__scroll = None
+
+        if self.__full_update:
+            pygame.display.update()
+            self.__present_rects = 1
+            self.__present_full = True
+            self.__last_dirty_rects = [self.__screen_rect]
+        else:
+            rects = self.merge_rects(self.__dirty_rects + self.__last_dirty_rects)
+            if len(rects) != 0:
+                pygame.display.update(rects)
+            self.__present_rects = len(rects)
+            self.__present_full = False
+            self.__last_dirty_rects = self.__dirty_rects
+        self.__dirty_rects = []
+        self.__full_update = False
+        self.__present_time = time.perf_counter() - start_time
+
+        # Limit the frame rate by waiting until the time the next frame is due.
+        # If we are running late, start timing again from now rather than rushing.
+        # An FPS of 0 means no limit.
+        if self.__fps == 0:
+            return
+        self.__next_frame_time += 1.0/self.__fps
+        delay = self.__next_frame_time - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            self.__next_frame_time = time.perf_counter()
 
         # Update the window caption to include actual FPS
         #fps = 1.0/(delay + delta)
         #pygame.display.set_caption("{0}: {1:.2f}".format(self.__title, fps))
 
+#########################################################################################
+# Profiler class. Times each phase of every frame and keeps the last few hundred
+#                 frames in a ring buffer. The last phase is always the whole frame.
+#                 When it is turned off every call returns straight away so it can
+#                 be left in the main loop.
+#########################################################################################
+
+class Profiler():
+    def __init__(self, names, samples, enabled=False, counter_names=None):
+        if counter_names is None:
+            counter_names = []
+        self.__names = names
+        self.__counter_names = counter_names
+        self.__enabled = enabled
+        self.__size = samples
+        self.__samples = np.zeros((len(self.__names), samples))
+        self.__current = [0.0] * len(self.__names)
+        self.__counter_samples = np.zeros((len(self.__counter_names), samples))
+        self.__counts = [0] * len(self.__counter_names)
+        self.__index = 0
+        self.__count = 0
+        self.__frames = 0
+        self.__frame_start = time.perf_counter()
+        self.__lap_time = self.__frame_start
+        self.__overlay_lines = []
+
+    def is_enabled(self):
+        return self.__enabled
+
+    def set_enabled(self, enabled):
+        self.__enabled = enabled
+        self.__current = [0.0] * len(self.__names)
+        self.__counts = [0] * len(self.__counter_names)
+        self.__frame_start = time.perf_counter()
+        self.__lap_time = self.__frame_start
+        self.__overlay_lines = []
+
+    def toggle(self):
+        self.set_enabled(not self.__enabled)
+
+    def begin_frame(self):
+        if not self.__enabled:
+            return
+        self.__frame_start = time.perf_counter()
+        self.__lap_time = self.__frame_start
+
+    # Adds the time since the last lap to a phase
+    def lap(self, phase):
+        if not self.__enabled:
+            return
+        now = time.perf_counter()
+        self.__current[phase] += now - self.__lap_time
+        self.__lap_time = now
+
+    # Adds a time measured somewhere else (e.g. by the display) to a phase
+    def record(self, phase, seconds):
+        if not self.__enabled:
+            return
+        self.__current[phase] += seconds
+
+    # Adds to one of the things counted this frame
+    def count(self, counter, amount):
+        if not self.__enabled:
+            return
+        self.__counts[counter] += amount
+
+    # Stores this frame's times in the ring buffer, overwriting the oldest frame
+    def end_frame(self):
+        if not self.__enabled:
+            return
+        self.__current[-1] = time.perf_counter() - self.__frame_start
+        self.__samples[:, self.__index] = self.__current
+        self.__counter_samples[:, self.__index] = self.__counts
+        self.__counts = [0] * len(self.__counter_names)
+        self.__index = (self.__index + 1) % self.__size
+        self.__count = min(self.__count + 1, self.__size)
+        self.__current = [0.0] * len(self.__names)
+        self.__frames += 1
+        if self.__frames % PROFILE_OVERLAY_REFRESH == 0:
+            self.__overlay_lines = []
+
+    def get_sample_count(self):
+        return self.__count
+
+    # Returns the stored frames oldest first, one row per phase
+    def get_samples(self):
+        return self.in_order(self.__samples)
+
+    def get_counter_samples(self):
+        return self.in_order(self.__counter_samples)
+
+    def in_order(self, samples):
+        if self.__count < self.__size:
+            return samples[:, :self.__count]
+        return np.roll(samples, -self.__index, axis=1)
+
+    # Returns the mean of each counter per frame
+    def get_counter_means(self):
+        if self.__count == 0:
+            return np.zeros(len(self.__counter_names))
+        return self.get_counter_samples().mean(axis=1)
+
+    # Returns the mean of each phase in milliseconds
+    def get_means(self):
+        if self.__count == 0:
+            return np.zeros(len(self.__names))
+        return self.get_samples().mean(axis=1) * 1000
+
+    # Returns the given percentile of each phase in milliseconds
+    def get_percentiles(self, percent):
+        if self.__count == 0:
+            return np.zeros(len(self.__names))
+        return np.percentile(self.get_samples(), percent, axis=1) * 1000
+
+    def draw(self):
+        if not self.__enabled:
+            return
+        # The numbers are only worked out every few frames so they can be read
+        if len(self.__overlay_lines) == 0:
+            p50 = self.get_percentiles(50)
+            p95 = self.get_percentiles(95)
+            p99 = self.get_percentiles(99)
+            self.__overlay_lines.append("ms     p50   p95   p99")
+            for phase in range(len(self.__names)):
+                self.__overlay_lines.append("{0:8} {1:5.1f} {2:5.1f} {3:5.1f}".format(self.__names[phase], p50[phase], p95[phase], p99[phase]))
+            counts = self.get_counter_means()
+            for counter in range(len(self.__counter_names)):
+                self.__overlay_lines.append("{0:8} {1:5.0f}".format(self.__counter_names[counter], counts[counter]))
+        screen.draw_filled_rect(Rect(WINDOW_WIDTH-280, 50, 270, len(self.__overlay_lines)*22 + 10), (0, 0, 0))
+        for i in range(len(self.__overlay_lines)):
+            screen.draw_text(self.__overlay_lines[i], (WINDOW_WIDTH-270, 55 + i*22))
+
+    # Writes the stored frames to a CSV file, one row per frame in milliseconds
+    def export_csv(self, filename):
+        if self.__count == 0:
+            return
+        csv_file = open(filename, "w", newline="")
+        csv_writer = csv.writer(csv_file)
+        csv_writer.writerow(self.__names + self.__counter_names)
+        counter_samples = self.get_counter_samples().T
+        for i, row in enumerate(self.get_samples().T):
+            csv_writer.writerow(["{0:.3f}".format(seconds*1000) for seconds in row] + [int(count) for count in counter_samples[i]])
+        csv_file.close()
+
 #########################################################################################
 # SaveGameManager class. Used for saving and loading the player's progress
 #########################################################################################
@@ -193,6 +689,8 @@ class SaveGameManager():
         self.__csv_writer = None
         self.__csv_reader = None
         self.__loaded_slot = 0
+        self.__game_loaded = False
+        self.__can_save = False     # only games being played save, not replays or headless worlds
         self.__slot_meta = ["", "", "", ""]
         self.__slot_meta[1] = ["File 1", "", 0, 0]
         self.__slot_meta[2] = ["File 2", "", 0, 0]
@@ -202,6 +700,20 @@ class SaveGameManager():
     def get_slot_meta(self):
         return self.__slot_meta
 
+    # True if a saved game was loaded rather than starting a new one
+    def is_game_loaded(self):
+        return self.__game_loaded
+
+    def get_loaded_slot(self):
+        return self.__loaded_slot
+
+    # Used by replays to use the slot the recorded game was started in without loading it
+    def set_loaded_slot(self, slot):
+        self.__loaded_slot = slot
+
+    def set_can_save(self, can_save):
+        self.__can_save = can_save
+
     def save_slot_meta(self):
         csv_file = open("slot_meta.txt", "w", newline="")
         csv_writer = csv.writer(csv_file)
@@ -240,16 +752,33 @@ class SaveGameManager():
         self.__slot_meta[self.__loaded_slot][1] = now.strftime("%d-%b-%Y %I:%M%p")  #format date and time e.g. 01-Apr-2024 22:54PM
         self.save_slot_meta()
 
+    # Does nothing unless the game is being played and a slot has been chosen
     def save_game(self):
-        global kid_mission, scroll_x_offset, scroll_y_offset
+        global kid_mission
+        if not self.__can_save or self.__loaded_slot == 0:
+            return
         self.save_open(self.__loaded_slot)
-        self.save_write_list([kid_mission, scroll_x_offset, scroll_y_offset])
+        self.save_write_list([kid_mission, camera.get_tile_x(), camera.get_tile_y()])
         player.save()
         items.save()
         people_npcs.save()
         monster_npcs.save()
         self.save_close()
 
+    # Works out a checksum of everything that would be saved plus the state of the
+    # random numbers, by saving into memory instead of a file
+    def get_state_checksum(self):
+        state_file = io.StringIO()
+        self.__csv_writer = csv.writer(state_file)
+        self.save_write_list([kid_mission, camera.get_tile_x(), camera.get_tile_y(), game_over_countdown, frame_count])
+        self.save_write_list([zlib.crc32(repr(rng.getstate()).encode())])
+        player.save()
+        items.save()
+        people_npcs.save()
+        monster_npcs.save()
+        self.__csv_writer = None
+        return zlib.crc32(state_file.getvalue().encode())
+
     def load_open(self, slot):
         self.__filename = "slot"+str(slot)+".txt"
         try:
@@ -267,13 +796,13 @@ class SaveGameManager():
         self.__csv_file.close()
 
     def load_game(self, slot):
-        global kid_mission, scroll_x_offset, scroll_y_offset
+        global kid_mission
         self.__loaded_slot = slot
         if self.load_open(slot):
+            self.__game_loaded = True
             data = game_slot.load_read_list()
             kid_mission = int(data[0])
-            scroll_x_offset = int(data[1])
-            scroll_y_offset = int(data[2])
+            camera.set_tile_position(int(data[1]), int(data[2]))
             player.load()
             items.load()
             people_npcs.load()
@@ -308,16 +837,22 @@ class GUIManager():
                 wraplist = textwrap.wrap(text, 70)
                 self.__speech += wraplist
 
-    def draw(self):
-        self.draw_health(10, 10, 304, 26, player.get_max_health(), player.get_current_health())
+    # Counts down the message and speech timers once per tick
+    def update(self):
         if self.__message_timer != 0:
             if self.__message_timer <= self.__fade_length:
                 self.__alpha -= (255//self.__fade_length)
-            screen.draw_text_centred(self.__message, 250, (255, 255, 255), self.__alpha)
             self.__message_timer -= 1
 
         if self.__speech_timer != 0:
             self.__speech_timer -= 1
+
+    def draw(self):
+        self.draw_health(10, 10, 304, 26, player.get_max_health(), player.get_current_health())
+        if self.__message_timer != 0:
+            screen.draw_text_centred(self.__message, 250, (255, 255, 255), self.__alpha)
+
+        if self.__speech_timer != 0:
             screen.draw_filled_rect((SPEECH_RECT_X, SPEECH_RECT_Y, SPEECH_RECT_W, SPEECH_RECT_H), (100, 100, 100))
             y = SPEECH_RECT_Y +10
             for speechline in self.__speech:
@@ -338,87 +873,376 @@ class GUIManager():
 #########################################################################################
 
 class SpriteSheet():
-    def __init__(self, image_file, tile_width, tile_height, tiles_across, tiles_down):
+    def __init__(self, image_file, tile_width, tile_height, tiles_across, tiles_down, image=None):
         self.__image_file = image_file
         self.__tile_width = tile_width
         self.__tile_height = tile_height
         self.__tiles_across = tiles_across
         self.__tiles_down = tiles_down
-        self.__spritesheet_image = pygame.image.load("images/"+image_file)
+
+        # The image can be passed in by the AssetRegistry so it is only loaded once
+        if image is None:
+            image = pygame.image.load("images/"+image_file)
+            # Convert the image to the same pixel format as the screen so blits don't
+            # have to convert every pixel. This can only be done once a window exists.
+            if pygame.display.get_surface() is not None:
+                image = image.convert_alpha()
+        self.__spritesheet_image = image
+
+        # Cut the sheet up into a list of frames once so drawing is a list lookup.
+        # Rows are counted from the image height as some sheets have an extra row.
+        self.__frames = []
+        rows = self.__spritesheet_image.get_height() // tile_height
+        for row in range(rows):
+            for col in range(tiles_across):
+                self.__frames.append(self.__spritesheet_image.subsurface(Rect(col*tile_width, row*tile_height, tile_width, tile_height)))
+
+    def get_frame(self, tile_num):
+        return self.__frames[tile_num]
 
     def draw(self, screen_x, screen_y, tile_num):
-        row = tile_num // self.__tiles_across
-        col = tile_num % self.__tiles_down
-        px = col * self.__tile_width
-        py = row * self.__tile_height
-        screen.blit(self.__spritesheet_image, (screen_x, screen_y), Rect(px, py, self.__tile_width, self.__tile_height))
+        screen.blit(self.__frames[tile_num], (screen_x, screen_y))
+
+    # Draws a sprite onto another surface instead of the screen (used to pre-render map chunks)
+    def draw_on(self, surface, x, y, tile_num):
+        surface.blit(self.__frames[tile_num], (x, y))
+
+    # Draws a list of (screen_x, screen_y, tile_num) sprites in one call
+    def draw_many(self, sprites):
+        screen.blits([(self.__frames[tile_num], (x, y)) for x, y, tile_num in sprites])
+
+    def draw_many_on(self, surface, sprites):
+        surface.blits([(self.__frames[tile_num], (x, y)) for x, y, tile_num in sprites], doreturn=False)
+
+#########################################################################################
+# AssetRegistry class. Loads each image once and shares it between every sprite sheet
+#                      that uses it. Counts how many times each sprite sheet has been
+#                      asked for this game. Sheets the game didn't ask for at all can then
+#                      be thrown away when a new game starts. Objects never hand sheets
+#                      back, so this is not a count of the objects using a sheet now.
+#########################################################################################
+
+class AssetRegistry():
+    def __init__(self):
+        self.__images = {}          # file -> converted image
+        self.__decoded = {}         # file -> image loaded by the background thread, not yet converted
+        self.__sheets = {}          # (file, tile width, tile height, across, down) -> SpriteSheet
+        self.__uses = {}            # key -> number of times the sprite sheet was asked for this game
+        self.__stats = {}           # file -> [seconds spent loading, bytes]
+        self.__pending = []
+        self.__lock = threading.Lock()
+        self.__preload_thread = None
+
+    # Starts loading a list of images in a background thread. The images are only
+    # decoded there, converting them to the screen format happens in get_image.
+    def preload(self, manifest):
+        self.__pending = [image_file for image_file in manifest if image_file not in self.__images]
+        if len(self.__pending) == 0:
+            return
+        self.__preload_thread = threading.Thread(target=self.preload_images, args=(list(self.__pending),), daemon=True)
+        self.__preload_thread.start()
+
+    def preload_images(self, manifest):
+        for image_file in manifest:
+            start_time = time.perf_counter()
+            try:
+                image = pygame.image.load("images/"+image_file)
+            except (pygame.error, OSError):
+                continue
+            with self.__lock:
+                self.__decoded[image_file] = image
+                self.__stats[image_file] = [time.perf_counter() - start_time, 0]
+
+    def get_image(self, image_file):
+        image = self.__images.get(image_file)
+        if image is not None:
+            return image
+
+        # Wait for the background thread if it is going to load this image
+        if image_file in self.__pending and self.__preload_thread is not None:
+            self.__preload_thread.join()
+            self.__pending = []
+
+        start_time = time.perf_counter()
+        with self.__lock:
+            image = self.__decoded.pop(image_file, None)
+            load_time = self.__stats.get(image_file, [0, 0])[0]
+        if image is None:
+            image = pygame.image.load("images/"+image_file)
+        if pygame.display.get_surface() is not None:
+            image = image.convert_alpha()
+        self.__images[image_file] = image
+        self.__stats[image_file] = [load_time + time.perf_counter() - start_time,
+                                    image.get_width()*image.get_height()*image.get_bytesize()]
+        return image
+
+    # Returns a shared SpriteSheet, creating it the first time it is asked for
+    def get_sprite_sheet(self, image_file, tile_width, tile_height, tiles_across, tiles_down):
+        key = (image_file, tile_width, tile_height, tiles_across, tiles_down)
+        sheet = self.__sheets.get(key)
+        if sheet is None:
+            sheet = SpriteSheet(image_file, tile_width, tile_height, tiles_across, tiles_down, self.get_image(image_file))
+            self.__sheets[key] = sheet
+            self.__uses[key] = 0
+        self.__uses[key] += 1
+        return sheet
+
+    # Called when all the game objects are thrown away (e.g. restarting after Game Over)
+    # The sheets and images are kept so the new game doesn't have to load them again,
+    # then unload_unused throws away the ones the new game didn't ask for
+    def start_new_game(self):
+        for key in self.__uses.keys():
+            self.__uses[key] = 0
+
+    def get_use_count(self, image_file):
+        total = 0
+        for key in self.__uses.keys():
+            if key[0] == image_file:
+                total += self.__uses[key]
+        return total
+
+    # Throws away the sprite sheets not asked for since start_new_game and their images
+    def unload_unused(self):
+        for key in list(self.__sheets.keys()):
+            if self.__uses[key] == 0:
+                del self.__sheets[key]
+                del self.__uses[key]
+        used_files = set()
+        for key in self.__sheets.keys():
+            used_files.add(key[0])
+        for image_file in list(self.__images.keys()):
+            if image_file not in used_files:
+                del self.__images[image_file]
+                del self.__stats[image_file]
+
+    # One line per loaded image showing how long it took to load and its size
+    def report(self):
+        lines = []
+        total_bytes = 0
+        for image_file in sorted(self.__images.keys()):
+            load_time, size = self.__stats[image_file]
+            total_bytes += size
+            lines.append("{0:<16} {1:7.2f} ms {2:8.1f} KB  asked for {3}".format(image_file, load_time*1000, size/1024, self.get_use_count(image_file)))
+        lines.append("{0:<16} {1:>10} {2:8.1f} KB".format("Total", "", total_bytes/1024))
+        return lines
 
 #########################################################################################
 # Scene class. Used to ensure moving objects (player, items, NPCs) are drawn in the
 #              correct order so they appear in front of or behind each other
-#              Uses a binary tree to keep objects in the correct Y order
+#              Keeps a draw list sorted by layer and Y position from frame to frame
 #########################################################################################
 
 class Scene():
     def __init__(self):
-        #The scene is stored in a binary tree which uses 4 empty lists
-        self.__object_to_draw = []  #Object to be drawn
-        self.__object_y = []        #The object's Y position
-        self.__object_left = []     #Index oof the left-hand node
-        self.__object_right = []    #Index of the right-hand node
-
-    # Function to add an object to the scene tree
-    # Takes the object to be drawn and its Y position on the map
-    def add_to_scene(self, leaf_object, leaf_y):
-        # ****
-        self.__object_to_draw.append(leaf_object)
-        self.__object_y.append(leaf_y)
-        self.__object_left.append(-1)
-        self.__object_right.append(-1)
-        new_index = len(self.__object_to_draw)-1
-        #If the object is not the first to be added to the tree
-        #then add the object to the correct position
-        if new_index != 0:
-            self.tree(leaf_object, leaf_y, new_index, 0)
-
-    # Recursive function to create the scene tree based on the y-coordinates  of objects
-    def tree(self, leaf_object, leaf_y, new_index, node_index):
-        if leaf_y <= self.__object_y[node_index]:
-            if self.__object_left[node_index] == -1:
-                self.__object_left[node_index] = new_index
-            else:
-                node_index = self.__object_left[node_index]
-                self.tree(leaf_object, leaf_y, new_index, node_index)
+        # The draw list is kept from frame to frame. Each entry is [sort key, object, frame]
+        # where the sort key is (layer, Y position, order submitted this frame).
+        # Objects hardly move between frames so the list is nearly sorted already.
+        self.__draw_list = []
+        self.__entries = {}     # entry for each object, looked up by the object's id
+        self.__frame = 0
+        self.__submitted = 0
+
+    def get_size(self):
+        return len(self.__draw_list)
+
+    # Function to add an object to the scene for this frame
+    # Takes the object to be drawn, its Y position on the map and the layer to draw it on.
+    # Lower layers are drawn first. Objects with the same layer and Y position are drawn
+    # in the order they were added.
+    def add_to_scene(self, leaf_object, leaf_y, layer=SCENE_LAYER_OBJECTS):
+        key = (layer, leaf_y, self.__submitted)
+        entry = self.__entries.get(id(leaf_object))
+        if entry is None:
+            entry = [key, leaf_object, self.__frame]
+            self.__entries[id(leaf_object)] = entry
+            self.__draw_list.append(entry)
         else:
-            if self.__object_right[node_index] == -1:
-                self.__object_right[node_index] = new_index
+            entry[0] = key
+            entry[2] = self.__frame
+        self.__submitted += 1
+
+    # Insertion sort. Only objects that have moved past another object are moved
+    # so it is quick when the list is nearly sorted. If too much has changed (e.g.
+    # after a teleport) Python's sort is used instead.
+    def sort(self):
+        draw_list = self.__draw_list
+        moves_left = len(draw_list) * SCENE_MAX_SORT_MOVES
+        for i in range(1, len(draw_list)):
+            entry = draw_list[i]
+            key = entry[0]
+            j = i - 1
+            while j >= 0 and draw_list[j][0] > key:
+                draw_list[j+1] = draw_list[j]
+                j -= 1
+            draw_list[j+1] = entry
+            moves_left -= i - 1 - j
+            if moves_left < 0:
+                draw_list.sort(key=lambda entry: entry[0])
+                return
+
+    # Draws the objects from lowest layer and y-coordinate to highest (top of the screen down)
+    def draw(self):
+        # Remove any objects that weren't added this frame
+        if len(self.__draw_list) != self.__submitted:
+            self.__draw_list = [entry for entry in self.__draw_list if entry[2] == self.__frame]
+            self.__entries = {}
+            for entry in self.__draw_list:
+                self.__entries[id(entry[1])] = entry
+        self.sort()
+        for entry in self.__draw_list:
+            entry[1].draw()
+        self.__frame += 1
+        self.__submitted = 0
+
+#########################################################################################
+# SpatialHash class. Splits the map into square cells and keeps a list of the objects
+#                    whose box touches each cell, so objects near a box can be found
+#                    without checking every object. Objects are stored by a key (e.g. name)
+#########################################################################################
+
+class SpatialHash():
+    def __init__(self, cell_size):
+        self.__cell_size = cell_size
+        self.__cells = {}           # (cell x, cell y) -> keys of the objects in that cell
+        self.__rects = {}           # key -> the object's box
+        self.__key_bounds = {}      # key -> (left, top, right, bottom) cells the object is in
+
+    def get_cell_size(self):
+        return self.__cell_size
+
+    def get_count(self):
+        return len(self.__rects)
+
+    def get_rect(self, key):
+        return self.__rects.get(key)
+
+    # Returns the first and last cells a rectangle covers as (left, top, right, bottom)
+    def bounds_for(self, rect):
+        size = self.__cell_size
+        return (rect.left // size, rect.top // size, (rect.right - 1) // size, (rect.bottom - 1) // size)
+
+    # Returns the cells that a rectangle covers
+    def cells_for(self, bounds):
+        left, top, right, bottom = bounds
+        return [(cell_x, cell_y) for cell_y in range(top, bottom+1) for cell_x in range(left, right+1)]
+
+    # Adds an object or moves it if it is already in the grid. The cell lists are
+    # only changed if the object has moved into different cells
+    def insert(self, key, rect):
+        self.__rects[key] = Rect(rect)
+        new_bounds = self.bounds_for(rect)
+        old_bounds = self.__key_bounds.get(key)
+        if old_bounds == new_bounds:
+            return
+        if old_bounds is not None:
+            self.remove_from_cells(key, old_bounds)
+        for cell in self.cells_for(new_bounds):
+            if cell in self.__cells:
+                self.__cells[cell].append(key)
             else:
-                node_index = self.__object_right[node_index]
-                self.tree(leaf_object, leaf_y, new_index, node_index)
-
-    # Draws the objects from the tree using in order tree traversal
-    # this draws objects from lowest y-coordinate to highest (top of the screen down)
-    #****************
-    def draw_tree(self, node_index):
-        if node_index == -1:
+                self.__cells[cell] = [key]
+        self.__key_bounds[key] = new_bounds
+
+    def remove(self, key):
+        old_bounds = self.__key_bounds.pop(key, None)
+        if old_bounds is None:
             return
-        self.draw_tree(self.__object_left[node_index])
-        self.__object_to_draw[node_index].draw()
-        self.draw_tree(self.__object_right[node_index])
+        del self.__rects[key]
+        self.remove_from_cells(key, old_bounds)
+
+    def remove_from_cells(self, key, bounds):
+        for cell in self.cells_for(bounds):
+            keys = self.__cells[cell]
+            keys.remove(key)
+            if len(keys) == 0:
+                del self.__cells[cell]
+
+    # Returns the keys of the objects whose boxes overlap a rectangle.
+    # A dictionary is used so objects in more than one cell are only found once
+    def query_rect(self, rect):
+        found = {}
+        for cell in self.cells_for(self.bounds_for(rect)):
+            for key in self.__cells.get(cell, ()):
+                if key not in found and self.__rects[key].colliderect(rect):
+                    found[key] = True
+        return list(found)
 
-    def draw(self):
-        self.draw_tree(0)
-        self.__object_to_draw = []
-        self.__object_y = []
-        self.__object_left = []
-        self.__object_right = []
+#########################################################################################
+# ItemIndex class. Keeps the items that are on the map in spatial hash grids: one of
+#                  their base boxes for collisions and one of their positions for each
+#                  tag so items of a type near a point can be found quickly
+#########################################################################################
+
+class ItemIndex():
+    def __init__(self, cell_size):
+        self.__box_grid = SpatialHash(cell_size)
+        self.__tag_grids = {}
+        for tag in ITEM_TAGS:
+            self.__tag_grids[tag] = SpatialHash(cell_size)
+        self.__order = {}       # the order items were added, so ties are always broken the same way
+        self.__listeners = []   # told about every box whose blocking has changed
+
+    # The listener's invalidate(box) is called with the old and new base boxes
+    # of any item that moves, appears or disappears
+    def add_listener(self, listener):
+        self.__listeners.append(listener)
+
+    # Called whenever an item moves or changes. Paths found near where the
+    # item's base box was or now is might not be right any more
+    def update(self, item):
+        name = item.get_name()
+        if name not in self.__order:
+            self.__order[name] = len(self.__order)
+        old_box = self.__box_grid.get_rect(name)
+        if item.is_on_map():
+            self.__box_grid.insert(name, item.get_base_box())
+        else:
+            self.__box_grid.remove(name)
+        new_box = self.__box_grid.get_rect(name)
+        if old_box != new_box:
+            for box in (old_box, new_box):
+                if box is not None:
+                    for listener in self.__listeners:
+                        listener.invalidate(box)
+        position = Rect(item.get_x(), item.get_y(), 1, 1)
+        for tag in ITEM_TAGS:
+            if item.is_on_map() and item.has_tag(tag):
+                self.__tag_grids[tag].insert(name, position)
+            else:
+                self.__tag_grids[tag].remove(name)
+
+    # Returns the first item added whose base box overlaps the box, or "" if there isn't one
+    def collide(self, box):
+        hit_names = self.__box_grid.query_rect(box)
+        if len(hit_names) == 0:
+            return ""
+        return min(hit_names, key=self.__order.get)
+
+    # Returns the base boxes of all the items that overlap a rectangle
+    def boxes_in_rect(self, rect):
+        return [self.__box_grid.get_rect(name) for name in self.__box_grid.query_rect(rect)]
+
+    # Returns the names of the items with a tag closer than the radius, nearest first.
+    # Squared distances are compared so no square roots are needed
+    def query_radius(self, tag, x, y, radius):
+        grid = self.__tag_grids[tag]
+        found = []
+        for name in grid.query_rect(Rect(x-radius, y-radius, radius*2+1, radius*2+1)):
+            position = grid.get_rect(name)
+            dx = x - position.x
+            dy = y - position.y
+            distance_squared = dx*dx + dy*dy
+            if distance_squared < radius*radius:
+                found.append((distance_squared, self.__order[name], name))
+        found.sort()
+        return [name for distance_squared, order, name in found]
 
 #########################################################################################
 # Item class. Defines an item that the player can pick up, drop or use
 #########################################################################################
 
 class Item():
-    def __init__(self, item_name, global_x, global_y, base_box, is_getable, item_sheet, sprite_num):
+    def __init__(self, item_name, global_x, global_y, base_box, is_getable, item_sheet, sprite_num, tags=(), item_index=None):
         self.__item_name = item_name
         self.__global_x = global_x
         self.__global_y = global_y
@@ -427,6 +1251,9 @@ class Item():
         self.__item_sheet = item_sheet
         self.__sprite_num = sprite_num
         self.__ani_count = 1
+        self.__tags = set(tags)
+        self.__item_index = item_index
+        self.update_box()
 
     def save(self):
         game_slot.save_write_list([self.__global_x, self.__global_y])
@@ -435,24 +1262,51 @@ class Item():
         data = game_slot.load_read_list()
         self.__global_x = int(data[0])
         self.__global_y = int(data[1])
+        self.update_box()
+
+    # Works out the base box on the map and moves the item in the item index
+    def update_box(self):
+        self.__world_box = self.__base_box.move(self.__global_x, self.__global_y)
+        if self.__item_index is not None:
+            self.__item_index.update(self)
+
+    # Items are moved off the map when they are picked up or used
+    def is_on_map(self):
+        return self.__global_x >= 0 and self.__global_y >= 0
+
+    # Every item has ITEM_TAG_ANY, and ITEM_TAG_GETABLE if it can be picked up
+    def has_tag(self, tag):
+        if tag == ITEM_TAG_ANY:
+            return True
+        if tag == ITEM_TAG_GETABLE:
+            return self.__is_getable
+        return tag in self.__tags
 
     def get_x(self):
         return self.__global_x
 
     def set_x(self, new_x):
         self.__global_x = new_x
+        self.update_box()
 
     def get_y(self):
         return self.__global_y
 
     def set_y(self, new_y):
         self.__global_y = new_y
+        self.update_box()
+
+    def set_position(self, new_x, new_y):
+        self.__global_x = new_x
+        self.__global_y = new_y
+        self.update_box()
 
     def get_is_getable(self):
         return self.__is_getable
 
     def set_is_getable(self, getable_flag):
         self.__is_getable = getable_flag
+        self.update_box()
 
     def get_name(self):
         return self.__item_name
@@ -462,21 +1316,25 @@ class Item():
         dy = y - self.__global_y
         return sqrt(dx*dx + dy*dy)
 
+    # The base box on the map. It is worked out when the item moves so don't change it
     def get_base_box(self):
-        box = self.__base_box.move(self.__global_x, self.__global_y)
-        return box
+        return self.__world_box
 
     def draw(self):
-        global frame_count
-        if frame_count%7 == 0:
-            self.__ani_count = (self.__ani_count + 1)%4
-        screen_x = self.__global_x - (scroll_x_offset*TILE_WIDTH)
-        screen_y = self.__global_y - (scroll_y_offset*TILE_HEIGHT)
+        # The animation frame comes from the tick count so it runs at the same
+        # speed however often the item is drawn
+        self.__ani_count = (frame_count//7 + 2)%4
+        screen_x = camera.world_to_screen_x(self.__global_x)
+        screen_y = camera.world_to_screen_y(self.__global_y)
         self.__item_sheet.draw(screen_x-23, screen_y-47, self.__sprite_num + self.__ani_count+1)
         if DRAW_HIT_BOXES:
             show_base_box = self.__base_box.move(screen_x, screen_y)
             screen.draw_rect(show_base_box, (0,255,255))
 
+    # The area of the map the item's sprite covers
+    def get_draw_rect(self):
+        return Rect(self.__global_x-23, self.__global_y-47, 48, 48)
+
     def draw_icon(self, screen_x, screen_y):
         self.__item_sheet.draw(screen_x, screen_y, self.__sprite_num)
 
@@ -487,12 +1345,17 @@ class Item():
 
 class ItemManager():
     def __init__(self, image_file):
-        self.__itemsheet_image = SpriteSheet(image_file, 48, 48, 10, 10)
+        self.__itemsheet_image = assets.get_sprite_sheet(image_file, 48, 48, 10, 10)
         self.__items = {}
+        self.__item_index = ItemIndex(ITEM_GRID_CELL_SIZE)
         self.__ani_count = 0  ##animation frame counter
         self.__inventory = ["Nothing", "Nothing"]
         self.__selected_slot = 0
 
+    # Things that need to know when an item's base box changes, like the path finder
+    def add_listener(self, listener):
+        self.__item_index.add_listener(listener)
+
     def save(self):
         game_slot.save_write_list(self.__inventory)
         game_slot.save_write_list([self.__selected_slot])
@@ -512,8 +1375,15 @@ class ItemManager():
             item_key = data[0]
             self.__items[item_key].load()
 
-    def add_item(self, item_name, global_x, global_y, base_box, is_getable, sprite_num):
-        self.__items[item_name] = Item(item_name, global_x, global_y, base_box, is_getable, self.__itemsheet_image, sprite_num)
+    # If no tags are given they are worked out from the start of the item's name
+    def add_item(self, item_name, global_x, global_y, base_box, is_getable, sprite_num, tags=None):
+        if tags is None:
+            tags = [ITEM_NAME_TAGS[prefix] for prefix in ITEM_NAME_TAGS if item_name.startswith(prefix)]
+        self.__items[item_name] = Item(item_name, global_x, global_y, base_box, is_getable, self.__itemsheet_image, sprite_num, tags, self.__item_index)
+
+    # Returns the names of the items with a tag within a radius of a point, nearest first
+    def query_radius(self, tag, x, y, radius):
+        return self.__item_index.query_radius(tag, x, y, radius)
 
     def get_world_x(self, item_name):
         try:
@@ -522,8 +1392,7 @@ class ItemManager():
             return -100000
 
     def set_item_position (self, item_name, global_x, global_y):
-        self.__items[item_name].set_x(global_x)
-        self.__items[item_name].set_y(global_y)
+        self.__items[item_name].set_position(global_x, global_y)
 
     def get_selected_slot(self):
         return self.__selected_slot
@@ -554,36 +1423,44 @@ class ItemManager():
         return self.__inventory
 
     def collide_with_base_box(self, main_box):
-        for item in self.__items.values():
-            if item.get_base_box().colliderect(main_box):
-                return item.get_name()
-        return ""
+        return self.__item_index.collide(main_box)
+
+    def base_boxes_in_rect(self, rect):
+        return self.__item_index.boxes_in_rect(rect)
+
+    # Marks the cells of a window of the collision layer where an NPC's foot box would hit
+    # an item's base box. left and top are the collision cell at the window's top left
+    def mark_blocked_cells(self, blocked, left, top, foot_box):
+        size = COLLISION_CELL_SIZE
+        height, width = blocked.shape
+        window_box = Rect(left*size, top*size, width*size, height*size)
+        for box in self.base_boxes_in_rect(window_box.inflate(foot_box.width*2, foot_box.height*2)):
+            # Cells whose centre is close enough for the foot box to touch the item box
+            first_x = max((box.left - foot_box.right - size//2) // size + 1, left) - left
+            last_x = min((box.right - foot_box.left - size//2 - 1) // size, left + width - 1) - left
+            first_y = max((box.top - foot_box.bottom - size//2) // size + 1, top) - top
+            last_y = min((box.bottom - foot_box.top - size//2 - 1) // size, top + height - 1) - top
+            if first_x <= last_x and first_y <= last_y:
+                blocked[first_y:last_y+1, first_x:last_x+1] = True
 
     def pickup(self, player_x, player_y):
-        nearest_item_name = "Nothing"
         got_item = "Nothing"
-        nearest_item_distance = 99999999
-        for item in self.__items.values():  ##for loop to find the item which is closest to the player
-            item_name = item.get_name()
-            item_x = item.get_x()
-            item_y = item.get_y()
-            dx = player_x - item_x
-            dy = player_y - item_y
-            distance = sqrt(dx*dx + dy*dy)  ##Pythagoras theorum to calculate the distance of the current item
-            if distance < nearest_item_distance:  ## works out the closest item to the player
-                nearest_item_distance = distance
-                nearest_item_name = item_name
+        # Finds the closest item to the player. It has to be in reach and be an item
+        # that can be picked up (e.g. not a fire in front of the sword)
+        nearby_items = self.query_radius(ITEM_TAG_ANY, player_x, player_y, 50)
+        if len(nearby_items) == 0:
+            return "Nothing"
+        nearest_item_name = nearby_items[0]
 
         if self.__items[nearest_item_name].get_is_getable() == True:
-            if nearest_item_distance < 50:
-                if self.__inventory[0] == "Nothing":
-                    self.__inventory[0] = nearest_item_name
-                    self.__items[nearest_item_name].set_x(-100000)
-                    got_item = nearest_item_name
-                elif self.__inventory[1] == "Nothing":
-                    self.__inventory[1] = nearest_item_name
-                    self.__items[nearest_item_name].set_x(-100000)
-                    got_item = nearest_item_name
+            if self.__inventory[0] == "Nothing":
+                self.__inventory[0] = nearest_item_name
+                self.__items[nearest_item_name].set_x(-100000)
+                got_item = nearest_item_name
+            elif self.__inventory[1] == "Nothing":
+                self.__inventory[1] = nearest_item_name
+                self.__items[nearest_item_name].set_x(-100000)
+                got_item = nearest_item_name
             return got_item
         else:
             return "Nothing"
@@ -598,9 +1475,8 @@ class ItemManager():
             return
 
         if item_to_use == "Empty_Bucket":
-            cx = player_x // 16
-            cy = player_y // 16
-            if collision_layer[cy][cx] == 4:
+            zone = game_map.get_trigger_zones().find(player_x, player_y)
+            if zone is not None and zone.get_action().get("water", False):
                 self.__inventory[self.__selected_slot-1] = "Filled_Bucket"
                 GUI.display_message("You have filled the bucket!", 90)
             else:
@@ -609,12 +1485,9 @@ class ItemManager():
         elif item_to_use == "Filled_Bucket":
             self.__inventory[self.__selected_slot-1] = "Empty_Bucket"
             fires_put_out = 0
-            for item in self.__items.values():  ##for loop to find fire items
-                item_name = item.get_name()
-                if item_name[0:4] == "Fire":
-                    if items.distance_to(item_name, player_x, player_y) < 50:
-                        fires_put_out += 1
-                        self.__items[item_name].set_x(-100000)
+            for item_name in self.query_radius(ITEM_TAG_FIRE, player_x, player_y, 50):
+                fires_put_out += 1
+                self.__items[item_name].set_x(-100000)
             if fires_put_out == 0:
                 GUI.display_message("Water splashes everywhere!", 90)
             elif fires_put_out == 1:
@@ -627,12 +1500,9 @@ class ItemManager():
 
         elif item_to_use == "Axe":
             trees_cut = 0
-            for item in self.__items.values():  ##for loop to find tree items
-                item_name = item.get_name()
-                if item_name[0:4] == "Tree":
-                    if items.distance_to(item_name, player_x, player_y) < 50:
-                        trees_cut += 1
-                        self.__items[item_name].set_x(-100000)
+            for item_name in self.query_radius(ITEM_TAG_TREE, player_x, player_y, 50):
+                trees_cut += 1
+                self.__items[item_name].set_x(-100000)
             if trees_cut == 0:
                 GUI.display_message("There is nothing to cut here!", 90)
             elif trees_cut == 1:
@@ -642,12 +1512,9 @@ class ItemManager():
 
         elif item_to_use == "Key":
             door_open = False
-            for item in self.__items.values():  ##for loop to find door items
-                item_name = item.get_name()
-                if item_name[0:4] == "Door":
-                    if items.distance_to(item_name, player_x, player_y) < 100:
-                        door_open = True
-                        self.__items[item_name].set_x(-100000)
+            for item_name in self.query_radius(ITEM_TAG_DOOR, player_x, player_y, 100):
+                door_open = True
+                self.__items[item_name].set_x(-100000)
             if door_open == False:
                 GUI.display_message("There is nothing to unlock here!", 90)
             else:
@@ -661,8 +1528,7 @@ class ItemManager():
         if self.__inventory[self.__selected_slot-1] == "Nothing":
             return "Nothing"
         dropped = self.__inventory[self.__selected_slot-1]
-        self.__items[self.__inventory[self.__selected_slot-1]].set_x(player_x)
-        self.__items[self.__inventory[self.__selected_slot-1]].set_y(player_y+20)
+        self.__items[dropped].set_position(player_x, player_y+20)
         self.__inventory[self.__selected_slot-1] = "Nothing"
         return dropped
 
@@ -673,13 +1539,21 @@ class ItemManager():
         elif self.__inventory[1] == item_name:
             self.__inventory[1] = "Nothing"
 
-        self.__items[item_name].set_x(-100000)
-        self.__items[item_name].set_y(-100000)
+        self.__items[item_name].set_position(-100000, -100000)
 
+    # Only items that might be seen are added to the scene. Items that have been
+    # picked up are moved off the map so they are always culled
     def draw(self):
+        view = camera.get_cull_rect()
+        culled = 0
         for item in self.__items.values():
-            scene.add_to_scene(item, item.get_y())
+            if item.get_draw_rect().colliderect(view):
+                scene.add_to_scene(item, item.get_y())
+            else:
+                culled += 1
             ##item.draw(self.__ani_count + 1)
+        profiler.count(PROFILE_COUNT_DRAWN, len(self.__items) - culled)
+        profiler.count(PROFILE_COUNT_CULLED, culled)
 
     def draw_inventory(self):
         if self.__selected_slot == 2:
@@ -693,23 +1567,349 @@ class ItemManager():
         if self.__inventory[1] != "Nothing":
             self.__items[self.__inventory[1]].draw_icon(758, 10)
 
+#########################################################################################
+# FlowField class. A breadth first search out from the player over the collision
+#                  layer, giving every open cell near the player the direction of the
+#                  next cell on the shortest path to them. Cells where an NPC's foot
+#                  box would hit something solid or an item count as walls. All the
+#                  chasing NPCs share it.
+#                  It is only started again when the player moves into a different cell
+#                  or an item near it changes, and only searches as far out as the NPCs
+#                  asking for directions.
+#########################################################################################
+
+class FlowField():
+    def __init__(self, radius):
+        self.__radius = radius
+        self.__width = radius*2 + 3     # the window has a border of walls round it
+        self.__source = None
+        self.__left = 0
+        self.__top = 0
+        self.__blocked = []         # True for each wall in the window, row by row
+        self.__steps = []           # (dx, dy, cells to the player) for each cell found so far
+        self.__frontier = deque()   # cells found but whose neighbours haven't been checked
+        self.__searched = 0
+        width = self.__width
+        self.__offsets = [(dy*width + dx, (-dx, -dy)) for dx, dy in FLOW_FIELD_DIRECTIONS]
+
+    def get_source(self):
+        return self.__source
+
+    def get_searched_count(self):
+        return self.__searched
+
+    # Called every tick with the player's position
+    def set_target(self, x, y):
+        source = (x // COLLISION_CELL_SIZE, y // COLLISION_CELL_SIZE)
+        if source == self.__source:
+            return
+        self.__source = source
+        self.__left = source[0] - self.__radius - 1
+        self.__top = source[1] - self.__radius - 1
+        # Anything off the edge of the map is a wall, and so is the border round the window
+        blocked = game_map.get_collision_table().blocked_cells(self.__left, self.__top, self.__width, self.__width, PATH_CELL_BOX)
+        blocked[0, :] = True
+        blocked[-1, :] = True
+        blocked[:, 0] = True
+        blocked[:, -1] = True
+        items.mark_blocked_cells(blocked, self.__left, self.__top, PATH_FOOT_BOX)
+        self.__blocked = blocked.ravel().tolist()
+        self.__steps = [None] * (self.__width * self.__width)
+        start = self.window_index(self.__radius + 1, self.__radius + 1)
+        self.__steps[start] = (0, 0, 0)
+        self.__frontier = deque([start])
+        self.__searched = 1
+
+    def window_index(self, x, y):
+        return y*self.__width + x
+
+    # Called when something in a box (in pixels) changes. If it is near the window the
+    # field is worked out again the next time the target is set
+    def invalidate(self, box):
+        if self.__source is None:
+            return
+        size = COLLISION_CELL_SIZE
+        window_box = Rect(self.__left*size, self.__top*size, self.__width*size, self.__width*size)
+        if window_box.inflate(PATH_FOOT_BOX.width*2, PATH_FOOT_BOX.height*2).colliderect(box):
+            self.__source = None
+
+    # Returns (dx, dy, cells to the player) for a position, searching further out if it
+    # hasn't been reached yet. Returns None if there is no path inside the window
+    def get_step(self, x, y):
+        if self.__source is None:
+            return None
+        window_x = x // COLLISION_CELL_SIZE - self.__left
+        window_y = y // COLLISION_CELL_SIZE - self.__top
+        if window_x <= 0 or window_y <= 0 or window_x >= self.__width - 1 or window_y >= self.__width - 1:
+            return None
+        index = self.window_index(window_x, window_y)
+        while self.__steps[index] is None and len(self.__frontier) > 0:
+            self.expand()
+        return self.__steps[index]
+
+    # Checks the neighbours of the next cell in the frontier. Each one found points
+    # back at the cell it was found from
+    def expand(self):
+        steps = self.__steps
+        blocked = self.__blocked
+        index = self.__frontier.popleft()
+        distance = steps[index][2] + 1
+        for offset, step in self.__offsets:
+            next_index = index + offset
+            if steps[next_index] is None and not blocked[next_index]:
+                steps[next_index] = (step[0], step[1], distance)
+                self.__frontier.append(next_index)
+                self.__searched += 1
+
+#########################################################################################
+# PathFinder class. Finds paths between two points for walking NPCs using A* with jump
+#                   point search, so only the cells where a path might turn are added to
+#                   the open list. NPCs only walk up, down, left or right so the search
+#                   does too. Of all the shortest paths it looks for the one that goes
+#                   across as early as it can, which can only turn from going up or down
+#                   to going across where a wall stopped it going across a step sooner.
+#                   Recent paths are kept in an ordered dictionary as a least recently
+#                   used (LRU) cache, with the area each search covered kept in a spatial
+#                   hash so paths can be thrown away when that part of the map changes.
+#########################################################################################
+
+class PathFinder():
+    def __init__(self, cache_size, region_size):
+        self.__cache_size = cache_size
+        self.__paths = OrderedDict()                # (start cell, goal cell) -> cells on the path or None
+        self.__regions = SpatialHash(region_size)   # (start cell, goal cell) -> area searched in pixels
+        self.__hits = 0
+        self.__misses = 0
+        self.__invalidated = 0
+        # the window being searched, with a border of walls round it
+        self.__left = 0
+        self.__top = 0
+        self.__width = 0
+        self.__height = 0
+        self.__blocked = []
+        self.__goal = (0, 0)
+
+    def get_hits(self):
+        return self.__hits
+
+    def get_misses(self):
+        return self.__misses
+
+    def get_invalidated(self):
+        return self.__invalidated
+
+    def get_size(self):
+        return len(self.__paths)
+
+    def clear(self):
+        for key in self.__paths:
+            self.__regions.remove(key)
+        self.__paths.clear()
+
+    # Returns the collision cells on a path from one point to another, start and goal
+    # included, or None if there isn't one. The returned list is shared so it must not be changed.
+    def find_path(self, start_x, start_y, goal_x, goal_y):
+        start = (start_x // COLLISION_CELL_SIZE, start_y // COLLISION_CELL_SIZE)
+        goal = (goal_x // COLLISION_CELL_SIZE, goal_y // COLLISION_CELL_SIZE)
+        key = (start, goal)
+        if key in self.__paths:
+            self.__hits += 1
+            self.__paths.move_to_end(key)
+            return self.__paths[key]
+
+        self.__misses += 1
+        path = self.search(start, goal)
+        self.__paths[key] = path
+        self.__regions.insert(key, Rect(self.__left*COLLISION_CELL_SIZE, self.__top*COLLISION_CELL_SIZE,
+                                        self.__width*COLLISION_CELL_SIZE, self.__height*COLLISION_CELL_SIZE))
+        if len(self.__paths) > self.__cache_size:
+            old_key, old_path = self.__paths.popitem(last=False)
+            self.__regions.remove(old_key)
+        return path
+
+    # Throws away the paths whose search covered any of a box in pixels
+    def invalidate(self, box):
+        for key in self.__regions.query_rect(box):
+            del self.__paths[key]
+            self.__regions.remove(key)
+            self.__invalidated += 1
+
+    # Makes a list of the cells around the start and goal where an NPC's foot box would
+    # hit something solid (see PATH_CELL_BOX) or an item
+    def load_window(self, start, goal):
+        margin = PATH_SEARCH_MARGIN + 1
+        self.__left = min(start[0], goal[0]) - margin
+        self.__top = min(start[1], goal[1]) - margin
+        self.__width = abs(start[0] - goal[0]) + margin*2 + 1
+        self.__height = abs(start[1] - goal[1]) + margin*2 + 1
+
+        blocked = game_map.get_collision_table().blocked_cells(self.__left, self.__top, self.__width, self.__height, PATH_CELL_BOX)
+        blocked[0, :] = True
+        blocked[-1, :] = True
+        blocked[:, 0] = True
+        blocked[:, -1] = True
+        items.mark_blocked_cells(blocked, self.__left, self.__top, PATH_FOOT_BOX)
+        self.__blocked = blocked.ravel().tolist()
+
+    # Cells are (x, y) in the window while searching
+    def is_blocked(self, x, y):
+        return self.__blocked[y*self.__width + x]
+
+    # A* search between jump points. Returns the cells on the path or None
+    def search(self, start, goal):
+        self.load_window(start, goal)
+        start = (start[0] - self.__left, start[1] - self.__top)
+        goal = (goal[0] - self.__left, goal[1] - self.__top)
+        self.__goal = goal
+        # The NPC is standing on the start cell even if an item is close to it
+        self.__blocked[start[1]*self.__width + start[0]] = False
+        if self.is_blocked(goal[0], goal[1]):
+            return None
+
+        costs = {start: 0}
+        parents = {start: None}
+        open_list = [(self.distance(start, goal), 0, start)]
+        closed = set()
+        pushed = 1
+        while len(open_list) > 0 and len(closed) < PATH_MAX_EXPANSIONS:
+            estimate, order, cell = heapq.heappop(open_list)
+            if cell == goal:
+                return self.build_path(parents, goal)
+            if cell in closed:
+                continue
+            closed.add(cell)
+            for dx, dy in self.directions(cell, parents[cell]):
+                jump_point = self.jump(cell[0] + dx, cell[1] + dy, dx, dy)
+                if jump_point is None or jump_point in closed:
+                    continue
+                cost = costs[cell] + self.distance(cell, jump_point)
+                if jump_point not in costs or cost < costs[jump_point]:
+                    costs[jump_point] = cost
+                    parents[jump_point] = cell
+                    heapq.heappush(open_list, (cost + self.distance(jump_point, goal), pushed, jump_point))
+                    pushed += 1
+        return None
+
+    # Manhattan distance: the number of steps if nothing is in the way
+    def distance(self, a, b):
+        return abs(a[0] - b[0]) + abs(a[1] - b[1])
+
+    # The directions worth searching from a cell given the direction it was reached in.
+    # Going across can turn up or down anywhere. Going up or down only turns across
+    # where the cell across from the one before is a wall (a forced turn)
+    def directions(self, cell, parent):
+        x, y = cell
+        if parent is None:
+            found = []
+            for dx, dy in FLOW_FIELD_DIRECTIONS:
+                if not self.is_blocked(x + dx, y + dy):
+                    found.append((dx, dy))
+            return found
+
+        dx = (x > parent[0]) - (x < parent[0])
+        dy = (y > parent[1]) - (y < parent[1])
+        found = []
+        if dx != 0:
+            if not self.is_blocked(x + dx, y):
+                found.append((dx, 0))
+            if not self.is_blocked(x, y - 1):
+                found.append((0, -1))
+            if not self.is_blocked(x, y + 1):
+                found.append((0, 1))
+        else:
+            if not self.is_blocked(x, y + dy):
+                found.append((0, dy))
+            if not self.is_blocked(x - 1, y) and self.is_blocked(x - 1, y - dy):
+                found.append((-1, 0))
+            if not self.is_blocked(x + 1, y) and self.is_blocked(x + 1, y - dy):
+                found.append((1, 0))
+        return found
+
+    # Carries on from a cell in one direction until it reaches the goal or a cell where
+    # the path might need to turn (a jump point). Returns None if it hits a wall first.
+    # This is where most of the search time goes so it works on the list index directly
+    def jump(self, x, y, dx, dy):
+        if dx != 0:
+            return self.jump_across(x, y, dx)
+        return self.jump_up_down(x, y, dy)
+
+    # Going across, any cell where a search up or down finds something is a jump point
+    def jump_across(self, x, y, dx):
+        blocked = self.__blocked
+        width = self.__width
+        goal_x, goal_y = self.__goal
+        index = y*width + x
+        while not blocked[index]:
+            if x == goal_x and y == goal_y:
+                return (x, y)
+            if self.jump_up_down(x, y - 1, -1) is not None or self.jump_up_down(x, y + 1, 1) is not None:
+                return (x, y)
+            x += dx
+            index += dx
+        return None
+
+    def jump_up_down(self, x, y, dy):
+        blocked = self.__blocked
+        width = self.__width
+        goal_x, goal_y = self.__goal
+        index = y*width + x
+        step = dy*width
+        while not blocked[index]:
+            if x == goal_x and y == goal_y:
+                return (x, y)
+            if (not blocked[index - 1] and blocked[index - 1 - step]) or (not blocked[index + 1] and blocked[index + 1 - step]):
+                return (x, y)
+            y += dy
+            index += step
+        return None
+
+    # Follows the parents back from the goal and fills in every cell between the jump
+    # points, which are always in the same row or column as the one before
+    def build_path(self, parents, goal):
+        jump_points = []
+        cell = goal
+        while cell is not None:
+            jump_points.append(cell)
+            cell = parents[cell]
+        jump_points.reverse()
+
+        x, y = jump_points[0]
+        path = [(x + self.__left, y + self.__top)]
+        for next_x, next_y in jump_points[1:]:
+            dx = (next_x > x) - (next_x < x)
+            dy = (next_y > y) - (next_y < y)
+            while (x, y) != (next_x, next_y):
+                x += dx
+                y += dy
+                path.append((x + self.__left, y + self.__top))
+        return path
+
 #########################################################################################
 # NPC class. The parent class for NPCs. Each NPC type inherits and expands this class
 #########################################################################################
 
 class NPC():
-    def __init__(self, npc_x, npc_y, foot_box, direction, image_file, move_type):
+    def __init__(self, npc_x, npc_y, foot_box, direction, image_file, move_type, npc_index=None):
+        npc_x, npc_y = game_map.get_collision_table().nearest_clear(npc_x, npc_y, foot_box)
         self.__npc_world_x = npc_x
         self.__npc_world_y = npc_y
+        self.__npc_last_x = npc_x   # position at the start of the tick, used for drawing between ticks
+        self.__npc_last_y = npc_y
         self.__foot_box = foot_box
-        self.__npc_screen_x = self.__npc_world_x - (scroll_x_offset*TILE_WIDTH)
-        self.__npc_screen_y = self.__npc_world_y - (scroll_y_offset*TILE_HEIGHT)
+        self.__npc_screen_x = camera.world_to_screen_x(self.__npc_world_x)
+        self.__npc_screen_y = camera.world_to_screen_y(self.__npc_world_y)
         self.__direction = direction
         self.__weapon_offset = 0  ##determines what set of sprites are shown (walking/ walking with sword)
         self.__has_sword = False
         self.__ani_count = 0  #animation frame counter
-        self.__herosheet_image = SpriteSheet(image_file, 96, 96, 8, 8)
+        self.__herosheet_image = assets.get_sprite_sheet(image_file, 96, 96, 8, 8)
         self._move_type = move_type
+        self.__npc_index = npc_index
+        self.__sleep_tick = 0   # the tick the NPC went to sleep on
+        self.__path = None      # cells the NPC is walking along, from the path finder
+        self.__path_index = 0   # the cell on the path the NPC is in
+        self.__path_goal = None
+        self.update_index()
 
     def save(self):
         game_slot.save_write_list([self.__npc_world_x, self.__npc_world_y, self.__direction, self._move_type])
@@ -720,15 +1920,52 @@ class NPC():
         self.__npc_world_y = int(data[1])
         self.__direction = int(data[2])
         self._move_type = int(data[3])
+        self.update_index()
+
+    # NPCs that must keep updating wherever they are, e.g. one following the player
+    def is_always_awake(self):
+        return False
+
+    # Called when the NPC stops being updated because the player is far away
+    def sleep(self):
+        self.__sleep_tick = frame_count
+        self.begin_tick()
+
+    # Called when the player comes near again
+    def wake(self):
+        self.catch_up(max(0, frame_count - self.__sleep_tick))
+        self.begin_tick()
+
+    # Cheaply moves the NPC on by the ticks it slept for instead of running them all
+    def catch_up(self, ticks):
+        pass
+
+    # Moves the NPC in the proximity index shared by the NPC managers
+    def update_index(self):
+        if self.__npc_index is not None and self.__npc_index.get_rect(self) != (self.__npc_world_x, self.__npc_world_y, 1, 1):
+            self.__npc_index.insert(self, Rect(self.__npc_world_x, self.__npc_world_y, 1, 1))
 
+    # The screen position to draw at, part way between the last tick and this one
     def get_screen_x(self):
-        self.__npc_screen_x = self.__npc_world_x - (scroll_x_offset*TILE_WIDTH)
+        self.__npc_screen_x = camera.world_to_screen_x(interpolate(self.__npc_last_x, self.__npc_world_x))
         return self.__npc_screen_x
 
     def get_screen_y(self):
-        self.__npc_screen_y = self.__npc_world_y - (scroll_y_offset*TILE_HEIGHT)
+        self.__npc_screen_y = camera.world_to_screen_y(interpolate(self.__npc_last_y, self.__npc_world_y))
         return self.__npc_screen_y
 
+    # The area of the map the NPC's sprite covers
+    def get_draw_rect(self):
+        return Rect(self.__npc_world_x-47, self.__npc_world_y-90, 96, 96)
+
+    def get_foot_box(self):
+        return self.__foot_box
+
+    # Called at the start of every tick to remember where the NPC was
+    def begin_tick(self):
+        self.__npc_last_x = self.__npc_world_x
+        self.__npc_last_y = self.__npc_world_y
+
     def get_world_x(self):
         return self.__npc_world_x
 
@@ -744,6 +1981,7 @@ class NPC():
     def set_position(self, x, y):
         self.__npc_world_x = x
         self.__npc_world_y = y
+        self.update_index()
 
     def get_direction(self):
         return self.__direction
@@ -752,15 +1990,15 @@ class NPC():
         self.__direction = direction
 
     def draw(self):
-        self.__npc_screen_x = self.__npc_world_x - (scroll_x_offset*TILE_WIDTH)
-        self.__npc_screen_y = self.__npc_world_y - (scroll_y_offset*TILE_HEIGHT)
+        self.get_screen_x()
+        self.get_screen_y()
         self.__herosheet_image.draw(self.__npc_screen_x-47, self.__npc_screen_y-90, self.__direction*8+self.__ani_count + self.__weapon_offset)
         if DRAW_HIT_BOXES:
             show_foot_box = self.__foot_box.move(self.__npc_screen_x, self.__npc_screen_y)
             screen.draw_rect(show_foot_box, (0,255,255))
 
     def move(self, x, y):
-        global frame_count, scroll_x_offset, scroll_y_offset
+        global frame_count
         if frame_count%3 == 0:
             self.__ani_count = (self.__ani_count + 1)%8
         new_x = self.__npc_world_x
@@ -784,13 +2022,13 @@ class NPC():
                 new_y -=2
             self.__direction = 0
 
+        # NPCs test their whole foot box against the solid cells
         box = self.__foot_box.move(new_x, new_y)
         if items.collide_with_base_box(box) == "":
-            cx = new_x // 16
-            cy = new_y // 16
-            if collision_layer[cy][cx] != 1:
+            if not game_map.get_collision_table().is_box_blocked(box):
                 self.__npc_world_x = new_x
                 self.__npc_world_y = new_y
+                self.update_index()
             else:
                 self.__ani_count = 7
 
@@ -824,14 +2062,142 @@ class NPC():
         if x != 0 or y != 0:
             self.move(x, y)
 
+    # Walks straight to a position without checking for collisions, e.g. along a rail
+    def step_to(self, new_x, new_y):
+        if new_x == self.__npc_world_x and new_y == self.__npc_world_y:
+            return
+        if frame_count%3 == 0:
+            self.__ani_count = (self.__ani_count + 1)%8
+        if new_x > self.__npc_world_x:
+            self.__direction = 3
+        elif new_x < self.__npc_world_x:
+            self.__direction = 1
+        if new_y > self.__npc_world_y:
+            self.__direction = 2
+        elif new_y < self.__npc_world_y:
+            self.__direction = 0
+        self.__npc_world_x = new_x
+        self.__npc_world_y = new_y
+        self.update_index()
+
+    # Walks along a path from the path finder to the target. A new path is only asked
+    # for when the target moves to a different cell or the NPC gets knocked off the path
+    def walk_to(self, target_x, target_y):
+        cell = (self.__npc_world_x // COLLISION_CELL_SIZE, self.__npc_world_y // COLLISION_CELL_SIZE)
+        goal = (target_x // COLLISION_CELL_SIZE, target_y // COLLISION_CELL_SIZE)
+        if self.__path is not None and self.__path_goal == goal:
+            # move on to the next cell once the NPC has walked into it
+            if self.__path_index + 1 < len(self.__path) and self.__path[self.__path_index + 1] == cell:
+                self.__path_index += 1
+            if self.__path[self.__path_index] != cell:
+                self.__path = None
+        if self.__path is None or self.__path_goal != goal:
+            self.__path = path_finder.find_path(self.__npc_world_x, self.__npc_world_y, target_x, target_y)
+            self.__path_index = 0
+            self.__path_goal = goal
+
+        # Walk straight at the target if there is no path or the NPC is in the last cell
+        if self.__path is None or self.__path_index + 1 >= len(self.__path):
+            self.move_towards_target(target_x, target_y)
+            return
+        next_x, next_y = self.__path[self.__path_index + 1]
+        if next_x != cell[0]:
+            self.move_to_cell(next_x - cell[0], 0)
+        else:
+            self.move_to_cell(0, next_y - cell[1])
+
+    # Steps towards the next cell on a path. The NPC lines up with the middle of the
+    # cell it is in first, so its foot box only goes where the path was checked
+    def move_to_cell(self, dx, dy):
+        size = COLLISION_CELL_SIZE
+        off_x = self.__npc_world_x - (self.__npc_world_x // size * size + size//2)
+        off_y = self.__npc_world_y - (self.__npc_world_y // size * size + size//2)
+        if dx != 0 and abs(off_y) > 1:
+            self.move(0, -1 if off_y > 0 else 1)
+        elif dy != 0 and abs(off_x) > 1:
+            self.move(-1 if off_x > 0 else 1, 0)
+        else:
+            self.move(dx, dy)
+
+    # Follows the flow field towards the player so the NPC goes round walls, then
+    # walks straight at the target once it is close
+    def chase(self, target_x, target_y):
+        step = flow_field.get_step(self.__npc_world_x, self.__npc_world_y)
+        if step is None or step[2] <= FLOW_FIELD_NEAR_STEPS:
+            self.move_towards_target(target_x, target_y)
+        else:
+            self.move_to_cell(step[0], step[1])
+
 #########################################################################################
 # NPCManager class. Parent class for NPC managers which each NPC manager inherits
 #                   Uses a dictionary to keep track of the NPCs
 #########################################################################################
 
 class NPCManager():
-    def __init__(self):
+    def __init__(self, npc_index):
         self._npcs = {}
+        self._npc_index = npc_index
+        self._npc_order = {}    # the order the NPCs were added, looked up by the NPC
+        self._next_order = 0
+        self._awake = []        # the NPCs being updated, in the order they were added
+        self._active_region = None
+
+    # An NPC that replaces one with the same name takes its place in the order,
+    # the same as in the dictionary. New NPCs go after all the others
+    def add_npc(self, name, npc):
+        # Paths are only found for PATH_FOOT_BOX, so they'd walk an NPC with any other foot box into things
+        assert npc.get_foot_box() == PATH_FOOT_BOX, "NPC {0} has a foot box paths aren't found for".format(name)
+        if name in self._npcs:
+            old_npc = self._npcs[name]
+            self._npc_index.remove(old_npc)
+            self._npc_order[npc] = self._npc_order.pop(old_npc)
+            if old_npc in self._awake:
+                self._awake.remove(old_npc)
+        else:
+            self._npc_order[npc] = self._next_order
+            self._next_order += 1
+        self._npcs[name] = npc
+        self._active_region = None
+
+    def get_awake_count(self):
+        return len(self._awake)
+
+    def get_asleep_count(self):
+        return len(self._npcs) - len(self._awake)
+
+    # Works out which NPCs are awake. This is only done when the player moves into a
+    # different region, so sleeping NPCs cost nothing each tick. Setting the active
+    # region to None (when NPCs are added or loaded) checks every NPC next time
+    def refresh_activity(self):
+        region = (player.get_world_x() // ACTIVE_REGION_SIZE, player.get_world_y() // ACTIVE_REGION_SIZE)
+        if region == self._active_region:
+            return
+        check_all = self._active_region is None
+        self._active_region = region
+        active_rect = Rect((region[0]-1) * ACTIVE_REGION_SIZE, (region[1]-1) * ACTIVE_REGION_SIZE, ACTIVE_REGION_SIZE*3, ACTIVE_REGION_SIZE*3)
+
+        awake = set(self.npcs_in_rect(active_rect))
+        for npc in self._npcs.values() if check_all else self._awake:
+            if npc.is_always_awake():
+                awake.add(npc)
+        was_awake = set(self._awake)
+        for npc in self._awake:
+            if npc not in awake:
+                npc.sleep()
+                # Going to sleep may send an NPC back to where it started
+                if active_rect.collidepoint(npc.get_world_x(), npc.get_world_y()):
+                    awake.add(npc)
+        self._awake = sorted(awake, key=self._npc_order.get)
+        for npc in self._awake:
+            if npc not in was_awake:
+                npc.wake()
+
+    # Returns this manager's NPCs standing inside a rectangle in the order they were added.
+    # Only the cells of the proximity index the rectangle covers are checked
+    def npcs_in_rect(self, rect):
+        found = [npc for npc in self._npc_index.query_rect(rect) if npc in self._npc_order]
+        found.sort(key=self._npc_order.get)
+        return found
 
     def save(self):
         game_slot.save_write_list([len(self._npcs)])
@@ -846,19 +2212,40 @@ class NPCManager():
             data = game_slot.load_read_list()
             npc_key = data[0]
             self._npcs[npc_key].load()
+        self._active_region = None
 
     def draw(self):
+        view = camera.get_cull_rect()
+        culled = 0
         for npc in self._npcs.values():
-            scene.add_to_scene(npc, npc.get_world_y())
+            if npc.get_draw_rect().colliderect(view):
+                scene.add_to_scene(npc, npc.get_world_y())
+            else:
+                culled += 1
+        profiler.count(PROFILE_COUNT_DRAWN, len(self._npcs) - culled)
+        profiler.count(PROFILE_COUNT_CULLED, culled)
+        profiler.count(PROFILE_COUNT_AWAKE, self.get_awake_count())
+        profiler.count(PROFILE_COUNT_ASLEEP, self.get_asleep_count())
 
+    # A sleeping NPC that has to keep updating now is woken straight away
     def set_move_type(self, name, move_type):
-        self._npcs[name].set_move_type(move_type)
+        npc = self._npcs[name]
+        npc.set_move_type(move_type)
+        if npc.is_always_awake() and npc not in self._awake:
+            npc.wake()
+            self._awake.append(npc)
+            self._awake.sort(key=self._npc_order.get)
 
     def get_move_type(self, name):
         return self._npcs[name].get_move_type()
 
+    def begin_tick(self):
+        for npc in self._awake:
+            npc.begin_tick()
+
     def update(self):
-        for npc in self._npcs.values():
+        self.refresh_activity()
+        for npc in self._awake:
             npc.update()
 
 
@@ -867,8 +2254,8 @@ class NPCManager():
 #########################################################################################
 
 class Person(NPC):
-    def __init__(self, name, npc_x, npc_y, foot_box, direction, image_file, move_type):
-        super().__init__(npc_x, npc_y, foot_box, direction, image_file, move_type)
+    def __init__(self, name, npc_x, npc_y, foot_box, direction, image_file, move_type, npc_index=None):
+        super().__init__(npc_x, npc_y, foot_box, direction, image_file, move_type, npc_index)
         self.__move_x = 0
         self.__move_y = 0
         self.__timer = 60
@@ -877,6 +2264,15 @@ class Person(NPC):
     def get_name(self):
         return self.__name
 
+    def is_always_awake(self):
+        return self._move_type == PERSON_MOVE_FOLLOW
+
+    # A wandering person picks a new direction straight away if they would have
+    # finished walking while asleep. They don't move while asleep.
+    def catch_up(self, ticks):
+        if self._move_type == PERSON_MOVE_WANDER:
+            self.__timer = max(1, self.__timer - ticks)
+
     def talk(self):
         global kid_mission
 
@@ -968,8 +2364,8 @@ class Person(NPC):
         if self._move_type == PERSON_MOVE_WANDER:
             self.__timer -= 1
             if self.__timer == 0:
-                self.__timer = random.randint(60, 90)
-                direction = random.randint(0, 4)
+                self.__timer = rng.randint(60, 90)
+                direction = rng.randint(0, 4)
                 if direction == 0:
                     self.__move_x = 0
                     self.__move_y = 0
@@ -1012,7 +2408,7 @@ class Person(NPC):
             if dist_x >= 15*TILE_WIDTH or dist_y >= 15*TILE_HEIGHT:
                 self.set_position(target_x, target_y)
             else:
-                self.move_towards_target(target_x, target_y)
+                self.walk_to(target_x, target_y)
 
 
 #########################################################################################
@@ -1021,11 +2417,11 @@ class Person(NPC):
 #########################################################################################
 
 class PersonManager(NPCManager):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, npc_index):
+        super().__init__(npc_index)
 
     def add_person(self, name, x, y, foot_box, direction, image_file, move_type=PERSON_MOVE_NONE):
-        self._npcs[name] = Person(name, x, y, foot_box, direction, image_file, move_type)
+        self.add_npc(name, Person(name, x, y, foot_box, direction, image_file, move_type, self._npc_index))
 
     def person_talking_to (self, player_x, player_y, facing):
         dx = 0
@@ -1043,19 +2439,16 @@ class PersonManager(NPCManager):
         facing_x = player_x+dx*TILE_WIDTH
         facing_y = player_y+dy*TILE_HEIGHT
 
+        # Only people within 50 pixels of that point are checked, using squared distances
         nearest_person_name = "None"
-        nearest_person_distance = 99999999
-        for peep in self._npcs.values():  ##for loop to find person which is closest to the player
-            person_name = peep.get_name()
-            person_x = peep.get_world_x()
-            person_y = peep.get_world_y()
-            dx = facing_x - person_x
-            dy = facing_y - person_y
-            distance = sqrt(dx*dx + dy*dy)  ##Pythagoras theorum to calculate the distance of the current person
-            print (person_name, distance)
-            if distance < nearest_person_distance and distance < 50:  ## works out the closest person to the player
+        nearest_person_distance = TALK_DISTANCE*TALK_DISTANCE
+        for peep in self.npcs_in_rect(Rect(facing_x-TALK_DISTANCE, facing_y-TALK_DISTANCE, TALK_DISTANCE*2+1, TALK_DISTANCE*2+1)):
+            dx = facing_x - peep.get_world_x()
+            dy = facing_y - peep.get_world_y()
+            distance = dx*dx + dy*dy
+            if distance < nearest_person_distance:  ## works out the closest person to the player
                 nearest_person_distance = distance
-                nearest_person_name = person_name
+                nearest_person_name = peep.get_name()
 
         return nearest_person_name
 
@@ -1067,9 +2460,9 @@ class PersonManager(NPCManager):
 #########################################################################################
 
 class Monster(NPC):
-    def __init__(self, npc_x, npc_y, foot_box, body_box, direction, image_file, attack_file, move_type):
-        super().__init__(npc_x, npc_y, foot_box, direction, image_file, move_type)
-        self.__attack_image = SpriteSheet(attack_file, 160, 128, 4, 4)
+    def __init__(self, npc_x, npc_y, foot_box, body_box, direction, image_file, attack_file, move_type, npc_index=None):
+        super().__init__(npc_x, npc_y, foot_box, direction, image_file, move_type, npc_index)
+        self.__attack_image = assets.get_sprite_sheet(attack_file, 160, 128, 4, 4)
         self.__is_attacking = False
         self.__attack_frame = 0
         self.__body_box = body_box
@@ -1078,11 +2471,14 @@ class Monster(NPC):
         self.__init_x = npc_x
         self.__init_y = npc_y
         self.__init_direction = direction
+        self.__rail = None              # (rail number, distance along it) if on a rail
+        self.__rail_position = None     # where the monster was put by the rail last tick
         #x and y offset pick a random point around the player that the monster will move towards
-        self.__x_offset = random.randint(-30, 30)
-        self.__y_offset = random.randint(-30, 30)
+        self.__x_offset = rng.randint(-30, 30)
+        self.__y_offset = rng.randint(-30, 30)
 
-    def update(self):
+    # The MonsterManager works out whether the player is close enough to be attacked
+    def update(self, in_aggro_range):
         if player.get_current_health() <= 0:
             return
 
@@ -1091,12 +2487,10 @@ class Monster(NPC):
 
         dist_x = abs(player.get_world_x() - self.get_world_x())
         dist_y = abs(player.get_world_y() - self.get_world_y())
-        if dist_x > 15*TILE_WIDTH or dist_y > 15*TILE_HEIGHT:
-            self.set_position(self.__init_x, self.__init_y)
-            self.set_direction(self.__init_direction)
-            self.set_move_type(self.__init_move_type)
+        if dist_x > MONSTER_RESET_DISTANCE or dist_y > MONSTER_RESET_DISTANCE:
+            self.reset()
         if self._move_type == MONSTER_MOVE_NONE or self._move_type == MONSTER_MOVE_RAILS:
-            if dist_x < 96 and dist_y < 96:
+            if in_aggro_range:
                 self._move_type = MONSTER_MOVE_ATTACK
 
         # Code for getting an NPC to attack the player
@@ -1109,31 +2503,58 @@ class Monster(NPC):
                         self.__attack_frame = 0
                         self.__is_attacking = False
             else:
-                if dist_x < 50 and dist_y < 30 and random.randint(1, 100)>95:
+                if dist_x < 50 and dist_y < 30 and rng.randint(1, 100)>95:
                     self.__is_attacking = True
                     player.take_damage(14)
                 else:
-                    self.move_towards_target(player.get_world_x()+self.__x_offset, player.get_world_y()+self.__y_offset)
+                    self.chase(player.get_world_x()+self.__x_offset, player.get_world_y()+self.__y_offset)
 
         # Code for moving an NPC along rails
         elif self._move_type == MONSTER_MOVE_RAILS:
-            x = self.get_world_x() // TILE_WIDTH
-            y = self.get_world_y() // TILE_HEIGHT
-            rail = rail_layer[y][x]
-            dx = 0
-            dy = 0
-            if rail == RAIL_LEFT:
-                dx = -1
-            elif rail == RAIL_RIGHT:
-                dx = 1
-            elif rail == RAIL_UP:
-                dy = -1
-            elif rail == RAIL_DOWN:
-                dy = 1
-            # works out the tile that the current rail is pointing to
-            target_x = (x + dx) * TILE_WIDTH + (TILE_WIDTH // 2)
-            target_y = (y + dy) * TILE_HEIGHT + (TILE_HEIGHT // 2)
-            self.move_towards_target(target_x, target_y)
+            self.follow_rail()
+
+    # Moves the monster RAIL_SPEED pixels along the compiled rail it is on. The rail is
+    # only looked up again if something else has moved the monster (e.g. reset or load)
+    def follow_rail(self):
+        rails = game_map.get_rails()
+        position = (self.get_world_x(), self.get_world_y())
+        if position != self.__rail_position:
+            self.__rail = rails.find(position[0], position[1])
+            self.__rail_position = position
+        if self.__rail is None:
+            return
+
+        rail_num, distance = self.__rail
+        rail = rails.get_rail(rail_num)
+        distance += RAIL_SPEED
+        if distance > rail.get_length():
+            if rail.is_closed():
+                distance -= rail.get_length()
+            elif rail.get_join() is not None:
+                distance -= rail.get_length()
+                rail_num, join_distance = rail.get_join()
+                rail = rails.get_rail(rail_num)
+                distance += join_distance
+            elif distance - RAIL_SPEED == rail.get_length():
+                return      # already stopped at the end of the rail
+            else:
+                distance = rail.get_length()
+        self.__rail = (rail_num, distance)
+        self.__rail_position = rail.point_at(distance)
+        self.step_to(self.__rail_position[0], self.__rail_position[1])
+
+    # Sends the monster back to where it started
+    def reset(self):
+        self.set_position(self.__init_x, self.__init_y)
+        self.set_direction(self.__init_direction)
+        self.set_move_type(self.__init_move_type)
+
+    # A monster only sleeps when it is further than MONSTER_RESET_DISTANCE from the
+    # player, so it would have been reset on its next update anyway
+    def sleep(self):
+        if self._move_type != MONSTER_MOVE_DEAD:
+            self.reset()
+        super().sleep()
 
     def draw(self):
         if self.__is_attacking == True:
@@ -1146,6 +2567,10 @@ class Monster(NPC):
             show_body_box = self.__body_box.move(self.get_screen_x(), self.get_screen_y())
             screen.draw_rect(show_body_box, (255,0,255))
 
+    # The attack sprites are bigger than the walking ones
+    def get_draw_rect(self):
+        return Rect(self.get_world_x()-80, self.get_world_y()-90, 160, 128)
+
     def check_if_hit(self, sword_box):
         hit_box = self.__body_box.move(self.get_world_x(), self.get_world_y())
         if hit_box.colliderect(sword_box):
@@ -1160,14 +2585,26 @@ class Monster(NPC):
 #########################################################################################
 
 class MonsterManager(NPCManager):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, npc_index):
+        super().__init__(npc_index)
 
     def add_monster(self, name, x, y, foot_box, body_box, direction, image_file, attack_file, move_type=MONSTER_MOVE_NONE):
-        self._npcs[name] = Monster(x, y, foot_box, body_box, direction, image_file, attack_file, move_type)
+        self.add_npc(name, Monster(x, y, foot_box, body_box, direction, image_file, attack_file, move_type, self._npc_index))
 
+    # Finds the monsters close enough to attack the player with a proximity
+    # index query instead of checking the distance to every monster
+    def update(self):
+        player_x = player.get_world_x()
+        player_y = player.get_world_y()
+        in_aggro_range = set(self.npcs_in_rect(Rect(player_x - MONSTER_AGGRO_DISTANCE + 1, player_y - MONSTER_AGGRO_DISTANCE + 1,
+                                                    MONSTER_AGGRO_DISTANCE*2 - 1, MONSTER_AGGRO_DISTANCE*2 - 1)))
+        self.refresh_activity()
+        for monster in self._awake:
+            monster.update(monster in in_aggro_range)
+
+    # Only monsters standing close enough for their body box to reach the sword are checked
     def check_hit(self, sword_box):
-        for enemy in self._npcs.values():
+        for enemy in self.npcs_in_rect(sword_box.inflate(MONSTER_HIT_MARGIN*2, MONSTER_HIT_MARGIN*2)):
             enemy.check_if_hit(sword_box)
 
 #########################################################################################
@@ -1176,23 +2613,27 @@ class MonsterManager(NPCManager):
 
 class Player():
     def __init__(self, player_x, player_y, foot_box, direction, image_file, attack_file):
+        player_x, player_y = game_map.get_collision_table().nearest_clear(player_x, player_y, foot_box)
         self.__player_world_x = player_x
         self.__player_world_y = player_y
+        self.__player_last_x = player_x   # position at the start of the tick, used for drawing between ticks
+        self.__player_last_y = player_y
         self.__foot_box = foot_box
-        self.__player_screen_x = self.__player_world_x - (scroll_x_offset*TILE_WIDTH)
-        self.__player_screen_y = self.__player_world_y - (scroll_y_offset*TILE_HEIGHT)
+        self.__player_screen_x = camera.world_to_screen_x(self.__player_world_x)
+        self.__player_screen_y = camera.world_to_screen_y(self.__player_world_y)
         self.__direction = direction
         self.__weapon_offset = 0  ##determines what set of sprites are shown (walking/ walking with sword)
         self.__has_sword = False
         self.__sword_boxes = [Rect(-20,-65,94,32),Rect(-64,-50,40,32),Rect(-15,-5,33,33),Rect(22,-50,40,32)]
         self.__ani_count = 0  #animation frame counter
-        self.__herosheet_image = SpriteSheet(image_file, 96, 96, 8, 8)
-        self.__heroattack_image = SpriteSheet(attack_file, 160, 128, 4, 4)
+        self.__herosheet_image = assets.get_sprite_sheet(image_file, 96, 96, 8, 8)
+        self.__heroattack_image = assets.get_sprite_sheet(attack_file, 160, 128, 4, 4)
         self.__player_max_health = 100
         self.__player_current_health = self.__player_max_health
         self.__heal_timer = 0
         self.__is_attacking = False
         self.__attack_frame = 0
+        self.__zone = None      # trigger zone the player is standing in
 
     def save(self):
         game_slot.save_write_list([self.__player_world_x, self.__player_world_y, self.__direction, self.__weapon_offset,
@@ -1207,15 +2648,22 @@ class Player():
         self.__has_sword = (data[4]=="True")
         self.__player_current_health = int(data[5])
         self.__heal_timer = int(data[6])
+        self.__zone = game_map.get_trigger_zones().find(self.__player_world_x, self.__player_world_y)
 
+    # Position on the screen at the current tick (not interpolated)
     def get_screen_x(self):
-        self.__player_screen_x = self.__player_world_x - (scroll_x_offset*TILE_WIDTH)
+        self.__player_screen_x = self.__player_world_x - camera.get_x()
         return self.__player_screen_x
 
     def get_screen_y(self):
-        self.__player_screen_y = self.__player_world_y - (scroll_y_offset*TILE_HEIGHT)
+        self.__player_screen_y = self.__player_world_y - camera.get_y()
         return self.__player_screen_y
 
+    # Called at the start of every tick to remember where the player was
+    def begin_tick(self):
+        self.__player_last_x = self.__player_world_x
+        self.__player_last_y = self.__player_world_y
+
     def get_world_x(self):
         return self.__player_world_x
 
@@ -1265,8 +2713,8 @@ class Player():
                 game_over_countdown = 90
 
     def draw(self):
-        self.__player_screen_x = self.__player_world_x - (scroll_x_offset*TILE_WIDTH)
-        self.__player_screen_y = self.__player_world_y - (scroll_y_offset*TILE_HEIGHT)
+        self.__player_screen_x = camera.world_to_screen_x(interpolate(self.__player_last_x, self.__player_world_x))
+        self.__player_screen_y = camera.world_to_screen_y(interpolate(self.__player_last_y, self.__player_world_y))
         if self.__player_current_health>0:
             if self.__is_attacking:
                 self.__heroattack_image.draw(self.__player_screen_x-80, self.__player_screen_y-90, self.__direction*4+self.__attack_frame)
@@ -1282,7 +2730,7 @@ class Player():
                 screen.draw_rect(show_sword_box, (255,255,0))
 
     def move(self, x, y):
-        global frame_count, scroll_x_offset, scroll_y_offset, game_over_countdown
+        global frame_count
         if self.__is_attacking or self.__player_current_health <= 0:
             return
 
@@ -1310,61 +2758,52 @@ class Player():
                 new_y -= PLAYER_SPEED
             self.__direction = FACING_UP
 
-        # Check the collision map to see if the player can move to the new position
-        # Also used to see if the player has stepped on a teleport square and move
-        # them the new location if they have.
-
+        # Walking the foot point into a trigger zone runs its action, e.g. teleporting the
+        # player through a doorway. Otherwise the player can only move if the whole foot
+        # box is clear of solid cells
         box = self.__foot_box.move(new_x, new_y)
         if items.collide_with_base_box(box) == "":
-            cx = new_x // 16
-            cy = new_y // 16
-            if collision_layer[cy][cx] == 0 or collision_layer[cy][cx] == 4:
+            zone = game_map.get_trigger_zones().find(new_x, new_y)
+            if zone is not None and not zone.is_walkable():
+                self.run_action(zone.get_action())
+                self.__zone = game_map.get_trigger_zones().find(self.__player_world_x, self.__player_world_y)
+            elif not game_map.get_collision_table().is_box_blocked(box):
                 self.__player_world_x = new_x
                 self.__player_world_y = new_y
-            elif collision_layer[cy][cx] == 2:              # Teleport into house
-                self.__player_world_x = 5232
-                self.__player_world_y = 470
-                scroll_x_offset = 98
-                scroll_y_offset = 0
-            elif collision_layer[cy][cx] == 3:              # Teleport out of house
-                self.__player_world_x = (22*TILE_WIDTH)+TILE_WIDTH//2
-                self.__player_world_y = (56*TILE_HEIGHT)+TILE_HEIGHT//2
-                scroll_x_offset = 12
-                scroll_y_offset = 49
-            elif collision_layer[cy][cx] == 5:              # Teleport into maze
-                self.__player_world_x = (110*TILE_WIDTH)+TILE_WIDTH//2
-                self.__player_world_y = (104*TILE_HEIGHT)+TILE_HEIGHT//2
-                scroll_x_offset = 104
-                scroll_y_offset = 97
-            elif collision_layer[cy][cx] == 6:              # Teleport to forest entrance
-                self.__player_world_x = (36*TILE_WIDTH)+TILE_WIDTH//2
-                self.__player_world_y = (31*TILE_HEIGHT)+TILE_HEIGHT//2
-                scroll_x_offset = 30
-                scroll_y_offset = 25
-            elif collision_layer[cy][cx] == 7:              # Teleport into cave if player has sword
-                if items.is_carried("Sword"):
-                    self.__player_world_x = (34*TILE_WIDTH)+TILE_WIDTH//2
-                    self.__player_world_y = 137*TILE_HEIGHT
-                    scroll_x_offset = 25
-                    scroll_y_offset = 132
-                else:
-                    GUI.display_message("It is too dangerous to go in there unarmed.", 90)
-                    self.__player_world_y += 48
-            elif collision_layer[cy][cx] == 8:              # Teleport Purple 3
-                self.__player_world_x = 15*TILE_WIDTH
-                self.__player_world_y = (86*TILE_HEIGHT)+TILE_HEIGHT//2
-                scroll_x_offset = 7
-                scroll_y_offset = 81
-            elif collision_layer[cy][cx] == 9:              # walked onto ship
-                self.__player_world_x = 9*TILE_WIDTH+24
-                self.__player_world_y = (155*TILE_HEIGHT)+TILE_HEIGHT//2
-                scroll_x_offset = 0
-                scroll_y_offset = 150
-                GUI.display_message("You escaped the island!", 90)
-                game_over_countdown = 90
+                if zone is not self.__zone:
+                    if self.__zone is not None and "exit" in self.__zone.get_action():
+                        self.run_action(self.__zone.get_action()["exit"])
+                    self.__zone = zone
+                    if zone is not None:
+                        self.run_action(zone.get_action())
             else:
                 self.__ani_count = 7
 
+    # Teleports and pushes put the player down without testing the foot box,
+    # so they might need moving somewhere they can walk from
+    def move_out_of_walls(self):
+        self.__player_world_x, self.__player_world_y = game_map.get_collision_table().nearest_clear(self.__player_world_x, self.__player_world_y, self.__foot_box)
+
+    # Runs the action of a trigger zone (see TRIGGER_ACTIONS)
+    def run_action(self, action):
+        global game_over_countdown
+        if "needs" in action and not items.is_carried(action["needs"]):
+            GUI.display_message(action["refused"], 90)
+            self.__player_world_x += action["push"][0]
+            self.__player_world_y += action["push"][1]
+            self.move_out_of_walls()
+            return
+        if "x" in action:
+            self.__player_world_x = action["x"]
+            self.__player_world_y = action["y"]
+            self.move_out_of_walls()
+        if "camera" in action:
+            camera.set_tile_position(*action["camera"])
+        if "message" in action:
+            GUI.display_message(action["message"], 90)
+        if "game_over" in action:
+            game_over_countdown = action["game_over"]
+
     def update(self):
         self.heal()
         if self.__is_attacking:
@@ -1374,6 +2813,676 @@ class Player():
                     self.__attack_frame = 0
                     self.__is_attacking = False
 
+#########################################################################################
+# MapLayers class. Stores the map layers as NumPy arrays instead of lists of lists
+#                  Tile layers use 16 bit numbers, rail and collision layers use 8 bits
+#########################################################################################
+
+class MapLayers():
+    def __init__(self, width, height):
+        self.__width = width
+        self.__height = height
+        self.__layers = [np.zeros((height, width), dtype=np.uint16),         # base
+                         np.zeros((height, width), dtype=np.uint16),         # detail
+                         np.zeros((height, width), dtype=np.uint16),         # top
+                         np.zeros((height, width), dtype=np.uint8),          # rail
+                         np.zeros((height*3, width*3), dtype=np.uint8)]      # collision
+
+    def get_width(self):
+        return self.__width
+
+    def get_height(self):
+        return self.__height
+
+    def get_layer(self, layer):
+        return self.__layers[layer]
+
+    def set_layer(self, layer, values):
+        self.__layers[layer] = values
+
+    def get_tile(self, layer, x, y):
+        return int(self.__layers[layer][y, x])
+
+    def get_collision(self, cx, cy):
+        return int(self.__layers[LAYER_COLLISION][cy, cx])
+
+    def get_rail(self, x, y):
+        return int(self.__layers[LAYER_RAIL][y, x])
+
+    # Returns a view of a rectangle of a layer, clipped to the edge of the layer
+    # Changing the returned array changes the layer
+    def read_region(self, layer, x, y, width, height):
+        values = self.__layers[layer]
+        x1 = max(x, 0)
+        y1 = max(y, 0)
+        x2 = min(x + width, values.shape[1])
+        y2 = min(y + height, values.shape[0])
+        return values[y1:max(y1, y2), x1:max(x1, x2)]
+
+    # Copies an array of values into a layer with its top left corner at x, y
+    # If a mask is given, only the values where the mask is True are copied
+    def write_region(self, layer, x, y, values, mask=None):
+        values = np.asarray(values)
+        region = self.__layers[layer][y:y+values.shape[0], x:x+values.shape[1]]
+        if mask is None:
+            region[:] = values
+        else:
+            region[mask] = values[mask]
+
+    def fill_region(self, layer, x, y, width, height, value, mask=None):
+        region = self.__layers[layer][y:y+height, x:x+width]
+        if mask is None:
+            region[:] = value
+        else:
+            region[mask] = value
+
+    # Number of bytes used to store all of the layers
+    def get_memory_bytes(self):
+        total = 0
+        for values in self.__layers:
+            total += values.nbytes
+        return total
+
+    # Estimate of the bytes the same layers would use as Python lists of lists
+    # Each cell needs an 8 byte pointer and each row is a separate list object
+    def get_list_memory_bytes(self):
+        total = 0
+        for values in self.__layers:
+            height, width = values.shape
+            total += sys.getsizeof([0]*height) + height*sys.getsizeof([0]*width)
+        return total
+
+    def memory_report(self):
+        return "Map layers use {0:.1f} KB (lists of lists would use {1:.1f} KB)".format(
+            self.get_memory_bytes()/1024, self.get_list_memory_bytes()/1024)
+
+#########################################################################################
+# MapCompiler class. Converts the CSV map into a binary file and loads it back using a
+#                    memory map so the layers can be used without parsing any text.
+#
+# File layout (little endian):
+#   header      magic, version, width, height, layer count, source size,
+#               source modified time, CRC32 checksum of all the layer data
+#   layer table one entry per layer: layer number, bytes per cell, rows, columns, offset
+#   layer data  each layer's cells, starting at its offset
+#########################################################################################
+
+class MapCompiler():
+    HEADER_FORMAT = "<4sHHHHQqI"
+    LAYER_FORMAT = "<BBxxIIQ"
+    DATA_ALIGN = 64
+
+    def __init__(self, source_file, binary_file):
+        self.__source_file = source_file
+        self.__binary_file = binary_file
+
+    def get_binary_file(self):
+        return self.__binary_file
+
+    # Returns the size and modified time of the CSV map, or None if it doesn't exist
+    def source_stamp(self):
+        try:
+            stat = os.stat(self.__source_file)
+        except OSError:
+            return None
+        return (stat.st_size, stat.st_mtime_ns)
+
+    def read_header(self, binary):
+        header = binary.read(struct.calcsize(self.HEADER_FORMAT))
+        if len(header) != struct.calcsize(self.HEADER_FORMAT):
+            return None
+        header = struct.unpack(self.HEADER_FORMAT, header)
+        if header[0] != MAP_BINARY_MAGIC or header[1] != MAP_BINARY_VERSION:
+            return None
+        return header
+
+    # The binary file is stale if it is missing, from an older version
+    # or was compiled from a different version of the CSV map
+    def is_stale(self):
+        try:
+            binary = open(self.__binary_file, "rb")
+        except OSError:
+            return True
+        header = self.read_header(binary)
+        binary.close()
+        if header is None:
+            return True
+        stamp = self.source_stamp()
+        if stamp is not None and (header[5], header[6]) != stamp:
+            return True
+        return False
+
+    # Writes all the layers in a MapLayers object to the binary file
+    def compile(self, layers):
+        layer_nums = [LAYER_BASE, LAYER_DETAIL, LAYER_TOP, LAYER_RAIL, LAYER_COLLISION]
+        table_size = struct.calcsize(self.HEADER_FORMAT) + len(layer_nums)*struct.calcsize(self.LAYER_FORMAT)
+        offset = self.align(table_size)
+        table = b""
+        data = []
+        checksum = 0
+        for layer in layer_nums:
+            values = np.ascontiguousarray(layers.get_layer(layer))
+            values = values.astype(values.dtype.newbyteorder("<"), copy=False)
+            table += struct.pack(self.LAYER_FORMAT, layer, values.itemsize, values.shape[0], values.shape[1], offset)
+            data.append((offset, values.tobytes()))
+            checksum = zlib.crc32(data[-1][1], checksum)
+            offset = self.align(offset + values.nbytes)
+
+        stamp = self.source_stamp()
+        if stamp is None:
+            stamp = (0, 0)
+        header = struct.pack(self.HEADER_FORMAT, MAP_BINARY_MAGIC, MAP_BINARY_VERSION, layers.get_width(), layers.get_height(),
+                             len(layer_nums), stamp[0], stamp[1], checksum)
+
+        # Write to a temporary file first so a half written file is never loaded
+        temp_file = self.__binary_file + ".tmp"
+        binary = open(temp_file, "wb")
+        binary.write(header + table)
+        for layer_offset, layer_bytes in data:
+            binary.seek(layer_offset)
+            binary.write(layer_bytes)
+        binary.close()
+        os.replace(temp_file, self.__binary_file)
+
+    def align(self, offset):
+        return (offset + self.DATA_ALIGN - 1) // self.DATA_ALIGN * self.DATA_ALIGN
+
+    # Memory maps each layer from the binary file into a MapLayers object
+    # The maps are copy on write so generating the maze never changes the file
+    # Returns False if the file is missing or damaged
+    def load(self, layers):
+        try:
+            binary = open(self.__binary_file, "rb")
+        except OSError:
+            return False
+        header = self.read_header(binary)
+        if header is None or header[2] != layers.get_width() or header[3] != layers.get_height():
+            binary.close()
+            return False
+        layer_table = []
+        for i in range(header[4]):
+            layer_table.append(struct.unpack(self.LAYER_FORMAT, binary.read(struct.calcsize(self.LAYER_FORMAT))))
+        binary.close()
+
+        loaded = {}
+        checksum = 0
+        try:
+            for layer, itemsize, rows, cols, offset in layer_table:
+                dtype = np.dtype("<u" + str(itemsize))
+                values = np.memmap(self.__binary_file, dtype=dtype, mode="c", offset=offset, shape=(rows, cols))
+                checksum = zlib.crc32(values, checksum)
+                loaded[layer] = values
+        except (OSError, ValueError):
+            return False
+        if checksum != header[7]:
+            return False
+
+        for layer in loaded.keys():
+            if loaded[layer].shape != layers.get_layer(layer).shape:
+                return False
+        for layer in loaded.keys():
+            layers.set_layer(layer, loaded[layer])
+        return True
+
+#########################################################################################
+# MapChunkCache class. Pre-renders the map into chunks of tiles so the map can be drawn
+#                      with a few large blits instead of one blit per tile.
+#                      Uses an ordered dictionary as a least recently used (LRU) cache
+#########################################################################################
+
+class MapChunkCache():
+    def __init__(self, tiles_image, chunk_size, budget_bytes):
+        self.__tiles_image = tiles_image
+        self.__chunk_size = chunk_size
+        self.__budget_bytes = budget_bytes
+        self.__chunks = OrderedDict()   #(draw_top, chunk_x, chunk_y) -> pre-rendered surface
+        self.__used_bytes = 0
+        self.__bakes = 0
+
+    def get_chunk_size(self):
+        return self.__chunk_size
+
+    def get_used_bytes(self):
+        return self.__used_bytes
+
+    def get_bake_count(self):
+        return self.__bakes
+
+    def clear(self):
+        self.__chunks.clear()
+        self.__used_bytes = 0
+
+    # Returns the surface for a chunk, drawing it first if it is not in the cache
+    def get_chunk(self, draw_top, chunk_x, chunk_y):
+        key = (draw_top, chunk_x, chunk_y)
+        chunk = self.__chunks.get(key)
+        if chunk is not None:
+            self.__chunks.move_to_end(key)
+            return chunk
+
+        chunk = self.bake(draw_top, chunk_x, chunk_y)
+        self.__chunks[key] = chunk
+        self.__used_bytes += self.chunk_bytes(chunk)
+
+        # Throw away the least recently used chunks until we are back within budget
+        while self.__used_bytes > self.__budget_bytes and len(self.__chunks) > 1:
+            old_key, old_chunk = self.__chunks.popitem(last=False)
+            self.__used_bytes -= self.chunk_bytes(old_chunk)
+        return chunk
+
+    def chunk_bytes(self, chunk):
+        return chunk.get_width() * chunk.get_height() * chunk.get_bytesize()
+
+    # Draws every tile in a chunk onto a new surface
+    # The ground pass is opaque, the top pass is transparent where there are no tiles
+    def bake(self, draw_top, chunk_x, chunk_y):
+        self.__bakes += 1
+        size = (self.__chunk_size*TILE_WIDTH, self.__chunk_size*TILE_HEIGHT)
+        if draw_top:
+            chunk = pygame.Surface(size, pygame.SRCALPHA).convert_alpha()
+            chunk.fill((0, 0, 0, 0))
+        else:
+            chunk = pygame.Surface(size).convert()
+
+        first_x = chunk_x*self.__chunk_size
+        first_y = chunk_y*self.__chunk_size
+        if draw_top == False:
+            passes = [map_layers.read_region(LAYER_BASE, first_x, first_y, self.__chunk_size, self.__chunk_size).tolist(),
+                      map_layers.read_region(LAYER_DETAIL, first_x, first_y, self.__chunk_size, self.__chunk_size).tolist()]
+        else:
+            passes = [map_layers.read_region(LAYER_TOP, first_x, first_y, self.__chunk_size, self.__chunk_size).tolist()]
+
+        sprites = []
+        for pass_num in range(len(passes)):
+            for y in range(len(passes[pass_num])):
+                row = passes[pass_num][y]
+                for x in range(len(row)):
+                    # the base layer is always drawn, other layers skip tile 0
+                    if row[x] != 0 or (pass_num == 0 and draw_top == False):
+                        sprites.append((x*TILE_WIDTH, y*TILE_HEIGHT, row[x]))
+        self.__tiles_image.draw_many_on(chunk, sprites)
+        return chunk
+
+    # Removes any chunks that overlap a rectangle of tiles so they are redrawn next time
+    def invalidate(self, tile_x, tile_y, width, height):
+        first_x = tile_x // self.__chunk_size
+        first_y = tile_y // self.__chunk_size
+        last_x = (tile_x + width - 1) // self.__chunk_size
+        last_y = (tile_y + height - 1) // self.__chunk_size
+        for key in list(self.__chunks.keys()):
+            draw_top, chunk_x, chunk_y = key
+            if first_x <= chunk_x <= last_x and first_y <= chunk_y <= last_y:
+                self.__used_bytes -= self.chunk_bytes(self.__chunks.pop(key))
+
+#########################################################################################
+# RailPath class. One compiled rail: the points where it turns, with the distance along
+#                 the rail to each one worked out in advance. A closed rail loops back to
+#                 its first point. An open rail either joins another rail or stops dead.
+#########################################################################################
+
+class RailPath():
+    def __init__(self, points, closed):
+        self.__points = points
+        self.__closed = closed
+        self.__join = None          # (rail number, distance) that the end of an open rail leads on to
+        if closed:
+            points = points + [points[0]]
+        self.__distances = [0]      # distance along the rail to each point
+        for i in range(1, len(points)):
+            step = abs(points[i][0] - points[i-1][0]) + abs(points[i][1] - points[i-1][1])
+            self.__distances.append(self.__distances[-1] + step)
+
+    def get_points(self):
+        return self.__points
+
+    def is_closed(self):
+        return self.__closed
+
+    def get_length(self):
+        return self.__distances[-1]
+
+    def get_join(self):
+        return self.__join
+
+    def set_join(self, rail_num, distance):
+        self.__join = (rail_num, distance)
+
+    # Returns the position a distance along the rail. The segment is found with a
+    # binary search of the distances so long rails are as quick as short ones
+    def point_at(self, distance):
+        segment = min(bisect.bisect_right(self.__distances, distance), len(self.__distances) - 1)
+        points = self.__points
+        start = points[segment-1]
+        end = points[segment % len(points)]
+        along = distance - self.__distances[segment-1]
+        dx = (end[0] > start[0]) - (end[0] < start[0])
+        dy = (end[1] > start[1]) - (end[1] < start[1])
+        return (start[0] + dx*along, start[1] + dy*along)
+
+#########################################################################################
+# RailNetwork class. Compiles the rail layer into RailPaths when the map is loaded so rail
+#                    monsters can move along them without reading the layer every tick.
+#                    Each rail tile points at one other tile, so following the arrows from
+#                    any tile either goes round a loop or runs off the end of the rails.
+#                    Rails that run off the end are reported as problems.
+#########################################################################################
+
+class RailNetwork():
+    def __init__(self):
+        self.__rails = []
+        self.__tiles = {}       # (tile x, tile y) -> (rail number, distance along the rail to the tile centre)
+        self.__problems = []
+
+    def get_rails(self):
+        return self.__rails
+
+    def get_rail(self, rail_num):
+        return self.__rails[rail_num]
+
+    def get_problems(self):
+        return self.__problems
+
+    # Returns (rail number, distance) for the rail tile under a position, or None
+    def find(self, x, y):
+        return self.__tiles.get((x // TILE_WIDTH, y // TILE_HEIGHT))
+
+    def report(self):
+        points = 0
+        for rail in self.__rails:
+            points += len(rail.get_points())
+        return ["{0} rails compiled into {1} points from {2} tiles, {3} problems".format(len(self.__rails), points, len(self.__tiles), len(self.__problems))] + self.__problems
+
+    def compile(self, rail_layer):
+        self.__rails = []
+        self.__tiles = {}
+        self.__problems = []
+
+        next_tiles = {}
+        for y, x in zip(*np.nonzero(rail_layer)):
+            tile = (int(x), int(y))
+            value = int(rail_layer[y, x])
+            if value in RAIL_DIRECTIONS:
+                dx, dy = RAIL_DIRECTIONS[value]
+                next_tiles[tile] = (tile[0] + dx, tile[1] + dy)
+            else:
+                self.__problems.append("Rail tile {0} has an unknown direction {1}".format(tile, value))
+
+        # Rails start at tiles that no other rail tile points to
+        pointed_at = set(next_tiles.values())
+        for tile in next_tiles:
+            if tile not in pointed_at:
+                self.compile_from(tile, next_tiles)
+
+        # Anything left over is part of a loop with nothing leading into it
+        for tile in next_tiles:
+            if tile not in self.__tiles:
+                self.compile_from(tile, next_tiles)
+
+    # Follows the arrows from a tile until it reaches a tile that has already been
+    # compiled, goes back on itself or runs off the end of the rails
+    def compile_from(self, start, next_tiles):
+        tiles = [start]
+        seen = {start: 0}
+        tile = next_tiles[start]
+        while tile in next_tiles and tile not in self.__tiles and tile not in seen:
+            seen[tile] = len(tiles)
+            tiles.append(tile)
+            tile = next_tiles[tile]
+
+        if tile in seen:
+            # The rail goes round a loop. Any tiles before the loop join it
+            loop_start = seen[tile]
+            loop_num = self.add_rail(tiles[loop_start:], True)
+            if loop_start > 0:
+                self.add_rail(tiles[:loop_start] + [tile], False, self.__tiles[tile])
+        elif tile in self.__tiles:
+            self.add_rail(tiles + [tile], False, self.__tiles[tile])
+        else:
+            self.__problems.append("Rail from tile {0} stops dead at tile {1}".format(start, tile))
+            self.add_rail(tiles + [tile], False)
+
+    # Adds a rail through the centres of a list of tiles, keeping only the corners.
+    # The last tile of an open rail is where it stops, or where it joins another rail
+    def add_rail(self, tiles, closed, join=None):
+        rail_num = len(self.__rails)
+        centres = [(x*TILE_WIDTH + TILE_WIDTH//2, y*TILE_HEIGHT + TILE_HEIGHT//2) for x, y in tiles]
+        points = []
+        for i in range(len(centres)):
+            # the first point is kept so distances start from it
+            if i == 0 or (not closed and i == len(centres) - 1):
+                points.append(centres[i])
+                continue
+            # a point in the middle of a straight line isn't needed
+            x, y = centres[i]
+            before = centres[i-1]
+            after = centres[(i+1) % len(centres)]
+            if (x - before[0], y - before[1]) != (after[0] - x, after[1] - y):
+                points.append(centres[i])
+        rail = RailPath(points, closed)
+        if join is not None:
+            rail.set_join(join[0], join[1])
+        self.__rails.append(rail)
+
+        # Remember where each tile is along the rail so monsters can find their place
+        distance = 0
+        last_tile = len(tiles) if closed else len(tiles) - 1
+        for i in range(last_tile):
+            if i > 0:
+                distance += abs(centres[i][0] - centres[i-1][0]) + abs(centres[i][1] - centres[i-1][1])
+            self.__tiles[tiles[i]] = (rail_num, distance)
+        return rail_num
+
+#########################################################################################
+# CollisionTable class. A summed-area table of the solid cells of the map, for things
+#                       that test their whole foot box instead of the point under it.
+#                       The maze walls in the collision layer are a cell wider than the
+#                       walls really are so the player's foot point stays out of them,
+#                       so the table is given the real walls. Each entry is the number
+#                       of solid cells above and to the left of it, so the solid cells
+#                       under any box can be counted from its four corners however big
+#                       the box is. Boxes are in world pixels.
+#########################################################################################
+
+class CollisionTable():
+    def __init__(self):
+        self.__solid = np.zeros((0, 0), dtype=bool)
+        self.__table = np.zeros((1, 1), dtype=np.int32)
+
+    def get_table(self):
+        return self.__table
+
+    def get_solid(self):
+        return self.__solid
+
+    def build(self, solid):
+        height, width = solid.shape
+        self.__solid = solid.copy()
+        self.__table = np.zeros((height+1, width+1), dtype=np.int32)
+        self.__table[1:, 1:] = solid.cumsum(0, dtype=np.int32).cumsum(1, dtype=np.int32)
+
+    # Changes which cells in a region are solid
+    def set_solid(self, cx, cy, solid):
+        self.__solid[cy:cy+solid.shape[0], cx:cx+solid.shape[1]] = solid
+        self.rebuild_from(cx, cy)
+
+    # Only the part of the table below and to the right of a changed cell depends on it,
+    # so after changing a region the table is rebuilt from its top left corner
+    def rebuild_from(self, cx, cy):
+        cx = max(cx, 0)
+        cy = max(cy, 0)
+        table = self.__table
+        counts = self.__solid[cy:, cx:].cumsum(0, dtype=np.int32).cumsum(1, dtype=np.int32)
+        table[cy+1:, cx+1:] = counts + table[cy, cx+1:][None, :] + table[cy+1:, cx][:, None] - table[cy, cx]
+
+    # Returns a window of collision cells, True where a box at the middle of the cell
+    # would hit something solid. left and top are the cell at the window's top left
+    def blocked_cells(self, left, top, width, height, box):
+        size = COLLISION_CELL_SIZE
+        # The box covers the same cells around the middle of every cell, so each corner
+        # of all the boxes can be read from the table as one slice
+        x1 = left + (size//2 + box.left) // size
+        y1 = top + (size//2 + box.top) // size
+        x2 = left + (size//2 + box.right - 1) // size + 1
+        y2 = top + (size//2 + box.bottom - 1) // size + 1
+        table = self.__table
+        if x1 >= 0 and y1 >= 0 and y2 + height <= table.shape[0] and x2 + width <= table.shape[1]:
+            counts = (table[y2:y2+height, x2:x2+width] - table[y1:y1+height, x2:x2+width]
+                      - table[y2:y2+height, x1:x1+width] + table[y1:y1+height, x1:x1+width])
+            return counts > 0
+        cell_ys, cell_xs = np.mgrid[top:top+height, left:left+width]
+        xs = cell_xs*COLLISION_CELL_SIZE + COLLISION_CELL_SIZE//2
+        ys = cell_ys*COLLISION_CELL_SIZE + COLLISION_CELL_SIZE//2
+        return self.are_boxes_blocked(xs, ys, box)
+
+    # Returns True if any cell under the box is blocked. Anything off the map is blocked
+    def is_box_blocked(self, box):
+        x1 = box.left // COLLISION_CELL_SIZE
+        y1 = box.top // COLLISION_CELL_SIZE
+        x2 = (box.right - 1) // COLLISION_CELL_SIZE + 1
+        y2 = (box.bottom - 1) // COLLISION_CELL_SIZE + 1
+        table = self.__table
+        if x1 < 0 or y1 < 0 or y2 >= table.shape[0] or x2 >= table.shape[1]:
+            return True
+        return table[y2, x2] - table[y1, x2] - table[y2, x1] + table[y1, x1] > 0
+
+    # Returns the position nearest to x, y where the box is clear. That is x, y itself if
+    # the box is clear there, otherwise the middle of the nearest clear cell within
+    # CLEAR_SEARCH_RADIUS cells. If there isn't one x, y is returned anyway
+    def nearest_clear(self, x, y, box):
+        if not self.is_box_blocked(box.move(x, y)):
+            return x, y
+        size = COLLISION_CELL_SIZE
+        left = x // size - CLEAR_SEARCH_RADIUS
+        top = y // size - CLEAR_SEARCH_RADIUS
+        clear_ys, clear_xs = np.nonzero(~self.blocked_cells(left, top, CLEAR_SEARCH_RADIUS*2+1, CLEAR_SEARCH_RADIUS*2+1, box))
+        if len(clear_xs) == 0:
+            return x, y
+        xs = (clear_xs + left)*size + size//2
+        ys = (clear_ys + top)*size + size//2
+        nearest = np.argmin((xs - x)**2 + (ys - y)**2)
+        return int(xs[nearest]), int(ys[nearest])
+
+    # The same as is_box_blocked for the box moved to each of a list of positions,
+    # worked out for all of them at once. Returns an array of True or False
+    def are_boxes_blocked(self, xs, ys, box):
+        xs = np.asarray(xs)
+        ys = np.asarray(ys)
+        x1 = (xs + box.left) // COLLISION_CELL_SIZE
+        y1 = (ys + box.top) // COLLISION_CELL_SIZE
+        x2 = (xs + box.right - 1) // COLLISION_CELL_SIZE + 1
+        y2 = (ys + box.bottom - 1) // COLLISION_CELL_SIZE + 1
+        table = self.__table
+        height, width = table.shape
+        off_map = (x1 < 0) | (y1 < 0) | (y2 >= height) | (x2 >= width)
+        x1 = np.clip(x1, 0, width - 1)
+        y1 = np.clip(y1, 0, height - 1)
+        x2 = np.clip(x2, 0, width - 1)
+        y2 = np.clip(y2, 0, height - 1)
+        counts = table[y2, x2] - table[y1, x2] - table[y2, x1] + table[y1, x1]
+        return off_map | (counts > 0)
+
+#########################################################################################
+# TriggerZone class. A rectangle of the map (in world pixels) made from collision cells
+#                    that all have the same trigger code, and the action for that code
+#########################################################################################
+
+class TriggerZone():
+    def __init__(self, code, rect):
+        self.__code = code
+        self.__rect = rect
+        self.__action = TRIGGER_ACTIONS[code]
+
+    def get_code(self):
+        return self.__code
+
+    def get_rect(self):
+        return self.__rect
+
+    def get_action(self):
+        return self.__action
+
+    def is_walkable(self):
+        return self.__action.get("walkable", False)
+
+#########################################################################################
+# TriggerZones class. Finds the trigger cells in the collision layer when the map is loaded
+#                    and joins cells next to each other into as few rectangles as it can.
+#                    The zones are kept in a spatial hash so the zone under a point can be
+#                    found without reading the collision layer.
+#########################################################################################
+
+class TriggerZones():
+    def __init__(self):
+        self.__zones = {}           # zone number -> TriggerZone
+        self.__next_zone_num = 0
+        self.__grid = SpatialHash(TRIGGER_GRID_CELL_SIZE)     # zone number -> zone rectangle
+
+    def get_zones(self):
+        return list(self.__zones.values())
+
+    # Returns the zone under a point, or None
+    def find(self, x, y):
+        for zone_num in self.__grid.query_rect(Rect(x, y, 1, 1)):
+            return self.__zones[zone_num]
+        return None
+
+    def report(self):
+        cells = 0
+        for zone in self.__zones.values():
+            rect = zone.get_rect()
+            cells += (rect.width // COLLISION_CELL_SIZE) * (rect.height // COLLISION_CELL_SIZE)
+        return ["{0} trigger zones made from {1} cells".format(len(self.__zones), cells)]
+
+    def compile(self, collision):
+        self.__zones = {}
+        self.__next_zone_num = 0
+        self.__grid = SpatialHash(TRIGGER_GRID_CELL_SIZE)
+        for code in TRIGGER_ACTIONS:
+            self.compile_code(collision == code, code, 0, 0)
+
+    # Must be called after changing a region of the collision layer (in cells). The zones
+    # that overlap it are thrown away and the cells they covered are compiled again
+    def update_region(self, collision, cx, cy, width, height):
+        size = COLLISION_CELL_SIZE
+        area = Rect(cx*size, cy*size, width*size, height*size)
+        for zone_num in self.__grid.query_rect(area):
+            area.union_ip(self.__zones[zone_num].get_rect())
+            self.__grid.remove(zone_num)
+            del self.__zones[zone_num]
+        area = area.clip(Rect(0, 0, collision.shape[1]*size, collision.shape[0]*size))
+        cx = area.left // size
+        cy = area.top // size
+        region = collision[cy:area.bottom // size, cx:area.right // size]
+        # Zones that were kept can still reach into the area, so their cells aren't compiled
+        # again. Only the part of each one inside the area is marked
+        kept = np.zeros(region.shape, dtype=bool)
+        for zone_num in self.__grid.query_rect(area):
+            rect = self.__zones[zone_num].get_rect().clip(area)
+            kept[rect.top//size-cy:rect.bottom//size-cy, rect.left//size-cx:rect.right//size-cx] = True
+        for code in TRIGGER_ACTIONS:
+            self.compile_code((region == code) & ~kept, code, cx, cy)
+
+    # Each rectangle starts at the top left cell not yet in a zone, is made as wide
+    # as it can be, then made taller while the whole of the next row is free.
+    # cx and cy are where the cells are in the collision layer
+    def compile_code(self, cells, code, cx, cy):
+        size = COLLISION_CELL_SIZE
+        free = cells.copy()
+        for y, x in zip(*np.nonzero(cells)):
+            if not free[y, x]:
+                continue
+            row = free[y, x:]
+            width = len(row) if row.all() else int(np.argmin(row))
+            height = 1
+            while y + height < free.shape[0] and free[y+height, x:x+width].all():
+                height += 1
+            free[y:y+height, x:x+width] = False
+            zone_num = self.__next_zone_num
+            self.__next_zone_num += 1
+            rect = Rect((int(x)+cx)*size, (int(y)+cy)*size, width*size, height*size)
+            self.__zones[zone_num] = TriggerZone(code, rect)
+            self.__grid.insert(zone_num, rect)
+
 #########################################################################################
 # Map class. Used for loading the map layers, generating the maze and drawing the map
 #########################################################################################
@@ -1384,8 +3493,22 @@ class Map():
         self.__map_view_width = view_width
         self.__map_top_x = map_top_x
         self.__map_top_y = map_top_y
-        self.__tiles_image = SpriteSheet(image_file, TILE_WIDTH, TILE_HEIGHT, 15, 15)
+        self.__tiles_image = assets.get_sprite_sheet(image_file, TILE_WIDTH, TILE_HEIGHT, 15, 15)
+        self.__chunk_cache = MapChunkCache(self.__tiles_image, MAP_CHUNK_SIZE, MAP_CHUNK_CACHE_BUDGET)
+        self.__compiler = MapCompiler(MAP_FILE, MAP_BINARY_FILE)
+        self.__rails = RailNetwork()
+        self.__collision_table = CollisionTable()
+        self.__trigger_zones = TriggerZones()
+        self.__load_time = 0
+        self.__loaded_from = ""
         self.__maze = [[0]*MAZE_WIDTH for i in range(MAZE_HEIGHT)]
+        self.__listeners = []   # told about every box of tiles that is changed
+
+        # The ground is drawn onto its own surface which is kept between frames
+        # so it can be scrolled instead of redrawn. Also remember where it was drawn.
+        self.__ground_surface = None
+        self.__ground_x = None
+        self.__ground_y = None
 
     def get_screen_height(self):
         return self.__map_view_height
@@ -1399,6 +3522,36 @@ class Map():
     def get_top_y(self):
         return self.__map_top_y
 
+    def get_chunk_cache(self):
+        return self.__chunk_cache
+
+    def get_rails(self):
+        return self.__rails
+
+    def get_collision_table(self):
+        return self.__collision_table
+
+    def get_trigger_zones(self):
+        return self.__trigger_zones
+
+    def get_load_time(self):
+        return self.__load_time
+
+    def get_loaded_from(self):
+        return self.__loaded_from
+
+    # The listener's invalidate(box) is called with the world box of any tiles that change
+    def add_listener(self, listener):
+        self.__listeners.append(listener)
+
+    # Must be called after changing any tiles so the chunks containing them are redrawn
+    def invalidate_tiles(self, tile_x, tile_y, width, height):
+        self.__chunk_cache.invalidate(tile_x, tile_y, width, height)
+        self.__ground_x = None
+        box = Rect(tile_x*TILE_WIDTH, tile_y*TILE_HEIGHT, width*TILE_WIDTH, height*TILE_HEIGHT)
+        for listener in self.__listeners:
+            listener.invalidate(box)
+
     # Generate a random maze. Uses a stack to keep track of visited cells.
     def generate_maze(self):
         for y in range(MAZE_HEIGHT):
@@ -1426,7 +3579,7 @@ class Map():
                 neighbours.append((0,1))
 
             if len(neighbours) != 0:
-                (dx,dy) = random.choice (neighbours)
+                (dx,dy) = rng.choice (neighbours)
                 stack.append((mx,my))
                 self.__maze[my+dy][mx+dx] = True
                 self.__maze[my+dy+dy][mx+dx+dx] = True
@@ -1444,68 +3597,298 @@ class Map():
         maze_position_x = 107
         maze_position_y = 85
 
-        for y in range(MAZE_HEIGHT):
-            for x in range(MAZE_WIDTH):
-                if self.__maze[y][x] == True:
-                    base_layer[y+maze_position_y][x+maze_position_x] = 1
-                else:
-                    base_layer[y+maze_position_y][x+maze_position_x] = 1
-                    detail_layer[y+maze_position_y][x+maze_position_x] = 80
-                    for i in range(3):
-                        for j in range(5):
-                            collision_layer[(y+maze_position_y)*3+i][(x+maze_position_x)*3+j-1] = 1
+        walls = np.logical_not(np.array(self.__maze, dtype=bool))
+        map_layers.fill_region(LAYER_BASE, maze_position_x, maze_position_y, MAZE_WIDTH, MAZE_HEIGHT, 1)
+        map_layers.fill_region(LAYER_DETAIL, maze_position_x, maze_position_y, MAZE_WIDTH, MAZE_HEIGHT, 80, walls)
+
+        # Each wall tile blocks its 3x3 collision cells plus one extra cell either side
+        wall_cells = np.kron(walls, np.ones((3, 3), dtype=bool))
+        blocked = np.zeros((MAZE_HEIGHT*3, MAZE_WIDTH*3+2), dtype=bool)
+        for j in range(3):
+            blocked[:, j:j+MAZE_WIDTH*3] |= wall_cells
+        solid = map_layers.read_region(LAYER_COLLISION, maze_position_x*3, maze_position_y*3, MAZE_WIDTH*3, MAZE_HEIGHT*3) == 1
+        map_layers.fill_region(LAYER_COLLISION, maze_position_x*3-1, maze_position_y*3, MAZE_WIDTH*3+2, MAZE_HEIGHT*3, 1, blocked)
+        # Things that test their whole foot box hit the walls without the extra cells
+        self.__collision_table.set_solid(maze_position_x*3, maze_position_y*3, solid | wall_cells)
+        self.__trigger_zones.update_region(map_layers.get_layer(LAYER_COLLISION), maze_position_x*3-1, maze_position_y*3, MAZE_WIDTH*3+2, MAZE_HEIGHT*3)
+
+        self.invalidate_tiles(maze_position_x, maze_position_y, MAZE_WIDTH, MAZE_HEIGHT)
+
+    # Load the map from the compiled binary file if it is up to date
+    # otherwise load it from the CSV file and compile a new binary file
+    def load(self):
+        start_time = time.perf_counter()
+        if not self.__compiler.is_stale() and self.__compiler.load(map_layers):
+            self.__loaded_from = self.__compiler.get_binary_file()
+        else:
+            self.load_csv()
+            self.__loaded_from = MAP_FILE
+            try:
+                self.__compiler.compile(map_layers)
+            except OSError:
+                pass
+        # Problems with the rails are shown whenever the map file has been changed
+        self.__rails.compile(map_layers.get_layer(LAYER_RAIL))
+        self.__collision_table.build(map_layers.get_layer(LAYER_COLLISION) == 1)
+        self.__trigger_zones.compile(map_layers.get_layer(LAYER_COLLISION))
+        if self.__loaded_from == MAP_FILE:
+            for problem in self.__rails.get_problems():
+                print(problem)
+        self.__chunk_cache.clear()
+        self.__ground_x = None
+        self.__load_time = time.perf_counter() - start_time
 
     # Load the map from a CSV file
-    def load(self):
-        csv_file = open("map.txt", "r")
+    def load_csv(self):
+        csv_file = open(MAP_FILE, "r")
         csv_reader = csv.reader(csv_file)
         dimensions = next(csv_reader)
         width = int(dimensions[0])
         height = int(dimensions[1])
         #print("width: {}, height: {}".format(width, height))
+        for layer in [LAYER_BASE, LAYER_DETAIL, LAYER_TOP]:
+            self.load_layer(csv_reader, layer, width, height)
+        self.load_layer(csv_reader, LAYER_COLLISION, width*3, height*3)
+        self.load_layer(csv_reader, LAYER_RAIL, width, height)
+        csv_file.close()
+
+    # Reads the rows for one layer from the CSV file and copies them into the layer
+    def load_layer(self, csv_reader, layer, width, height):
+        values = map_layers.get_layer(layer)
         for y in range(height):
             row = next(csv_reader)
-            #print(row)
-            for x in range(width):
-               base_layer[y][x] = int(row[x])
-        for y in range(height):
-            row = next(csv_reader)
-            #print(row)
-            for x in range(width):
-               detail_layer[y][x] = int(row[x])
-        for y in range(height):
-            row = next(csv_reader)
-            #print(row)
-            for x in range(width):
-               top_layer[y][x] = int(row[x])
-        for y in range(height*3):
-            row = next(csv_reader)
-            #print(row)
-            for x in range(width*3):
-               collision_layer[y][x] = int(row[x])
-        for y in range(height):
-            row = next(csv_reader)
-            #print(row)
-            for x in range(width):
-               rail_layer[y][x] = int(row[x])
-        csv_file.close()
+            values[y, :width] = np.array(row[:width], dtype=np.int64)
 
     def draw_tile(self, tile_num, screen_x, screen_y):
         self.__tiles_image.draw(screen_x, screen_y, tile_num)
 
+    # Returns each chunk that overlaps a rectangle of the map (in world pixels)
+    # along with the world position of its top left corner
+    def chunks_in_area(self, draw_top, area):
+        chunk_width = self.__chunk_cache.get_chunk_size()*TILE_WIDTH
+        chunk_height = self.__chunk_cache.get_chunk_size()*TILE_HEIGHT
+        chunks = []
+        for chunk_y in range(area.top // chunk_height, (area.bottom - 1) // chunk_height + 1):
+            for chunk_x in range(area.left // chunk_width, (area.right - 1) // chunk_width + 1):
+                chunk = self.__chunk_cache.get_chunk(draw_top, chunk_x, chunk_y)
+                chunks.append((chunk, chunk_x*chunk_width, chunk_y*chunk_height))
+        return chunks
+
+    # Draws part of the ground onto the ground surface. Area is in world pixels.
+    def render_ground(self, area, view_x, view_y):
+        self.__ground_surface.set_clip(area.move(-view_x, -view_y))
+        for chunk, world_x, world_y in self.chunks_in_area(False, area):
+            self.__ground_surface.blit(chunk, (world_x - view_x, world_y - view_y))
+        self.__ground_surface.set_clip(None)
+
+    # Brings the ground surface up to date with the camera. If the camera has only
+    # moved a little the old pixels are scrolled along with Surface.scroll and only
+    # the newly uncovered strips are drawn.
+    def update_ground(self, view_x, view_y):
+        view_width = self.__map_view_width*TILE_WIDTH
+        view_height = self.__map_view_height*TILE_HEIGHT
+        if self.__ground_surface is None:
+            self.__ground_surface = pygame.Surface((view_width, view_height)).convert()
+
+        if self.__ground_x is None:
+            dx = view_width
+            dy = view_height
+        else:
+            dx = view_x - self.__ground_x
+            dy = view_y - self.__ground_y
+        if dx == 0 and dy == 0:
+            return
+
+        if abs(dx) >= view_width or abs(dy) >= view_height:
+            self.render_ground(Rect(view_x, view_y, view_width, view_height), view_x, view_y)
+        else:
+            self.__ground_surface.scroll(-dx, -dy)
+            if dx > 0:
+                self.render_ground(Rect(view_x + view_width - dx, view_y, dx, view_height), view_x, view_y)
+            elif dx < 0:
+                self.render_ground(Rect(view_x, view_y, -dx, view_height), view_x, view_y)
+            if dy > 0:
+                self.render_ground(Rect(view_x, view_y + view_height - dy, view_width, dy), view_x, view_y)
+            elif dy < 0:
+                self.render_ground(Rect(view_x, view_y, view_width, -dy), view_x, view_y)
+        self.__ground_x = view_x
+        self.__ground_y = view_y
+
+    # Draws the visible part of the map using the pre-rendered chunks
+    # draw_top is False for the ground (base and detail layers) and True for the top layer
     def draw(self, draw_top):
-        for y in range(self.__map_view_height):
-            for x in range(self.__map_view_width):
-                if draw_top == False:
-                    tile_num = base_layer[y+scroll_y_offset][x+scroll_x_offset]
-                    self.draw_tile(tile_num, self.__map_top_x + x*TILE_WIDTH, self.__map_top_x+ y*TILE_HEIGHT)
-                    tile_num = detail_layer[y+scroll_y_offset][x+scroll_x_offset]
-                    if tile_num != 0 :
-                        self.draw_tile(tile_num, self.__map_top_x + x*TILE_WIDTH, self.__map_top_x+ y*TILE_HEIGHT)
-                else:
-                    tile_num = top_layer[y+scroll_y_offset][x+scroll_x_offset]
-                    if tile_num != 0 :
-                        self.draw_tile(tile_num, self.__map_top_x + x*TILE_WIDTH, self.__map_top_x+ y*TILE_HEIGHT)
+        view_x = camera.get_draw_x()
+        view_y = camera.get_draw_y()
+        screen.set_scroll(view_x, view_y)
+        if draw_top == False:
+            self.update_ground(view_x, view_y)
+            screen.blit(self.__ground_surface, (self.__map_top_x, self.__map_top_y), track=False)
+        else:
+            old_clip = screen.get_clip()
+            screen.set_clip(Rect(self.__map_top_x, self.__map_top_y, self.__map_view_width*TILE_WIDTH, self.__map_view_height*TILE_HEIGHT))
+            for chunk, world_x, world_y in self.chunks_in_area(True, camera.get_draw_view_rect()):
+                screen.blit(chunk, (self.__map_top_x + camera.world_to_screen_x(world_x), self.__map_top_y + camera.world_to_screen_y(world_y)), track=False)
+            screen.set_clip(old_clip)
+
+#########################################################################################
+# Camera class. Keeps track of which part of the map is on screen and converts
+#               map (world) positions into screen positions
+#########################################################################################
+
+class Camera():
+    def __init__(self, view_width, view_height, tile_x, tile_y):
+        self.__view_width = view_width
+        self.__view_height = view_height
+        self.__max_x = MAP_WIDTH*TILE_WIDTH - view_width
+        self.__max_y = MAP_HEIGHT*TILE_HEIGHT - view_height
+        self.set_tile_position(tile_x, tile_y)
+        self.begin_tick()
+
+    def get_x(self):
+        return self.__x
+
+    def get_y(self):
+        return self.__y
+
+    # The tile the camera is at, or is scrolling to. Used when saving the game
+    def get_tile_x(self):
+        return self.__target_x // TILE_WIDTH
+
+    def get_tile_y(self):
+        return self.__target_y // TILE_HEIGHT
+
+    def get_view_rect(self):
+        return Rect(self.__x, self.__y, self.__view_width, self.__view_height)
+
+    # Where the camera is drawn from, part way between the last tick and this one
+    def get_draw_x(self):
+        return interpolate(self.__last_x, self.__x)
+
+    def get_draw_y(self):
+        return interpolate(self.__last_y, self.__y)
+
+    def get_draw_view_rect(self):
+        return Rect(self.get_draw_x(), self.get_draw_y(), self.__view_width, self.__view_height)
+
+    # Anything outside this can't be seen. It is a bit bigger than the view because
+    # objects are drawn between their positions at the last tick and this one
+    def get_cull_rect(self):
+        return self.get_draw_view_rect().inflate(CULL_MARGIN*2, CULL_MARGIN*2)
+
+    # Converts a map position to a screen position for drawing
+    def world_to_screen_x(self, world_x):
+        return world_x - self.get_draw_x()
+
+    def world_to_screen_y(self, world_y):
+        return world_y - self.get_draw_y()
+
+    # Called at the start of every tick to remember where the camera was
+    def begin_tick(self):
+        self.__last_x = self.__x
+        self.__last_y = self.__y
+
+    # Moves the camera straight to a position without scrolling
+    def set_position(self, x, y):
+        self.__x = max(0, min(x, self.__max_x))
+        self.__y = max(0, min(y, self.__max_y))
+        self.__target_x = self.__x
+        self.__target_y = self.__y
+
+    def set_tile_position(self, tile_x, tile_y):
+        self.set_position(tile_x*TILE_WIDTH, tile_y*TILE_HEIGHT)
+
+    # Starts the camera scrolling by a number of tiles. Stops at the edge of the map
+    def scroll_by_tiles(self, tiles_x, tiles_y):
+        self.__target_x = max(0, min(self.__target_x + tiles_x*TILE_WIDTH, self.__max_x))
+        self.__target_y = max(0, min(self.__target_y + tiles_y*TILE_HEIGHT, self.__max_y))
+
+    def is_moving(self):
+        return self.__x != self.__target_x or self.__y != self.__target_y
+
+    # Moves the camera up to CAMERA_SPEED pixels towards where it is scrolling to
+    def update(self):
+        self.__x += max(-CAMERA_SPEED, min(self.__target_x - self.__x, CAMERA_SPEED))
+        self.__y += max(-CAMERA_SPEED, min(self.__target_y - self.__y, CAMERA_SPEED))
+
+#########################################################################################
+# Menu class. The parent class for menu screens which each menu screen inherits
+#             Waits for events instead of redrawing in a loop, so an idle menu uses
+#             almost no CPU. Buttons are only redrawn when the mouse moves on or off
+#             them or when a button is clicked.
+#########################################################################################
+
+class Menu():
+    def __init__(self):
+        self._in_menu = True
+        self._buttons = []
+        self.__hovered = None
+
+    # Returns the button under a position on the screen or None
+    def button_at(self, pos):
+        for button in self._buttons:
+            if button.is_over(pos):
+                return button
+        return None
+
+    def draw_buttons(self):
+        self.__hovered = self.button_at(pygame.mouse.get_pos())
+        for button in self._buttons:
+            button.draw(button is self.__hovered)
+
+    # Shows the buttons and handles events until the menu is closed with close_menu()
+    # Can be called again from a click to show another screen, e.g. the controls.
+    # Returns False if the window was closed.
+    def run(self, buttons):
+        outer_buttons = self._buttons
+        self._buttons = buttons
+        self._in_menu = True
+        self.draw_buttons()
+        screen.update()
+        window_closed = False
+
+        while self._in_menu and not window_closed:
+            # Sleep until something happens, then handle everything in the queue
+            # before updating the window. Events are taken one at a time so a
+            # screen opened by a click gets the events that come after the click.
+            event = pygame.event.wait()
+            while event.type != pygame.NOEVENT:
+                if event.type == pygame.QUIT:
+                    # Put it back so the menus and game loop outside also see it
+                    pygame.event.post(event)
+                    window_closed = True
+                    break
+                elif event.type == pygame.MOUSEMOTION:
+                    hovered = self.button_at(event.pos)
+                    if hovered is not self.__hovered:
+                        if self.__hovered is not None:
+                            self.__hovered.draw(False)
+                        if hovered is not None:
+                            hovered.draw(True)
+                        self.__hovered = hovered
+                elif event.type == pygame.MOUSEBUTTONDOWN:
+                    self.menu_mouse_down(event.pos, event.button)
+                    if not self._in_menu:
+                        break
+                    self.draw_buttons()
+                elif event.type == pygame.KEYDOWN:
+                    self.menu_key_down(event.key, event.mod)
+                elif event.type == pygame.WINDOWEXPOSED:
+                    screen.mark_all_dirty()
+                event = pygame.event.poll()
+            screen.update()
+
+        self._buttons = outer_buttons
+        self._in_menu = True
+        return not window_closed
+
+    def close_menu(self):
+        self._in_menu = False
+
+    def menu_key_down(self, key, mod):
+        pass
+
+    def menu_mouse_down(self, pos, button):
+        pass
 
 #########################################################################################
 # MenuButton class. Handles buttons on the opening menu screen
@@ -1516,19 +3899,17 @@ class MenuButton():
         self.__label = label
         self.__box = box
 
-    def draw(self):
+    def draw(self, hovered):
         screen.draw_filled_rect(self.__box, (255, 255, 255))
         screen.draw_big_text_centred(self.__label, self.__box.x, self.__box.y, self.__box.w, self.__box.h, (0,0,0))
-        mouse_pos = pygame.mouse.get_pos()
-        if self.__box.collidepoint(mouse_pos):
+        if hovered:
             screen.draw_rect(self.__box, (255,0,0), 2)
 
+    def is_over(self, pos):
+        return self.__box.collidepoint(pos)
+
     def is_pressed(self):
-        mouse_pos = pygame.mouse.get_pos()
-        if self.__box.collidepoint(mouse_pos):
-            return True
-        else:
-            return False
+        return self.is_over(pygame.mouse.get_pos())
 
 #########################################################################################
 # GameSlotButton class. Handles buttons on the game loading menu screen
@@ -1542,7 +3923,7 @@ class GameSlotButton():
         self.__max_health = max_health
         self.__current_health = current_health
 
-    def draw(self):
+    def draw(self, hovered):
         screen.draw_filled_rect(self.__box, (255, 255, 255))
         if self.__max_health == 0:
             screen.draw_big_text(self.__label, (self.__box.x+10, self.__box.y+10), (0,0,0))
@@ -1552,26 +3933,23 @@ class GameSlotButton():
             save_date, save_time = self.__save_datetime.split(" ", 1)
             screen.draw_text(save_date, (self.__box.x+self.__box.w-150, self.__box.y+17), (0,0,0))
             screen.draw_text(save_time, (self.__box.x+self.__box.w-150, self.__box.y+42), (0,0,0))
-        mouse_pos = pygame.mouse.get_pos()
-        if self.__box.collidepoint(mouse_pos):
+        if hovered:
             screen.draw_rect(self.__box, (255,0,0), 2)
 
+    def is_over(self, pos):
+        return self.__box.collidepoint(pos)
+
     def is_pressed(self):
-        mouse_pos = pygame.mouse.get_pos()
-        if self.__box.collidepoint(mouse_pos):
-            return True
-        else:
-            return False
+        return self.is_over(pygame.mouse.get_pos())
 
 #########################################################################################
 # MenuScreen class. Draws the opening menu and handles the selection made
 #########################################################################################
 
-class MenuScreen():
+class MenuScreen(Menu):
     def __init__(self):
-        self.__in_menu = True
-        self.__back_pressed = False
-        self.__logo_image = SpriteSheet("logo.png", 558, 100, 1, 1)
+        super().__init__()
+        self.__logo_image = assets.get_sprite_sheet("logo.png", 558, 100, 1, 1)
         self.__start_button = MenuButton("Start Game", Rect(138, 165, 540, 80))
         self.__controls_button = MenuButton("Controls", Rect(138, 265, 540, 80))
         self.__credits_button = MenuButton("Credits", Rect(138, 365, 540, 80))
@@ -1585,23 +3963,15 @@ class MenuScreen():
                               "Programmed in Python by Samantha Pinder for the AQA Non-Exam Assessment 2024"
 
     def menu_main(self):
-        while self.__in_menu:
-            if pygame.event.peek(pygame.QUIT):
-                return
-            screen.clear((143,210,255))
-            self.__logo_image.draw(129, 30, 0)
-            for event in pygame.event.get(pygame.MOUSEBUTTONDOWN):
-                if event.type == pygame.MOUSEBUTTONDOWN:
-                    self.menu_mouse_down(event.pos, event.button)
+        self.menu_draw_background()
+        self.run([self.__start_button, self.__controls_button, self.__credits_button])
 
-            self.__start_button.draw()
-            self.__controls_button.draw()
-            self.__credits_button.draw()
-            screen.update()
-
-    def menu_show_controls(self):
+    def menu_draw_background(self):
         screen.clear((143,210,255))
         self.__logo_image.draw(129, 30, 0)
+
+    def menu_show_controls(self):
+        self.menu_draw_background()
         screen.draw_filled_rect((100, 150, 616, 270), (255, 255, 255))
         wrapped_text = []
         text_list = self.__controls_text.splitlines()
@@ -1614,20 +3984,10 @@ class MenuScreen():
         for textline in wrapped_text:
             screen.draw_text(textline, (110, y), (0,0,0))
             y += 25
-        self.__back_pressed = False
-        while not self.__back_pressed:
-            if pygame.event.peek(pygame.QUIT):
-                return
-            for event in pygame.event.get(pygame.MOUSEBUTTONDOWN):
-                if event.type == pygame.MOUSEBUTTONDOWN:
-                    self.menu_mouse_down(event.pos, event.button)
-
-            self.__back_button.draw()
-            screen.update()
+        self.run([self.__back_button])
 
     def menu_show_credits(self):
-        screen.clear((143,210,255))
-        self.__logo_image.draw(129, 30, 0)
+        self.menu_draw_background()
         screen.draw_filled_rect((100, 150, 616, 270), (255, 255, 255))
         wrapped_text = []
         text_list = self.__credits_text.splitlines()
@@ -1639,39 +3999,29 @@ class MenuScreen():
         for textline in wrapped_text:
             screen.draw_text(textline, (110, y), (0,0,0))
             y += 25
-        self.__back_pressed = False
-        while not self.__back_pressed:
-            if pygame.event.peek(pygame.QUIT):
-                return
-            for event in pygame.event.get(pygame.MOUSEBUTTONDOWN):
-                if event.type == pygame.MOUSEBUTTONDOWN:
-                    self.menu_mouse_down(event.pos, event.button)
-
-            self.__back_button.draw()
-            screen.update()
-
-    def menu_key_down(self, key, mod):
-        pass
+        self.run([self.__back_button])
 
     def menu_mouse_down(self, pos, button):
-        if button == mouse.LEFT:
-            if self.__start_button.is_pressed():
-                self.__in_menu = False
-            elif self.__controls_button.is_pressed():
+        if button == BUTTON_LEFT:
+            if self.__start_button in self._buttons and self.__start_button.is_over(pos):
+                self.close_menu()
+            elif self.__controls_button in self._buttons and self.__controls_button.is_over(pos):
                 self.menu_show_controls()
-            elif self.__credits_button.is_pressed():
+                self.menu_draw_background()
+            elif self.__credits_button in self._buttons and self.__credits_button.is_over(pos):
                 self.menu_show_credits()
-            elif self.__back_button.is_pressed():
-                self.__back_pressed = True
+                self.menu_draw_background()
+            elif self.__back_button in self._buttons and self.__back_button.is_over(pos):
+                self.close_menu()
 
 #########################################################################################
 # StartScreen class. Draws the game slot selection screen and handles the selection made
 #########################################################################################
 
-class StartScreen():
+class StartScreen(Menu):
     def __init__(self):
-        self.__in_menu = True
-        self.__logo_image = SpriteSheet("logo.png", 558, 100, 1, 1)
+        super().__init__()
+        self.__logo_image = assets.get_sprite_sheet("logo.png", 558, 100, 1, 1)
         self.__slot_meta = game_slot.get_slot_meta()
         self.__file_1_button = GameSlotButton(self.__slot_meta[1][0], Rect(138, 165, 540, 80), self.__slot_meta[1][1], self.__slot_meta[1][2], self.__slot_meta[1][3])
         self.__file_2_button = GameSlotButton(self.__slot_meta[2][0], Rect(138, 265, 540, 80), self.__slot_meta[2][1], self.__slot_meta[2][2], self.__slot_meta[2][3])
@@ -1680,57 +4030,478 @@ class StartScreen():
     def menu_main(self):
         screen.clear((143,210,255))
         self.__logo_image.draw(129, 30, 0)
-        while self.__in_menu:
-            if pygame.event.peek(pygame.QUIT):
-                return
-            for event in pygame.event.get(pygame.MOUSEBUTTONDOWN):
-                if event.type == pygame.MOUSEBUTTONDOWN:
-                    self.menu_mouse_down(event.pos, event.button)
-
-            self.__file_1_button.draw()
-            self.__file_2_button.draw()
-            self.__file_3_button.draw()
-            screen.update()
-
-    def menu_key_down(self, key, mod):
-        pass
+        self.run([self.__file_1_button, self.__file_2_button, self.__file_3_button])
 
     def menu_mouse_down(self, pos, button):
-        if button == mouse.LEFT:
-            if self.__file_1_button.is_pressed():
+        if button == BUTTON_LEFT:
+            if self.__file_1_button.is_over(pos):
                 game_slot.load_game(1)
-                self.__in_menu = False
-            elif self.__file_2_button.is_pressed():
+                self.close_menu()
+            elif self.__file_2_button.is_over(pos):
                 game_slot.load_game(2)
-                self.__in_menu = False
-            elif self.__file_3_button.is_pressed():
+                self.close_menu()
+            elif self.__file_3_button.is_over(pos):
                 game_slot.load_game(3)
-                self.__in_menu = False
+                self.close_menu()
+
+#########################################################################################
+# GameClock class. Works out how many fixed length game ticks to run each frame.
+#                  Time is added to an accumulator and one tick is taken out of it for
+#                  each update. What is left over says how far to the next tick we are.
+#########################################################################################
+
+class GameClock():
+    def __init__(self, tick_rate, max_ticks_per_frame):
+        self.__tick_length = 1.0/tick_rate
+        self.__max_ticks_per_frame = max_ticks_per_frame
+        self.__accumulator = 0.0
+        self.__last_time = time.perf_counter()
+        self.__dropped_ticks = 0
+
+    # Start timing from now, e.g. after leaving the menus
+    def reset(self):
+        self.__accumulator = 0.0
+        self.__last_time = time.perf_counter()
+
+    # Returns the number of ticks to run before drawing the next frame
+    def advance(self):
+        now = time.perf_counter()
+        self.__accumulator += now - self.__last_time
+        self.__last_time = now
+        ticks = int(self.__accumulator // self.__tick_length)
+        self.__accumulator -= ticks*self.__tick_length
+        if ticks > self.__max_ticks_per_frame:
+            self.__dropped_ticks += ticks - self.__max_ticks_per_frame
+            ticks = self.__max_ticks_per_frame
+        return ticks
+
+    # How far between the last tick and the next one we are (0.0 to 1.0)
+    def get_alpha(self):
+        return min(self.__accumulator / self.__tick_length, 1.0)
+
+    def get_dropped_ticks(self):
+        return self.__dropped_ticks
+
+#########################################################################################
+# TickInput class. The input for one game tick: the movement keys held down and any
+#                  keys or mouse buttons pressed since the last tick
+#########################################################################################
+
+class TickInput():
+    def __init__(self, held_keys=()):
+        self.__held_keys = set(held_keys)
+        self.__key_downs = []
+        self.__mouse_downs = []
+        self.__mouse_ups = []
+
+    # Takes the held keys from pygame.key.get_pressed()
+    def set_held_keys(self, pressed):
+        self.__held_keys = set(key for key in MOVEMENT_KEYS if pressed[key])
+
+    def is_held(self, key):
+        return key in self.__held_keys
+
+    def get_held_keys(self):
+        return self.__held_keys
+
+    def add_key_down(self, key, mod):
+        self.__key_downs.append((key, mod))
+
+    def add_mouse_down(self, pos, button):
+        self.__mouse_downs.append((pos, button))
+
+    def add_mouse_up(self, pos, button):
+        self.__mouse_ups.append((pos, button))
+
+    def get_key_downs(self):
+        return self.__key_downs
+
+    def get_mouse_downs(self):
+        return self.__mouse_downs
+
+    def get_mouse_ups(self):
+        return self.__mouse_ups
+
+#########################################################################################
+# World class. Runs the game simulation one tick at a time without drawing anything,
+#              so it can be run headless for benchmarks and soak tests. It owns the
+#              game objects that startup() makes. The classes find them through the
+#              globals, so a World puts its own objects there before it runs a tick
+#              and takes back anything a tick changed when another World runs.
+#########################################################################################
+
+class World():
+    # Only a World for a game being played should set can_save. Saving does nothing in the others
+    def __init__(self, seed=None, can_save=False):
+        global frame_count, current_world
+        if screen is None:
+            setup_display(headless=True)
+        if seed is None:
+            seed = random.randrange(1 << 32)
+        self.__seed = seed
+        self.__objects = {}         # name in WORLD_GLOBALS -> this World's object
+        self.__ticks = 0
+        if current_world is not None:
+            current_world.store_globals()
+        startup(seed)
+        game_slot.set_can_save(can_save)
+        frame_count = 0
+        current_world = self
+        self.store_globals()
+
+    # Keeps the objects (and numbers such as frame_count) that are in the globals
+    def store_globals(self):
+        for name in WORLD_GLOBALS:
+            self.__objects[name] = globals()[name]
+
+    # Puts this World's objects in the globals, keeping the last World's first
+    def make_current(self):
+        global current_world
+        if current_world is self:
+            return
+        if current_world is not None:
+            current_world.store_globals()
+        globals().update(self.__objects)
+        current_world = self
+
+    def get_object(self, name):
+        if current_world is self:
+            return globals()[name]
+        return self.__objects[name]
+
+    def get_player(self):
+        return self.get_object("player")
+
+    def get_items(self):
+        return self.get_object("items")
+
+    def get_people(self):
+        return self.get_object("people_npcs")
+
+    def get_monsters(self):
+        return self.get_object("monster_npcs")
+
+    def get_map(self):
+        return self.get_object("game_map")
+
+    def get_game_slot(self):
+        return self.get_object("game_slot")
+
+    def get_seed(self):
+        return self.__seed
+
+    def get_ticks(self):
+        return self.__ticks
+
+    # A checksum of the game state, used to check a replay ended up the same
+    def get_checksum(self):
+        self.make_current()
+        return game_slot.get_state_checksum()
+
+    def is_running(self):
+        return self.get_object("game_over_countdown") > 0
+
+    # Runs one tick. Returns False once the game is over
+    def step(self, inputs=None):
+        global frame_count
+        self.make_current()
+        if inputs is None:
+            inputs = TickInput()
+        tick_profiler.begin_frame()
+        for key, mod in inputs.get_key_downs():
+            on_key_down(key, mod)
+        for pos, button in inputs.get_mouse_downs():
+            on_mouse_down(pos, button)
+        for pos, button in inputs.get_mouse_ups():
+            on_mouse_up(pos, button)
+        tick_profiler.lap(TICK_INPUT)
+        update(inputs)
+        tick_profiler.end_frame()
+        frame_count += 1
+        self.__ticks += 1
+        return self.is_running()
+
+    # Runs up to the given number of ticks with the same input held down.
+    # Returns the number of ticks run
+    def run(self, ticks, inputs=None):
+        for tick in range(ticks):
+            if not self.step(inputs):
+                return tick + 1
+        return ticks
+
+#########################################################################################
+# Recording class. Stores the seed, the save slot the game was started in and the input
+#                  for every tick of a game so it can be replayed exactly. The file is a header followed by the ticks packed
+#                  with struct and compressed with zlib.
+#########################################################################################
+
+class Recording():
+    HEADER_FORMAT = "<4sHQBII"
+    TICK_FORMAT = "<BBBB"
+    KEY_FORMAT = "<IH"
+    MOUSE_FORMAT = "<hhB"
+
+    def __init__(self, seed=0, slot=0):
+        self.__seed = seed
+        self.__slot = slot
+        self.__ticks = []
+        self.__checksum = 0
+
+    def get_seed(self):
+        return self.__seed
+
+    def get_slot(self):
+        return self.__slot
+
+    def get_tick_count(self):
+        return len(self.__ticks)
+
+    def get_input(self, tick):
+        return self.__ticks[tick]
+
+    def add_tick(self, inputs):
+        self.__ticks.append(inputs)
+
+    def get_checksum(self):
+        return self.__checksum
+
+    def set_checksum(self, checksum):
+        self.__checksum = checksum
+
+    def save(self, filename):
+        body = []
+        for inputs in self.__ticks:
+            held = 0
+            for i in range(len(MOVEMENT_KEYS)):
+                if inputs.is_held(MOVEMENT_KEYS[i]):
+                    held |= 1 << i
+            body.append(struct.pack(self.TICK_FORMAT, held, len(inputs.get_key_downs()), len(inputs.get_mouse_downs()), len(inputs.get_mouse_ups())))
+            for key, mod in inputs.get_key_downs():
+                body.append(struct.pack(self.KEY_FORMAT, key, mod))
+            for pos, button in inputs.get_mouse_downs() + inputs.get_mouse_ups():
+                body.append(struct.pack(self.MOUSE_FORMAT, pos[0], pos[1], button))
+        header = struct.pack(self.HEADER_FORMAT, RECORD_MAGIC, RECORD_VERSION, self.__seed, self.__slot, len(self.__ticks), self.__checksum)
+        record_file = open(filename, "wb")
+        record_file.write(header + zlib.compress(b"".join(body)))
+        record_file.close()
+
+    # Returns False if the file is missing or isn't a recording
+    def load(self, filename):
+        try:
+            record_file = open(filename, "rb")
+        except OSError:
+            return False
+        data = record_file.read()
+        record_file.close()
+        header_size = struct.calcsize(self.HEADER_FORMAT)
+        if len(data) < header_size:
+            return False
+        magic, version, self.__seed, self.__slot, num_ticks, self.__checksum = struct.unpack_from(self.HEADER_FORMAT, data)
+        if magic != RECORD_MAGIC or version != RECORD_VERSION:
+            return False
+        try:
+            body = zlib.decompress(data[header_size:])
+        except zlib.error:
+            return False
+
+        self.__ticks = []
+        offset = 0
+        for tick in range(num_ticks):
+            held, num_keys, num_downs, num_ups = struct.unpack_from(self.TICK_FORMAT, body, offset)
+            offset += struct.calcsize(self.TICK_FORMAT)
+            inputs = TickInput([MOVEMENT_KEYS[i] for i in range(len(MOVEMENT_KEYS)) if held & (1 << i)])
+            for i in range(num_keys):
+                key, mod = struct.unpack_from(self.KEY_FORMAT, body, offset)
+                offset += struct.calcsize(self.KEY_FORMAT)
+                inputs.add_key_down(key, mod)
+            for i in range(num_downs + num_ups):
+                x, y, button = struct.unpack_from(self.MOUSE_FORMAT, body, offset)
+                offset += struct.calcsize(self.MOUSE_FORMAT)
+                if i < num_downs:
+                    inputs.add_mouse_down((x, y), button)
+                else:
+                    inputs.add_mouse_up((x, y), button)
+            self.__ticks.append(inputs)
+        return True
+
+#########################################################################################
+# Benchmark class. Builds worlds with extra items, people and monsters placed on the
+#                  walkable tiles of the real map, walks the player around them with
+#                  scripted input and times each part of the tick and the frame.
+#########################################################################################
+
+class Benchmark():
+    def __init__(self, sizes, ticks):
+        self.__sizes = sizes
+        self.__ticks = ticks
+        self.__results = []
+
+    def get_results(self):
+        return self.__results
+
+    # Returns the centres of the walkable tiles in the benchmark area
+    def walkable_positions(self):
+        area = BENCHMARK_AREA
+        # The middle of each tile, if the whole of an NPC's foot box fits there
+        tile_ys, tile_xs = np.mgrid[area.top:area.bottom, area.left:area.right]
+        xs = tile_xs.ravel()*TILE_WIDTH + TILE_WIDTH//2
+        ys = tile_ys.ravel()*TILE_HEIGHT + TILE_HEIGHT//2
+        blocked = game_map.get_collision_table().are_boxes_blocked(xs, ys, PATH_FOOT_BOX)
+        return [(int(x), int(y)) for x, y in zip(xs[~blocked], ys[~blocked])]
+
+    # Returns the world and the memory used by the extra objects
+    def build_world(self, size):
+        world = World(BENCHMARK_SEED)
+        place_rng = random.Random(BENCHMARK_SEED + size)
+        positions = self.walkable_positions()
+        tracemalloc.start()
+        for i in range(size):
+            x, y = place_rng.choice(positions)
+            items.add_item("bench_item"+str(i), x, y, Rect(-15, -13, 31, 15), True, 10)
+            x, y = place_rng.choice(positions)
+            people_npcs.add_person("bench_person"+str(i), x, y, Rect(-15, -10, 33, 15), 2, "oldman.png", PERSON_MOVE_WANDER)
+            x, y = place_rng.choice(positions)
+            monster_npcs.add_monster("bench_orc"+str(i), x, y, Rect(-15, -10, 33, 15), Rect(-13, -50, 26, 50), 2, "orc.png", "orcattack.png", MONSTER_MOVE_NONE)
+        build_bytes = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+        # Put the sword under the player so the script can pick it up and swing it
+        items.set_item_position("Sword", player.get_world_x(), player.get_world_y())
+        return world, build_bytes
+
+    # The input for a tick: pick up and select the sword, then walk round in a
+    # square swinging it every few ticks
+    def script_input(self, tick):
+        leg = (tick // BENCHMARK_LEG_TICKS) % len(MOVEMENT_KEYS)
+        inputs = TickInput([[K_d, K_s, K_a, K_w][leg]])
+        if tick == 0:
+            inputs.add_key_down(K_e, 0)
+        elif tick == 1:
+            inputs.add_key_down(K_1, 0)
+        elif tick % BENCHMARK_ATTACK_TICKS == 0:
+            inputs.add_mouse_down((0, 0), BUTTON_RIGHT)
+        return inputs
+
+    def run_size(self, size):
+        global profiler, tick_profiler
+
+        world, build_bytes = self.build_world(size)
+
+        profiler = Profiler(PROFILE_NAMES, self.__ticks, True, PROFILE_COUNTER_NAMES)
+        tick_profiler = Profiler(TICK_PROFILE_NAMES, self.__ticks, True)
+        start_time = time.perf_counter()
+        for tick in range(self.__ticks):
+            profiler.begin_frame()
+            world.step(self.script_input(tick))
+            profiler.lap(PROFILE_UPDATE)
+            # Monsters may gang up on the player, so keep them alive to keep the work the same
+            player.set_current_health(player.get_max_health())
+            draw()
+            screen.update()
+            profiler.record(PROFILE_PRESENT, screen.get_present_time())
+            profiler.end_frame()
+            if not world.is_running():
+                break
+        run_time = time.perf_counter() - start_time
+
+        result = {"size": size,
+                  "ticks": world.get_ticks(),
+                  "seconds": run_time,
+                  "ticks_per_second": world.get_ticks() / run_time,
+                  "build_memory_bytes": build_bytes,
+                  "tick_ms": self.phase_stats(tick_profiler, TICK_PROFILE_NAMES),
+                  "frame_ms": self.phase_stats(profiler, PROFILE_NAMES),
+                  "frame_counts": self.counter_stats(profiler, PROFILE_COUNTER_NAMES)}
+        self.__results.append(result)
+        return result
+
+    def phase_stats(self, phase_profiler, names):
+        means = phase_profiler.get_means()
+        p50 = phase_profiler.get_percentiles(50)
+        p95 = phase_profiler.get_percentiles(95)
+        stats = {}
+        for phase in range(len(names)):
+            stats[names[phase]] = {"mean": round(float(means[phase]), 4), "p50": round(float(p50[phase]), 4), "p95": round(float(p95[phase]), 4)}
+        return stats
+
+    def counter_stats(self, phase_profiler, names):
+        means = phase_profiler.get_counter_means()
+        stats = {}
+        for counter in range(len(names)):
+            stats[names[counter]] = round(float(means[counter]), 2)
+        return stats
+
+    def run(self):
+        self.__results = []
+        for size in self.__sizes:
+            result = self.run_size(size)
+            print("N={0:5}  {1:7.0f} ticks/s  tick {2:7.3f} ms  frame {3:7.3f} ms  {4:6.0f} KB  {5:6.0f} culled  {6:6.0f} awake".format(size, result["ticks_per_second"],
+                  result["tick_ms"]["tick"]["mean"], result["frame_ms"]["frame"]["mean"], result["build_memory_bytes"]/1024,
+                  result["frame_counts"]["culled"], result["frame_counts"]["awake"]))
+        return self.__results
+
+    def save(self, filename):
+        results_file = open(filename, "w")
+        json.dump({"ticks": self.__ticks, "seed": BENCHMARK_SEED, "results": self.__results}, results_file, indent=2)
+        results_file.close()
+
+    # Prints how much the mean time of each phase changed from a baseline run
+    def compare(self, filename):
+        try:
+            baseline_file = open(filename, "r")
+        except OSError:
+            print("Can't load baseline", filename)
+            return
+        baseline = json.load(baseline_file)
+        baseline_file.close()
+        old_results = {}
+        for result in baseline["results"]:
+            old_results[result["size"]] = result
+        for result in self.__results:
+            if result["size"] not in old_results:
+                continue
+            old = old_results[result["size"]]
+            changes = []
+            for group in ["tick_ms", "frame_ms"]:
+                for name, stats in result[group].items():
+                    old_mean = old[group].get(name, {"mean": 0})["mean"]
+                    if old_mean > 0:
+                        changes.append("{0} {1:+.0f}%".format(name, (stats["mean"] - old_mean) * 100 / old_mean))
+            print("N={0:5}  ".format(result["size"]) + "  ".join(changes))
+
+#########################################################################################
+# Function to work out where to draw something that moves between ticks
+#########################################################################################
+
+def interpolate(last, current):
+    if abs(current - last) > TELEPORT_DISTANCE:
+        return current
+    return last + int(round((current - last) * draw_alpha))
 
 #########################################################################################
 # Function to handle key presses
 #########################################################################################
 
 def on_key_down(key, mod):
-    global kid_mission, scroll_x_offset, scroll_y_offset
+    global kid_mission
 
-    if key == keys.E:
+    if key == K_e:
         item_got = items.pickup(player.get_world_x(), player.get_world_y())  ##calls pickup function
         if item_got == "Bucket":
             GUI.display_message("You could fill this with water...", 90)
 
-    if key == keys.Q:
+    if key == K_q:
         item_dropped = items.drop(player.get_world_x(), player.get_world_y())
         if item_dropped == "Sword":
             player.set_has_sword(False)
 
-    if key == keys.K_1:
+    if key == K_1:
         if items.get_selected_slot() == 1:
             items.set_selected_slot(0)
         else:
             items.set_selected_slot(1)
 
-    if key == keys.K_2:
+    if key == K_2:
         if items.get_selected_slot() == 2:
             items.set_selected_slot(0)
         else:
@@ -1741,10 +4512,10 @@ def on_key_down(key, mod):
     else:
         player.set_has_sword(False)
 
-    if key == keys.R:
+    if key == K_r:
         player.take_damage(10)
 
-    if key == keys.O:
+    if key == K_o:
         game_slot.save_game()
         GUI.display_message("Game Saved", 90)
 
@@ -1753,7 +4524,7 @@ def on_key_down(key, mod):
 #########################################################################################
 
 def on_mouse_down(pos, button):
-    if button == mouse.RIGHT:
+    if button == BUTTON_RIGHT:
         if items.get_selected_item() != "Nothing":
             items.use_item(player.get_world_x(), player.get_world_y())
         else:
@@ -1776,102 +4547,121 @@ def on_mouse_up(pos, button):
 #########################################################################################
 
 def draw():
-    screen.clear()
+    # The map covers the whole window so the screen doesn't need clearing first
     game_map.draw(False)
+    profiler.lap(PROFILE_GROUND)
     items.draw()
     scene.add_to_scene(player, player.get_world_y())
     people_npcs.draw()
     monster_npcs.draw()
     scene.draw()
+    profiler.lap(PROFILE_SCENE)
     game_map.draw(True)
+    profiler.lap(PROFILE_TOP)
     items.draw_inventory()
     GUI.draw()
+    profiler.draw()
+    profiler.lap(PROFILE_GUI)
 
 #########################################################################################
 # Function to update everything when the game is playing
 #########################################################################################
 
-def update():
-    global scroll_x_offset, scroll_y_offset, scroll_x_counter, scroll_y_counter, game_over_countdown
-    keys=pygame.key.get_pressed()
+def update(inputs):
+    global game_over_countdown
 
-    # If the screen needs scrolling then keep scrolling it
-    if scroll_x_counter > 0:
-        scroll_x_counter -= 1
-        if scroll_x_offset < MAP_WIDTH-game_map.get_screen_width():
-            scroll_x_offset += 1
-        return
+    # Remember where everything was at the start of the tick so frames
+    # drawn before the next tick can be drawn part way between them
+    camera.begin_tick()
+    player.begin_tick()
+    people_npcs.begin_tick()
+    monster_npcs.begin_tick()
 
-    if scroll_x_counter < 0:
-        scroll_x_counter += 1
-        if scroll_x_offset > 0:
-            scroll_x_offset -= 1
-        return
-
-    if scroll_y_counter > 0:
-        scroll_y_counter -= 1
-        if scroll_y_offset<MAP_HEIGHT-game_map.get_screen_height():
-            scroll_y_offset += 1
-        return
-
-    if scroll_y_counter < 0:
-        scroll_y_counter += 1
-        if scroll_y_offset > 0:
-            scroll_y_offset -= 1
-        return
+    # Keep scrolling the camera if it is moving. Everything else keeps
+    # moving while the camera scrolls.
+    camera.update()
 
     # Check for the WSAD movment keys
-    if keys[K_w]:
+    if inputs.is_held(K_w):
         player.move(0, -1)
-    elif keys[K_s]:
+    elif inputs.is_held(K_s):
         player.move(0, 1)
-    elif keys[K_a]:
+    elif inputs.is_held(K_a):
         player.move(-1, 0)
-    elif keys[K_d]:
+    elif inputs.is_held(K_d):
         player.move(1, 0)
 
     # If the player reaches the edge of the screen then
     # set the screen to be scrolled.
 
-    player_sx = player.get_screen_x()
-    player_sy = player.get_screen_y()
-    if player_sx >= 720:
-        scroll_x_counter += min(12, (MAP_WIDTH-game_map.get_screen_width())-scroll_x_offset)
+    if not camera.is_moving():
+        player_sx = player.get_screen_x()
+        player_sy = player.get_screen_y()
+        if player_sx >= 720:
+            camera.scroll_by_tiles(12, 0)
+
+        if player_sx <= 96:
+            camera.scroll_by_tiles(-12, 0)
 
-    if player_sx <= 96:
-        scroll_x_counter -= min(12, scroll_x_offset)
+        if player_sy >= 480:
+            camera.scroll_by_tiles(0, 7)
 
-    if player_sy >= 480:
-        scroll_y_counter += min(7, (MAP_HEIGHT-game_map.get_screen_height())-scroll_y_offset)
+        if player_sy <= 96:
+            camera.scroll_by_tiles(0, -7)
 
-    if player_sy <= 96:
-        scroll_y_counter -= min(7, scroll_y_offset)
+    tick_profiler.lap(TICK_PLAYER)
 
-    # Update all the NPCs
+    # Update all the NPCs. The flow field the chasing NPCs follow
+    # is started again if the player has moved to a different cell
+    flow_field.set_target(player.get_world_x(), player.get_world_y())
     people_npcs.update()
+    tick_profiler.lap(TICK_PEOPLE)
     monster_npcs.update()
+    tick_profiler.lap(TICK_MONSTERS)
 
     player.update()
+    GUI.update()
     if game_over_countdown > 0 and game_over_countdown < 1000:
         game_over_countdown -= 1
+    tick_profiler.lap(TICK_OTHER)
 
 #########################################################################################
 # Startup function to create all the game objects
 #########################################################################################
 
-def startup():
-    global game_map, game_slot, player, game_over_countdown, people_npcs, monster_npcs, items, scene, GUI, kid_mission, scroll_x_offset, scroll_y_offset
+def startup(seed=None):
+    global game_map, map_layers, camera, game_slot, player, game_over_countdown, people_npcs, monster_npcs, items, scene, GUI, kid_mission, rng, flow_field, path_finder
+
+    # All the random numbers in the game come from this so a game can be repeated
+    # exactly by starting it with the same seed
+    rng = random.Random(seed)
 
     #
     kid_mission = KID_MISSION_START
-    scroll_x_offset = 50
-    scroll_y_offset = 83
 
     # Load the map and generate the maze
+    map_layers = MapLayers(MAP_WIDTH, MAP_HEIGHT)
+    path_finder = PathFinder(PATH_CACHE_SIZE, PATH_REGION_SIZE)
+    # Chasing NPCs find their way to the player with a shared flow field
+    flow_field = FlowField(FLOW_FIELD_RADIUS)
     game_map = Map(0, 0, 11, 17, "tilesheet.png")
+    game_map.add_listener(path_finder)
+    game_map.add_listener(flow_field)
     game_map.load()
     game_map.generate_maze()
 
+    # Create the camera which follows the player around the map
+    camera = Camera(game_map.get_screen_width()*TILE_WIDTH, game_map.get_screen_height()*TILE_HEIGHT, CAMERA_START_X, CAMERA_START_Y)
+    if SHOW_LOAD_STATS:
+        print("Map loaded from {0} in {1:.1f} ms".format(game_map.get_loaded_from(), game_map.get_load_time()*1000))
+        print(map_layers.memory_report())
+        for line in game_map.get_rails().report():
+            print(line)
+        for line in game_map.get_trigger_zones().report():
+            print(line)
+        for line in assets.report():
+            print(line)
+
     #Creates the object for loading and saving the game
     game_slot = SaveGameManager()
 
@@ -1881,8 +4671,11 @@ def startup():
     #
     game_over_countdown = 1000
 
+    # The people and monsters share an index so NPCs near a point can be found quickly
+    npc_index = SpatialHash(NPC_GRID_CELL_SIZE)
+
     # Create a PersonManager object and add the villagers to the game
-    people_npcs = PersonManager()
+    people_npcs = PersonManager(npc_index)
     people_npcs.add_person("old_man", 124*TILE_WIDTH+24, 75*TILE_HEIGHT+24, Rect(-15, -10, 33, 15), 2, "oldman.png")
     people_npcs.add_person("lady", 14*TILE_WIDTH+24, 67*TILE_HEIGHT+24, Rect(-15, -10, 33, 15), 2, "lady.png", PERSON_MOVE_WANDER)
     people_npcs.add_person("kid", 33*TILE_WIDTH+24, 109*TILE_HEIGHT+24, Rect(-15, -10, 33, 15), 2, "kid.png", PERSON_MOVE_NONE)
@@ -1891,7 +4684,7 @@ def startup():
     people_npcs.add_person("abi", 34*TILE_WIDTH+24, 35*TILE_HEIGHT, Rect(-15, -10, 33, 15), 2, "abi.png", PERSON_MOVE_NONE)
 
     # Create a MonsterManager object and add the monsters to the game
-    monster_npcs = MonsterManager()
+    monster_npcs = MonsterManager(npc_index)
     monster_npcs.add_monster("orc", 47*TILE_WIDTH+24, 118*TILE_HEIGHT+24, Rect(-15, -10, 33, 15), Rect(-13, -50, 26, 50), 2, "orc.png", "orcattack.png", MONSTER_MOVE_RAILS)
     monster_npcs.add_monster("orc2", 48*TILE_WIDTH+24, 123*TILE_HEIGHT+24, Rect(-15, -10, 33, 15), Rect(-13, -50, 26, 50), 2, "orc.png", "orcattack.png", MONSTER_MOVE_RAILS)
     monster_npcs.add_monster("orc3", 32*TILE_WIDTH+24, 120*TILE_HEIGHT+24, Rect(-15, -10, 33, 15), Rect(-13, -50, 26, 50), 2, "orc.png", "orcattack.png", MONSTER_MOVE_NONE)
@@ -1905,6 +4698,8 @@ def startup():
 
     # Create an ItemManager object and add all the items to the game
     items = ItemManager("items.png")
+    items.add_listener(path_finder)
+    items.add_listener(flow_field)
     items.add_item("Sword",-100000, -100000 , Rect(-15, -13, 16, 8), True, 0)
     items.add_item("Empty_Bucket", 48 * TILE_WIDTH+24, 120 * TILE_HEIGHT, Rect(-15, -13, 31, 15), True, 10)
     items.add_item("Filled_Bucket", -100000, -100000, Rect(-15, -13, 31, 15), True, 15)
@@ -1920,48 +4715,147 @@ def startup():
     items.add_item("Gold_Coins", -100000, -100000, Rect(-15, -13, 31, 15), True, 50)
     items.add_item("Gate", 9 * TILE_WIDTH+23, 90 * TILE_HEIGHT, Rect(-15, -13, 31, 15), False, 45)
 
-    if random.randint(1,100) > 50:
+    if rng.randint(1,100) > 50:
         items.add_item("Key", 48*TILE_WIDTH, 133*TILE_HEIGHT, Rect(-15, -13, 31, 15), True, 40)
     else:
         items.add_item("Key", 19*TILE_WIDTH, 128*TILE_HEIGHT, Rect(-15, -13, 31, 15), True, 40)
 
 
+#########################################################################################
+# Function to replay a recorded game headless as fast as possible. Prints how long it
+# took and whether it ended in exactly the same state as when it was recorded
+#########################################################################################
+
+def replay(filename):
+    recording = Recording()
+    if not recording.load(filename):
+        print("Can't load recording", filename)
+        return False
+    setup_display(headless=True)
+    world = World(recording.get_seed())
+    world.get_game_slot().set_loaded_slot(recording.get_slot())
+    start_time = time.perf_counter()
+    for tick in range(recording.get_tick_count()):
+        world.step(recording.get_input(tick))
+    replay_time = time.perf_counter() - start_time
+    matched = world.get_checksum() == recording.get_checksum()
+    print("Replayed {0} ticks in {1:.3f} s ({2:.0f} ticks/s)".format(world.get_ticks(), replay_time, world.get_ticks()/max(replay_time, 1e-9)))
+    print("State matches recording" if matched else "State does not match recording")
+    return matched
+
+#########################################################################################
+# Function to run the benchmarks headless and save the results as JSON, comparing
+# them with an earlier run if a baseline file is given
+#########################################################################################
+
+def benchmark(filename, baseline_filename=""):
+    setup_display(headless=True)
+    screen.set_fps(0)
+    bench = Benchmark(BENCHMARK_SIZES, BENCHMARK_TICKS)
+    bench.run()
+    bench.save(filename)
+    if baseline_filename != "":
+        bench.compare(baseline_filename)
+
+#########################################################################################
+# Function to create the window and the things shared by every game
+#########################################################################################
+
+def setup_display(headless=False):
+    global screen, assets, profiler, tick_profiler
+
+    # The dummy drivers let everything be created without opening a window
+    if headless:
+        os.environ["SDL_VIDEODRIVER"] = "dummy"
+        os.environ["SDL_AUDIODRIVER"] = "dummy"
+    screen = Display(WINDOW_WIDTH, WINDOW_HEIGHT, WINDOW_TITLE, RENDER_FPS)
+    assets = AssetRegistry()
+    profiler = Profiler(PROFILE_NAMES, PROFILE_SAMPLES, PROFILE_ENABLED, PROFILE_COUNTER_NAMES)
+    tick_profiler = Profiler(TICK_PROFILE_NAMES, PROFILE_SAMPLES)
+
 #########################################################################################
 # Main game function
 #########################################################################################
 
 def game_main():
-    global frame_count, screen
+    global draw_alpha
 
-    screen = Display(WINDOW_WIDTH, WINDOW_HEIGHT, WINDOW_TITLE, GAME_FPS)
+    setup_display()
+    clock = GameClock(GAME_FPS, MAX_TICKS_PER_FRAME)
     playing = True
     while playing:
-        startup()
+        # The objects from the last game are thrown away, then the images for the
+        # new game load in the background while the menu is shown.
+        assets.start_new_game()
+        assets.preload(ASSET_MANIFEST)
         menu = MenuScreen()
         menu.menu_main()
 
+        world = World(can_save=True)
         start_menu = StartScreen()
+        assets.unload_unused()
         start_menu.menu_main()
 
-        frame_count = 0
+        # Recordings always replay from a new game so a loaded game can't be recorded
+        recording = None
+        if RECORD_FILE != "" and not game_slot.is_game_loaded():
+            recording = Recording(world.get_seed(), game_slot.get_loaded_slot())
+
+        # Input is collected until the next tick runs so none is lost
+        # on frames that don't run a tick
+        inputs = TickInput()
         playing = True
-        while playing and game_over_countdown>0:
+        clock.reset()
+        while playing and world.is_running():
+            profiler.begin_frame()
             for event in pygame.event.get():
                 if event.type == pygame.QUIT:
                     playing = False
                 elif event.type == pygame.MOUSEBUTTONDOWN:
-                    on_mouse_down(event.pos, event.button)
+                    inputs.add_mouse_down(event.pos, event.button)
                 elif event.type == pygame.MOUSEBUTTONUP:
-                    on_mouse_up(event.pos, event.button)
+                    inputs.add_mouse_up(event.pos, event.button)
                 elif event.type == pygame.KEYDOWN:
-                    on_key_down(event.key, event.mod)
-
-            update()
+                    if event.key == K_F3:
+                        profiler.toggle()
+                    else:
+                        inputs.add_key_down(event.key, event.mod)
+            profiler.lap(PROFILE_EVENTS)
+
+            # Run the game logic at a fixed rate then draw a frame
+            for tick in range(clock.advance()):
+                inputs.set_held_keys(pygame.key.get_pressed())
+                world.step(inputs)
+                if recording is not None:
+                    recording.add_tick(inputs)
+                inputs = TickInput()
+                if not world.is_running():
+                    break
+            profiler.lap(PROFILE_UPDATE)
+            draw_alpha = clock.get_alpha()
             draw()
             screen.update()
-            frame_count += 1
-
-
-game_main()
-pygame.quit()
-sys.exit()
+            profiler.record(PROFILE_PRESENT, screen.get_present_time())
+            profiler.end_frame()
+
+        if recording is not None:
+            recording.set_checksum(world.get_checksum())
+            recording.save(RECORD_FILE)
+
+    profiler.export_csv(PROFILE_FILE)
+
+
+# Only start the game when it is run, either directly or with pgzrun. Importing it
+# (e.g. to run the World headless) doesn't open a window.
+if __name__ == "__main__" or "pgzero.runner" in sys.modules:
+    if len(sys.argv) == 3 and sys.argv[1] == "--replay":
+        replayed = replay(sys.argv[2])
+        pygame.quit()
+        sys.exit(0 if replayed else 1)
+    if len(sys.argv) >= 2 and sys.argv[1] == "--benchmark":
+        benchmark(*(sys.argv[2:4] or [BENCHMARK_FILE]))
+        pygame.quit()
+        sys.exit()
+    game_main()
+    pygame.quit()
+    sys.exit()
@@ -0,0 +1,165 @@
+import os
+from collections import deque
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+import numpy as np
+import pytest
+
+import game
+
+#########################################################################################
+# Helpers. The tests only use small NumPy grids of collision cells, not the map file
+#########################################################################################
+
+# Solid cells in blocks of 3 by 3 collision cells, like walls made of tiles
+def random_solid(rng, tiles_wide, tiles_high, density):
+    tiles = rng.random((tiles_high, tiles_wide)) < density
+    return np.kron(tiles, np.ones((3, 3), dtype=bool))
+
+# Stands in for the map so the path finder only sees a collision table
+class TableMap():
+    def __init__(self, solid):
+        self.__collision_table = game.CollisionTable()
+        self.__collision_table.build(solid)
+
+    def get_collision_table(self):
+        return self.__collision_table
+
+# Stands in for the items when there aren't any on the map
+class NoItems():
+    def mark_blocked_cells(self, blocked, left, top, foot_box):
+        pass
+
+#########################################################################################
+# PathFinder tests
+#########################################################################################
+
+# The cells the path finder treats as blocked, worked out one cell at a time
+def blocked_window(table, left, top, width, height):
+    size = game.COLLISION_CELL_SIZE
+    blocked = np.zeros((height, width), dtype=bool)
+    for y in range(height):
+        for x in range(width):
+            middle_x = (left + x)*size + size//2
+            middle_y = (top + y)*size + size//2
+            blocked[y, x] = table.is_box_blocked(game.PATH_CELL_BOX.move(middle_x, middle_y))
+    blocked[0, :] = True
+    blocked[-1, :] = True
+    blocked[:, 0] = True
+    blocked[:, -1] = True
+    return blocked
+
+# Number of 4-way steps from start to goal in the same window the path finder searches
+def bfs_steps(table, start, goal):
+    margin = game.PATH_SEARCH_MARGIN + 1
+    left = min(start[0], goal[0]) - margin
+    top = min(start[1], goal[1]) - margin
+    width = abs(start[0] - goal[0]) + margin*2 + 1
+    height = abs(start[1] - goal[1]) + margin*2 + 1
+    blocked = blocked_window(table, left, top, width, height)
+    blocked[start[1] - top, start[0] - left] = False
+    if blocked[goal[1] - top, goal[0] - left]:
+        return None
+    steps = {start: 0}
+    queue = deque([start])
+    while queue:
+        cell = queue.popleft()
+        if cell == goal:
+            return steps[cell]
+        for dx, dy in game.FLOW_FIELD_DIRECTIONS:
+            x, y = cell[0] + dx, cell[1] + dy
+            if (x, y) not in steps and not blocked[y - top, x - left]:
+                steps[(x, y)] = steps[cell] + 1
+                queue.append((x, y))
+    return None
+
+@pytest.mark.parametrize("seed", range(4))
+def test_jps_paths_are_as_short_as_bfs(monkeypatch, seed):
+    rng = np.random.default_rng(seed)
+    solid = random_solid(rng, 16, 16, 0.25)
+    table_map = TableMap(solid)
+    monkeypatch.setattr(game, "game_map", table_map, raising=False)
+    monkeypatch.setattr(game, "items", NoItems(), raising=False)
+    table = table_map.get_collision_table()
+    path_finder = game.PathFinder(game.PATH_CACHE_SIZE, game.PATH_REGION_SIZE)
+    size = game.COLLISION_CELL_SIZE
+    height, width = solid.shape
+    for i in range(40):
+        start = (int(rng.integers(width)), int(rng.integers(height)))
+        goal = (int(rng.integers(width)), int(rng.integers(height)))
+        path = path_finder.find_path(start[0]*size, start[1]*size, goal[0]*size, goal[1]*size)
+        steps = bfs_steps(table, start, goal)
+        if steps is None:
+            assert path is None
+            continue
+        assert path is not None
+        assert len(path) == steps + 1
+        assert path[0] == start and path[-1] == goal
+        for a, b in zip(path, path[1:]):
+            assert abs(a[0] - b[0]) + abs(a[1] - b[1]) == 1
+
+#########################################################################################
+# CollisionTable tests
+#########################################################################################
+
+@pytest.mark.parametrize("seed", range(4))
+def test_set_solid_matches_a_full_build(seed):
+    rng = np.random.default_rng(seed)
+    solid = rng.random((45, 60)) < 0.3
+    table = game.CollisionTable()
+    table.build(solid)
+    for i in range(30):
+        width = int(rng.integers(1, 20))
+        height = int(rng.integers(1, 20))
+        cx = int(rng.integers(0, solid.shape[1] - width + 1))
+        cy = int(rng.integers(0, solid.shape[0] - height + 1))
+        if i == 0:
+            cx, cy = 0, 0   # the table is rebuilt from its first row and column
+        region = rng.random((height, width)) < 0.5
+        table.set_solid(cx, cy, region)
+        solid[cy:cy+height, cx:cx+width] = region
+        built = game.CollisionTable()
+        built.build(solid)
+        assert np.array_equal(table.get_solid(), built.get_solid())
+        assert np.array_equal(table.get_table(), built.get_table())
+
+#########################################################################################
+# TriggerZones tests
+#########################################################################################
+
+# Random codes in blocks of cells, so zones are bigger than one cell
+def random_codes(rng, width, height):
+    codes = np.array([0, 0, 0, 1] + list(game.TRIGGER_ACTIONS), dtype=np.uint8)
+    blocks = rng.choice(codes, ((height + 1)//2, (width + 1)//2))
+    return np.kron(blocks, np.ones((2, 2), dtype=np.uint8))[:height, :width]
+
+# Every trigger cell must be in exactly one zone with its code and no other cell in any
+def check_zones(trigger_zones, collision):
+    size = game.COLLISION_CELL_SIZE
+    covered = np.zeros(collision.shape, dtype=int)
+    for zone in trigger_zones.get_zones():
+        rect = zone.get_rect()
+        cells = (slice(rect.top//size, rect.bottom//size), slice(rect.left//size, rect.right//size))
+        assert rect.width > 0 and rect.height > 0
+        assert (collision[cells] == zone.get_code()).all()
+        covered[cells] += 1
+    assert covered.max() <= 1
+    assert np.array_equal(covered == 1, np.isin(collision, list(game.TRIGGER_ACTIONS)))
+
+@pytest.mark.parametrize("seed", range(4))
+def test_update_region_keeps_zones_apart_and_covers_every_cell(seed):
+    rng = np.random.default_rng(seed)
+    collision = random_codes(rng, 40, 30)
+    trigger_zones = game.TriggerZones()
+    trigger_zones.compile(collision)
+    check_zones(trigger_zones, collision)
+    for i in range(60):
+        width = int(rng.integers(1, 12))
+        height = int(rng.integers(1, 12))
+        cx = int(rng.integers(0, collision.shape[1] - width + 1))
+        cy = int(rng.integers(0, collision.shape[0] - height + 1))
+        collision[cy:cy+height, cx:cx+width] = random_codes(rng, width, height)
+        trigger_zones.update_region(collision, cx, cy, width, height)
+        check_zones(trigger_zones, collision)